@@ -1,20 +1,35 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Cookie, Response, Header, WebSocket, WebSocketDisconnect, File, UploadFile, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Cookie, Response, Request, Header, WebSocket, WebSocketDisconnect, File, UploadFile, Form
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import os
 import logging
 import re
 import base64
+import io
+import hashlib
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Literal, Dict, Set
+from typing import Any, List, Optional, Literal, Dict, Set
 import uuid
 from datetime import datetime, timezone, timedelta
 import httpx
+import jwt
+import Levenshtein
 import asyncio
 import json
+import time
+import math
+import heapq
+import bisect
+import numpy as np
+from collections import OrderedDict
+from sortedcontainers import SortedList
+from zoneinfo import ZoneInfo
+from PIL import Image
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -38,6 +53,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# The event loop only holds weak references to tasks, so fire-and-forget work is kept here until done
+background_tasks: Set[asyncio.Task] = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 # ============================================
 # PYDANTIC MODELS
 # ============================================
@@ -81,6 +105,8 @@ class Product(BaseModel):
     available: bool = True
     category: Optional[str] = None
     image_url: Optional[str] = None
+    barcode: Optional[str] = None
+    sku: Optional[str] = None
     created_at: datetime
 
 class OrderItem(BaseModel):
@@ -227,9 +253,9 @@ ACHIEVEMENT_DEFINITIONS = {
     },
     "popular": {
         "name": "Pulpería Popular",
-        "description": "200+ visitas a tu perfil",
+        "description": "200+ visitantes distintos en tu perfil",
         "icon": "Users",
-        "criteria": {"profile_views": 200},
+        "criteria": {"unique_visitors": 200},
         "points": 40
     },
     
@@ -255,6 +281,13 @@ ACHIEVEMENT_DEFINITIONS = {
         "criteria": {"profile_views": 500},
         "points": 60
     },
+    "top_diez": {
+        "name": "Top 10",
+        "description": "Entre las 10 mejores pulperías en ventas, calificación o crecimiento",
+        "icon": "Medal",
+        "criteria": {"top_rank": 10},
+        "points": 75
+    },
     
     # Nivel 5 - Maestro (Legendarios)
     "verificado": {
@@ -275,9 +308,9 @@ ACHIEVEMENT_DEFINITIONS = {
     },
     "leyenda": {
         "name": "Leyenda Local",
-        "description": "1000+ visitas y 50+ reseñas positivas",
+        "description": "1000+ visitantes distintos y 50+ reseñas positivas",
         "icon": "Crown",
-        "criteria": {"profile_views": 1000, "happy_customers": 50},
+        "criteria": {"unique_visitors": 1000, "happy_customers": 50},
         "points": 200,
         "tier": "legendary"
     }
@@ -294,6 +327,7 @@ class PulperiaStats(BaseModel):
     sales_count: int = 0
     products_count: int = 0
     profile_views: int = 0
+    unique_visitors: int = 0  # Visitantes únicos de todo el historial (HyperLogLog)
     happy_customers: int = 0  # Clientes con rating >= 4
     avg_response_time: int = 999  # En minutos
     is_verified: bool = False
@@ -358,6 +392,8 @@ class ProductCreate(BaseModel):
     available: bool = True
     category: Optional[str] = None
     image_url: Optional[str] = None
+    barcode: Optional[str] = None  # EAN/UPC, unique per pulperia
+    sku: Optional[str] = None  # Owner's own code, unique per pulperia
 
 class ReviewCreate(BaseModel):
     rating: int
@@ -411,6 +447,276 @@ class UserTypeChange(BaseModel):
 # AUTHENTICATION HELPERS
 # ============================================
 
+# Session cache configuration
+SESSION_CACHE_TTL_SECONDS = int(os.environ.get('SESSION_CACHE_TTL_SECONDS', '60'))
+SESSION_CACHE_MAX_ENTRIES = int(os.environ.get('SESSION_CACHE_MAX_ENTRIES', '10000'))
+
+class SessionCache:
+    """In-process LRU cache of resolved sessions keyed by session token.
+    
+    An entry lives at most `ttl_seconds` and never past the session's own
+    expiry. Invalidation only reaches the current process, so with several
+    workers the TTL bounds how stale a user can get.
+    """
+    
+    def __init__(self, max_entries: int = SESSION_CACHE_MAX_ENTRIES, ttl_seconds: int = SESSION_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.user_tokens: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, token: str) -> Optional[dict]:
+        entry = self.entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        if entry["cached_until"] <= time.monotonic():
+            self._remove(token)
+            self.misses += 1
+            return None
+        
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return entry
+    
+    def set(self, token: str, user: User, expires_at: datetime, jti: Optional[str] = None, last_seen: Optional[datetime] = None):
+        if self.max_entries <= 0:
+            return
+        
+        if token in self.entries:
+            self._remove(token)
+        
+        self.entries[token] = {
+            "user": user,
+            "expires_at": expires_at,
+            "jti": jti,
+            "last_seen": last_seen,
+            "cached_until": time.monotonic() + self.ttl_seconds
+        }
+        self.user_tokens.setdefault(user.user_id, set()).add(token)
+        
+        while len(self.entries) > self.max_entries:
+            oldest_token = next(iter(self.entries))
+            self._remove(oldest_token)
+            self.evictions += 1
+    
+    def invalidate(self, token: str):
+        if token in self.entries:
+            self._remove(token)
+            self.invalidations += 1
+    
+    def invalidate_user(self, user_id: str):
+        for token in list(self.user_tokens.get(user_id, ())):
+            self.invalidate(token)
+    
+    def _remove(self, token: str):
+        entry = self.entries.pop(token, None)
+        if entry is None:
+            return
+        
+        user_id = entry["user"].user_id
+        tokens = self.user_tokens.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.user_tokens[user_id]
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+session_cache = SessionCache()
+
+# Signed (stateless) session tokens. Opaque tokens keep working while enabled.
+SESSION_DURATION = timedelta(days=7)
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+SIGNED_SESSIONS_ENABLED = os.environ.get('SIGNED_SESSIONS_ENABLED', 'false').lower() == 'true' and bool(SESSION_SIGNING_KEY)
+REVOCATION_SYNC_SECONDS = int(os.environ.get('REVOCATION_SYNC_SECONDS', '30'))
+# Each sync re-reads this much before the previous one, for revocations stamped before it but written after
+REVOCATION_SYNC_OVERLAP = timedelta(seconds=int(os.environ.get('REVOCATION_SYNC_OVERLAP_SECONDS', '120')))
+
+# Sliding expiry for opaque sessions: last_seen/expires_at are written at most once per interval
+SESSION_SLIDING_EXPIRY = os.environ.get('SESSION_SLIDING_EXPIRY', 'false').lower() == 'true'
+SESSION_TOUCH_INTERVAL = timedelta(seconds=int(os.environ.get('SESSION_TOUCH_INTERVAL_SECONDS', '900')))
+
+def to_utc_datetime(value) -> datetime:
+    """Normalize an ISO string or naive BSON datetime to an aware UTC datetime"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+def is_signed_session_token(token: str) -> bool:
+    """Signed tokens are JWTs (three dot-separated parts); opaque tokens have no dots"""
+    return token.count(".") == 2
+
+def issue_signed_session_token(user_id: str, user_type: Optional[str]) -> str:
+    """Issue an HMAC-signed session token carrying user_id, user_type and expiry"""
+    now = datetime.now(timezone.utc)
+    claims = {
+        "sub": user_id,
+        "user_type": user_type,
+        "iat": now,
+        "exp": now + SESSION_DURATION,
+        "jti": uuid.uuid4().hex
+    }
+    return jwt.encode(claims, SESSION_SIGNING_KEY, algorithm="HS256")
+
+def decode_signed_session_token(token: str) -> dict:
+    """Validate a signed session token without touching the database"""
+    if not SESSION_SIGNING_KEY:
+        raise HTTPException(status_code=401, detail="Sesión inválida")
+    
+    try:
+        claims = jwt.decode(
+            token,
+            SESSION_SIGNING_KEY,
+            algorithms=["HS256"],
+            options={"require": ["sub", "exp", "jti"]}
+        )
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Sesión expirada")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Sesión inválida")
+    
+    if claims["jti"] in revoked_sessions:
+        raise HTTPException(status_code=401, detail="Sesión inválida")
+    
+    return claims
+
+class RevocationList:
+    """In-memory set of revoked signed-session ids, kept in sync from db.revoked_sessions"""
+    
+    def __init__(self):
+        self.revoked: Dict[str, float] = {}  # jti -> token expiry (unix timestamp)
+        self.last_sync: Optional[datetime] = None
+    
+    def __contains__(self, jti: str) -> bool:
+        return jti in self.revoked
+    
+    def add(self, jti: str, exp: float):
+        self.revoked[jti] = exp
+    
+    async def revoke(self, claims: dict):
+        self.add(claims["jti"], claims["exp"])
+        await db.revoked_sessions.update_one(
+            {"jti": claims["jti"]},
+            {"$setOnInsert": {
+                "jti": claims["jti"],
+                "user_id": claims["sub"],
+                "expires_at": datetime.fromtimestamp(claims["exp"], tz=timezone.utc),
+                "revoked_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
+    
+    async def sync(self):
+        """Pull revocations issued since the last sync (by any worker) and drop expired ones"""
+        now = datetime.now(timezone.utc)
+        query = {"expires_at": {"$gt": now}}
+        if self.last_sync:
+            query["revoked_at"] = {"$gte": self.last_sync - REVOCATION_SYNC_OVERLAP}
+        
+        async for doc in db.revoked_sessions.find(query, {"_id": 0, "jti": 1, "expires_at": 1}):
+            self.add(doc["jti"], to_utc_datetime(doc["expires_at"]).timestamp())
+        
+        self.revoked = {jti: exp for jti, exp in self.revoked.items() if exp > now.timestamp()}
+        self.last_sync = now
+
+revoked_sessions = RevocationList()
+
+async def revocation_sync_loop():
+    """Background task keeping the revocation list in sync across workers"""
+    while True:
+        await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+        try:
+            await revoked_sessions.sync()
+        except Exception as e:
+            logger.warning(f"[AUTH] Revocation sync failed: {e}")
+
+async def create_user_session(user_id: str, user_type: Optional[str], opaque_token: Optional[str] = None) -> str:
+    """Create a session for a user and return its token
+    
+    Issues a signed token when SIGNED_SESSIONS_ENABLED, otherwise stores an
+    opaque token (the given one or a new sess_<uuid>) in db.user_sessions.
+    """
+    if SIGNED_SESSIONS_ENABLED:
+        return issue_signed_session_token(user_id, user_type)
+    
+    now = datetime.now(timezone.utc)
+    session_token = opaque_token or f"sess_{uuid.uuid4().hex}"
+    session_doc = {
+        "user_id": user_id,
+        "session_token": session_token,
+        "expires_at": now + SESSION_DURATION,  # BSON date so the TTL index can purge it
+        "last_seen": now,
+        "created_at": now
+    }
+    await db.user_sessions.insert_one(session_doc)
+    return session_token
+
+async def slide_session_expiry(token: str, last_seen: Optional[datetime]) -> Optional[datetime]:
+    """Extend an opaque session if it was last touched more than SESSION_TOUCH_INTERVAL ago
+    
+    The filter on last_seen coalesces concurrent touches from several
+    requests or workers into a single write. Returns the new expiry, or
+    None when this call did not extend the session.
+    """
+    now = datetime.now(timezone.utc)
+    if not SESSION_SLIDING_EXPIRY or (last_seen and now - last_seen < SESSION_TOUCH_INTERVAL):
+        return None
+    
+    expires_at = now + SESSION_DURATION
+    result = await db.user_sessions.update_one(
+        {
+            "session_token": token,
+            "$or": [
+                {"last_seen": {"$lt": now - SESSION_TOUCH_INTERVAL}},
+                {"last_seen": {"$exists": False}}
+            ]
+        },
+        {"$set": {"last_seen": now, "expires_at": expires_at}}
+    )
+    return expires_at if result.modified_count else None
+
+async def migrate_session_datetimes(batch_size: int = 1000) -> int:
+    """Convert legacy ISO-string session dates to BSON dates so the TTL index applies"""
+    migrated = 0
+    while True:
+        legacy_sessions = await db.user_sessions.find(
+            {"expires_at": {"$type": "string"}},
+            {"_id": 1, "expires_at": 1, "created_at": 1}
+        ).to_list(batch_size)
+        if not legacy_sessions:
+            break
+        
+        operations = []
+        for session in legacy_sessions:
+            update = {"expires_at": to_utc_datetime(session["expires_at"])}
+            if isinstance(session.get("created_at"), str):
+                update["created_at"] = to_utc_datetime(session["created_at"])
+            operations.append(UpdateOne({"_id": session["_id"]}, {"$set": update}))
+        
+        await db.user_sessions.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+    
+    return migrated
+
 async def get_current_user(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     """Get current authenticated user from session token"""
     token = None
@@ -423,27 +729,56 @@ async def get_current_user(authorization: Optional[str] = Header(None), session_
     if not token:
         raise HTTPException(status_code=401, detail="No autenticado")
     
-    session_doc = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
-    if not session_doc:
-        raise HTTPException(status_code=401, detail="Sesión inválida")
-    
-    expires_at = session_doc["expires_at"]
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    
-    if expires_at < datetime.now(timezone.utc):
-        raise HTTPException(status_code=401, detail="Sesión expirada")
-    
-    user_doc = await db.users.find_one({"user_id": session_doc["user_id"]}, {"_id": 0})
+    cached = session_cache.get(token)
+    if cached:
+        if cached["expires_at"] < datetime.now(timezone.utc):
+            session_cache.invalidate(token)
+            raise HTTPException(status_code=401, detail="Sesión expirada")
+        if cached["jti"] and cached["jti"] in revoked_sessions:
+            session_cache.invalidate(token)
+            raise HTTPException(status_code=401, detail="Sesión inválida")
+        if not cached["jti"]:
+            new_expiry = await slide_session_expiry(token, cached["last_seen"])
+            if new_expiry:
+                cached["expires_at"] = new_expiry
+                cached["last_seen"] = datetime.now(timezone.utc)
+        return cached["user"]
+    
+    jti = None
+    last_seen = None
+    if is_signed_session_token(token):
+        # Signed tokens are validated locally; only the user profile is read
+        claims = decode_signed_session_token(token)
+        user_id = claims["sub"]
+        jti = claims["jti"]
+        expires_at = datetime.fromtimestamp(claims["exp"], tz=timezone.utc)
+    else:
+        session_doc = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
+        if not session_doc:
+            raise HTTPException(status_code=401, detail="Sesión inválida")
+        
+        expires_at = to_utc_datetime(session_doc["expires_at"])
+        if expires_at < datetime.now(timezone.utc):
+            raise HTTPException(status_code=401, detail="Sesión expirada")
+        user_id = session_doc["user_id"]
+        
+        if session_doc.get("last_seen"):
+            last_seen = to_utc_datetime(session_doc["last_seen"])
+        new_expiry = await slide_session_expiry(token, last_seen)
+        if new_expiry:
+            expires_at = new_expiry
+            last_seen = datetime.now(timezone.utc)
+    
+    user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     if not user_doc:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
     # Check if user is admin
     user_doc["is_admin"] = user_doc.get("email") == ADMIN_EMAIL
     
-    return User(**user_doc)
+    user = User(**user_doc)
+    session_cache.set(token, user, expires_at, jti, last_seen)
+    return user
 
 async def get_admin_user(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     """Get current user and verify admin access"""
@@ -470,34 +805,1964 @@ def normalize_text(text: str) -> str:
         text = text.replace(old, new)
     return text
 
+def strip_plural(term: str) -> str:
+    """Remove trailing 's' for singular/plural matching"""
+    if term.endswith('s') and len(term) > 2:
+        return term[:-1]
+    return term
+
 def create_search_pattern(search_term: str) -> str:
     """Create a flexible regex pattern for fuzzy search"""
-    normalized = normalize_text(search_term)
-    # Remove trailing 's' for singular/plural matching
-    if normalized.endswith('s') and len(normalized) > 2:
-        normalized = normalized[:-1]
+    normalized = strip_plural(normalize_text(search_term))
     # Create pattern that matches the base term
     return normalized
 
-async def fuzzy_search_products(search_term: str) -> list:
-    """Search products with fuzzy matching"""
-    base_pattern = create_search_pattern(search_term)
+def search_tokens(text: str) -> List[str]:
+    """Split text into normalized, singularized search terms"""
+    return [strip_plural(token) for token in re.findall(r"[a-z0-9]+", normalize_text(text))]
+
+# Server-side product sorts; product_id breaks ties so keyset cursors are stable
+PRODUCT_SORTS = {
+    "price_asc": [("price", 1), ("product_id", 1)],
+    "price_desc": [("price", -1), ("product_id", -1)],
+    "newest": [("created_at", -1), ("product_id", -1)]
+}
+PRODUCT_PAGE_SIZE = 100
+
+def encode_cursor(payload: dict) -> str:
+    """Opaque pagination token"""
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(token: str, sort_name: str) -> dict:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(payload, dict) or payload.get("sort") != sort_name or not isinstance(payload.get("after"), list):
+            raise ValueError("cursor does not match the request")
+        return payload
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+def keyset_filter(sort_spec: List[tuple], after: list) -> dict:
+    """Match documents strictly after `after` in the given sort order
+    
+    The bound on the leading field lets Mongo seek into the sort index
+    instead of scanning from the first page.
+    """
+    branches = []
+    for i, (field, direction) in enumerate(sort_spec):
+        branch = {prev_field: after[j] for j, (prev_field, _) in enumerate(sort_spec[:i])}
+        branch[field] = {"$gt" if direction == 1 else "$lt": after[i]}
+        branches.append(branch)
+    
+    leading_field, leading_direction = sort_spec[0]
+    return {leading_field: {"$gte" if leading_direction == 1 else "$lte": after[0]}, "$or": branches}
+
+async def sorted_product_page(search: Optional[str], category: Optional[str], sort_name: str, limit: int, after: Optional[list]) -> tuple:
+    """One page of products sorted by Mongo on an indexed key, returning (products, last sort values or None)"""
+    sort_spec = PRODUCT_SORTS[sort_name]
+    conditions = [{"available": True}]
+    if category:
+        conditions.append({"category": category})
+    if search:
+        conditions.append(prefix_search_query("products", search))
+    if after:
+        conditions.append(keyset_filter(sort_spec, after))
+    
+    query = conditions[0] if len(conditions) == 1 else {"$and": conditions}
+    products = await db.products.find(query, PUBLIC_PROJECTION).sort(sort_spec).limit(limit + 1).to_list(limit + 1)
+    if len(products) <= limit:
+        return products, None
+    
+    products = products[:limit]
+    return products, [products[-1].get(field) for field, _ in sort_spec]
+
+async def relevance_product_page(search: str, category: Optional[str], limit: int, after: Optional[list], snapshot: Optional[dict] = None) -> tuple:
+    """One page of BM25-ranked products from the in-memory index
+    
+    Returns (products, last (score, id) or None, scoring snapshot). Later
+    pages must pass the first page's snapshot so their scores, and with
+    them the (score, id) keyset, are computed the same way.
+    """
+    try:
+        scores, snapshot = product_search_index.scored_match(search, snapshot)
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+    if category:
+        scores = {
+            product_id: score for product_id, score in scores.items()
+            if category_facets.products.get(product_id, (None, None))[1] == category
+        }
+    
+    keys = ((-score, product_id) for product_id, score in scores.items())
+    if after:
+        after_key = (-after[0], after[1])
+        keys = (key for key in keys if key > after_key)
+    page = heapq.nsmallest(limit + 1, keys)
+    
+    last = None
+    if len(page) > limit:
+        page = page[:limit]
+        last = [-page[-1][0], page[-1][1]]
+    if not page:
+        return [], None, snapshot
     
-    # Search with multiple patterns
+    product_ids = [product_id for _, product_id in page]
     products = await db.products.find(
-        {
-            "$or": [
-                {"name": {"$regex": base_pattern, "$options": "i"}},
-                {"name": {"$regex": f".*{base_pattern}.*", "$options": "i"}},
-                {"description": {"$regex": base_pattern, "$options": "i"}},
-                {"category": {"$regex": base_pattern, "$options": "i"}}
-            ],
-            "available": True
-        },
-        {"_id": 0}
-    ).to_list(100)
+        {"product_id": {"$in": product_ids}, "available": True},
+        PUBLIC_PROJECTION
+    ).to_list(len(product_ids))
+    position = {product_id: i for i, product_id in enumerate(product_ids)}
+    products.sort(key=lambda p: position[p["product_id"]])
+    return products, last, snapshot
+
+# ============================================
+# PERSISTED SEARCH FIELDS
+# ============================================
+
+# Normalized copies written with each document so searches can use anchored, indexed lookups
+SEARCH_FIELD_SOURCES = {
+    "products": ("name", ["name", "description", "category"]),
+    "pulperias": ("name", ["name", "address"]),
+    "jobs": ("title", ["title", "description"]),
+    "services": ("title", ["title", "description"])
+}
+SEARCH_PREFIX_MAX_LENGTH = 12
+
+# Keeps the persisted search fields out of API responses
+PUBLIC_PROJECTION = {"_id": 0, "name_norm": 0, "title_norm": 0, "search_tokens": 0, "search_prefixes": 0, "geo_location": 0, "hours_schedule": 0, "hours_schedule_version": 0}
+
+def build_search_fields(collection_name: str, doc: dict) -> dict:
+    """Build name_norm/title_norm, token array and prefix keys for a document"""
+    name_field, text_fields = SEARCH_FIELD_SOURCES[collection_name]
+    tokens = list(dict.fromkeys(
+        token for field in text_fields for token in search_tokens(doc.get(field) or "")
+    ))
+    prefixes = {
+        token[:length]
+        for token in tokens
+        for length in range(1, min(len(token), SEARCH_PREFIX_MAX_LENGTH) + 1)
+    }
+    return {
+        f"{name_field}_norm": normalize_text(doc.get(name_field) or ""),
+        "search_tokens": tokens,
+        "search_prefixes": sorted(prefixes)
+    }
+
+def prefix_search_query(collection_name: str, search: str, terms: Optional[List[str]] = None) -> dict:
+    """Anchored, index-backed query matching every search term as a word prefix
+    
+    Documents written before the search fields existed (not yet backfilled)
+    are still matched through the legacy regex on their text fields. Callers
+    that already tokenized the search can pass `terms` to skip that step.
+    """
+    if terms is None:
+        terms = search_tokens(search)
+    terms = [term[:SEARCH_PREFIX_MAX_LENGTH] for term in dict.fromkeys(terms)]
+    if not terms:
+        return {}
+    
+    pattern = create_search_pattern(search)
+    _, text_fields = SEARCH_FIELD_SOURCES[collection_name]
+    return {
+        "$or": [
+            {"search_prefixes": {"$all": terms}},
+            {
+                "search_prefixes": {"$exists": False},
+                "$or": [{field: {"$regex": re.escape(pattern), "$options": "i"}} for field in text_fields]
+            }
+        ]
+    }
+
+async def backfill_search_fields(collection_name: str, only_missing: bool = True, batch_size: int = 500) -> int:
+    """Write the persisted search fields on existing documents in batches"""
+    collection = db[collection_name]
+    _, text_fields = SEARCH_FIELD_SOURCES[collection_name]
+    query = {"search_prefixes": {"$exists": False}} if only_missing else {}
+    projection = {"_id": 1, **{field: 1 for field in text_fields}}
     
-    return products
+    updated = 0
+    operations = []
+    async for doc in collection.find(query, projection).batch_size(batch_size):
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": build_search_fields(collection_name, doc)}))
+        if len(operations) >= batch_size:
+            await collection.bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+    
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    
+    return updated
+
+# ============================================
+# SEARCH RESULT CACHE
+# ============================================
+
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', '5000'))
+SEARCH_CACHE_TTL_SECONDS = int(os.environ.get('SEARCH_CACHE_TTL_SECONDS', '300'))
+
+class SearchResultCache:
+    """LRU cache of first pages of /api/products keyed by normalized query, category, sort and page size.
+    
+    Each entry remembers the products and pulperias it returned and the
+    terms it searched for. A product write drops the entries that returned
+    that product or whose terms it now matches; a pulperia write drops the
+    entries showing its name or logo. Responses that depended on the whole
+    vocabulary (empty or typo-corrected) go on any product write. The TTL
+    only bounds staleness caused by writes on other workers.
+    
+    Every invalidation bumps `generation`. A result computed while the
+    generation moved is not stored, since the write it raced with could
+    not drop an entry that did not exist yet.
+    """
+    
+    def __init__(self, max_entries: int = SEARCH_CACHE_MAX_ENTRIES, ttl_seconds: int = SEARCH_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.by_product: Dict[str, Set[tuple]] = {}
+        self.by_pulperia: Dict[str, Set[tuple]] = {}
+        self.by_term: Dict[str, Set[tuple]] = {}
+        self.by_listing: Dict[str, Set[tuple]] = {}
+        self.vocabulary_dependent: Set[tuple] = set()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_discards = 0
+    
+    @staticmethod
+    def make_key(search: Optional[str], category: Optional[str], sort_by: Optional[str], limit: int = PRODUCT_PAGE_SIZE) -> tuple:
+        return (" ".join(search_tokens(search or "")), category or "", sort_by or "", limit)
+    
+    def get(self, key: tuple) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        if entry["cached_until"] <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    
+    def set(self, key: tuple, results: list, did_you_mean: Optional[str] = None, next_cursor: Optional[str] = None, generation: Optional[int] = None):
+        """Store a response; `generation` is the value read before computing it"""
+        if self.max_entries <= 0:
+            return
+        if generation is not None and generation != self.generation:
+            self.stale_discards += 1
+            return
+        
+        if key in self.entries:
+            self._remove(key)
+        
+        query, category = key[0], key[1]
+        terms = set(query.split()) | set(search_tokens(did_you_mean or ""))
+        entry = {
+            "results": results,
+            "did_you_mean": did_you_mean,
+            "next_cursor": next_cursor,
+            "products": {product["product_id"] for product in results},
+            "pulperias": {product["pulperia_id"] for product in results},
+            "terms": terms,
+            "listing": None if query else category,
+            "cached_until": time.monotonic() + self.ttl_seconds
+        }
+        self.entries[key] = entry
+        
+        for product_id in entry["products"]:
+            self.by_product.setdefault(product_id, set()).add(key)
+        for pulperia_id in entry["pulperias"]:
+            self.by_pulperia.setdefault(pulperia_id, set()).add(key)
+        for term in terms:
+            self.by_term.setdefault(term, set()).add(key)
+        if entry["listing"] is not None:
+            self.by_listing.setdefault(entry["listing"], set()).add(key)
+        if query and (did_you_mean or not results):
+            self.vocabulary_dependent.add(key)
+        
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+    
+    def invalidate_product(self, product: dict, deleted: bool = False):
+        keys = set(self.by_product.get(product["product_id"], ()))
+        if not deleted and product.get("available", True):
+            # Queries the new version can match: any cached term prefixing one of its tokens
+            for field in ProductSearchIndex.FIELD_WEIGHTS:
+                for token in search_tokens(product.get(field) or ""):
+                    for end in range(1, len(token) + 1):
+                        keys.update(self.by_term.get(token[:end], ()))
+            keys.update(self.by_listing.get("", ()))
+            keys.update(self.by_listing.get(product.get("category") or "", ()))
+            keys.update(self.vocabulary_dependent)
+        self._invalidate(keys)
+    
+    def invalidate_pulperia(self, pulperia_id: str):
+        self._invalidate(set(self.by_pulperia.get(pulperia_id, ())))
+    
+    def clear(self):
+        self._invalidate(set(self.entries))
+    
+    def _invalidate(self, keys: Set[tuple]):
+        self.generation += 1
+        for key in keys:
+            if key in self.entries:
+                self._remove(key)
+                self.invalidations += 1
+    
+    def _remove(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        
+        for index, values in (
+            (self.by_product, entry["products"]),
+            (self.by_pulperia, entry["pulperias"]),
+            (self.by_term, entry["terms"]),
+            (self.by_listing, [] if entry["listing"] is None else [entry["listing"]])
+        ):
+            for value in values:
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+        self.vocabulary_dependent.discard(key)
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale_discards": self.stale_discards
+        }
+
+search_result_cache = SearchResultCache()
+
+# ============================================
+# TYPO TOLERANCE
+# ============================================
+
+class TrigramIndex:
+    """Trigram candidate index over a search vocabulary
+    
+    Candidates sharing enough trigrams with a misspelled term are
+    re-ranked by Levenshtein distance, then by how many documents use
+    them. Terms are reference counted so documents can add and drop
+    them incrementally.
+    """
+    
+    def __init__(self):
+        self.trigrams: Dict[str, Set[str]] = {}
+        self.counts: Dict[str, int] = {}
+        self.documents: Dict[str, List[str]] = {}
+    
+    @staticmethod
+    def trigrams_of(term: str) -> Set[str]:
+        padded = f"${term}$"
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    @staticmethod
+    def max_distance(term: str) -> int:
+        if len(term) < 3:
+            return 0
+        return 1 if len(term) < 6 else 2
+    
+    def add_term(self, term: str):
+        count = self.counts.get(term, 0)
+        self.counts[term] = count + 1
+        if count == 0:
+            for gram in self.trigrams_of(term):
+                self.trigrams.setdefault(gram, set()).add(term)
+    
+    def remove_term(self, term: str):
+        count = self.counts.get(term, 0)
+        if count > 1:
+            self.counts[term] = count - 1
+            return
+        
+        self.counts.pop(term, None)
+        for gram in self.trigrams_of(term):
+            terms = self.trigrams.get(gram)
+            if terms is not None:
+                terms.discard(term)
+                if not terms:
+                    del self.trigrams[gram]
+    
+    def set_document(self, doc_id: str, terms: List[str]):
+        self.remove_document(doc_id)
+        unique_terms = list(dict.fromkeys(terms))
+        self.documents[doc_id] = unique_terms
+        for term in unique_terms:
+            self.add_term(term)
+    
+    def remove_document(self, doc_id: str):
+        for term in self.documents.pop(doc_id, []):
+            self.remove_term(term)
+    
+    def suggest(self, term: str, limit: int = 5) -> List[tuple]:
+        """Return (term, distance) pairs for vocabulary terms close to `term`"""
+        max_distance = self.max_distance(term)
+        if not max_distance:
+            return []
+        
+        grams = self.trigrams_of(term)
+        shared: Dict[str, int] = {}
+        for gram in grams:
+            for candidate in self.trigrams.get(gram, ()):
+                if abs(len(candidate) - len(term)) <= max_distance:
+                    shared[candidate] = shared.get(candidate, 0) + 1
+        
+        # Each edit destroys at most three trigrams (q-gram lemma)
+        min_shared = max(1, len(grams) - 3 * max_distance)
+        matches = []
+        for candidate, count in shared.items():
+            if count < min_shared or candidate == term:
+                continue
+            distance = Levenshtein.distance(term, candidate, score_cutoff=max_distance)
+            if distance <= max_distance:
+                matches.append((candidate, distance))
+        
+        matches.sort(key=lambda match: (match[1], -self.counts.get(match[0], 0)))
+        return matches[:limit]
+    
+    def correct_query(self, query: str, is_known=None) -> Optional[str]:
+        """Replace unknown terms with their closest vocabulary term, or None if nothing changes"""
+        is_known = is_known or (lambda term: term in self.counts)
+        terms = search_tokens(query)
+        corrected = []
+        changed = False
+        for term in terms:
+            if not is_known(term):
+                # Prefer a correction that does not just repeat another query term
+                suggestions = [candidate for candidate, _ in self.suggest(term) if candidate not in terms]
+                if suggestions:
+                    term = suggestions[0]
+                    changed = True
+            corrected.append(term)
+        return " ".join(corrected) if changed else None
+    
+    async def rebuild_from(self, collection_name: str, id_field: str, text_fields: List[str], batch_size: int = 1000):
+        """Load document vocabularies from Mongo in batches and swap them in"""
+        fresh = TrigramIndex()
+        projection = {"_id": 0, id_field: 1, **{field: 1 for field in text_fields}}
+        async for doc in db[collection_name].find({}, projection).batch_size(batch_size):
+            fresh.set_document(doc[id_field], vocabulary_terms(doc, text_fields))
+        
+        self.trigrams = fresh.trigrams
+        self.counts = fresh.counts
+        self.documents = fresh.documents
+    
+    def stats(self) -> dict:
+        return {"terms": len(self.counts), "trigrams": len(self.trigrams)}
+
+PULPERIA_VOCABULARY_FIELDS = ["name", "address"]
+
+def vocabulary_terms(doc: dict, text_fields: List[str]) -> List[str]:
+    return [term for field in text_fields for term in search_tokens(doc.get(field) or "")]
+
+pulperia_vocabulary = TrigramIndex()
+
+def index_pulperia_change(pulperia: dict, deleted: bool = False):
+    """Apply a pulperia write in this worker and log it for the others"""
+    apply_pulperia_change(pulperia, deleted)
+    catalog_changes.record("pulperia", pulperia["pulperia_id"], deleted)
+
+def apply_pulperia_change(pulperia: dict, deleted: bool = False):
+    """Propagate a pulperia write to the in-memory search, map and leaderboard structures"""
+    search_result_cache.invalidate_pulperia(pulperia["pulperia_id"])
+    map_tile_cache.invalidate_marker(pulperia_grid.get(pulperia["pulperia_id"]))
+    open_map_tile_cache.invalidate_marker(pulperia_grid.get(pulperia["pulperia_id"]))
+    if deleted:
+        pulperia_vocabulary.remove_document(pulperia["pulperia_id"])
+        search_suggestions.remove_source(pulperia["pulperia_id"])
+        pulperia_grid.remove(pulperia["pulperia_id"])
+        leaderboards.forget(pulperia["pulperia_id"])
+    else:
+        pulperia_vocabulary.set_document(pulperia["pulperia_id"], vocabulary_terms(pulperia, PULPERIA_VOCABULARY_FIELDS))
+        search_suggestions.set_pulperia(pulperia)
+        pulperia_grid.upsert(pulperia)
+        leaderboards.set_pulperia(pulperia)
+        map_tile_cache.invalidate_marker(pulperia_grid.get(pulperia["pulperia_id"]))
+        open_map_tile_cache.invalidate_marker(pulperia_grid.get(pulperia["pulperia_id"]))
+
+# ============================================
+# PRODUCT SEARCH INDEX
+# ============================================
+
+PRODUCT_INDEX_PROJECTION = {"_id": 0, "product_id": 1, "pulperia_id": 1, "name": 1, "description": 1, "category": 1, "available": 1}
+
+class ProductSearchIndex:
+    """In-memory inverted index over available products, ranked with BM25
+    
+    Terms come from search_tokens, so matching follows the same accent
+    folding and plural stripping as create_search_pattern. Name and
+    category occurrences weigh more than description ones. A query term
+    matches every vocabulary term it prefixes ("lech" -> "leche") and a
+    product must match every query term, which is the match set of the
+    persisted search_prefixes lookup used by the explicit sorts.
+    The term vocabulary feeds a TrigramIndex used for typo correction.
+    """
+    
+    FIELD_WEIGHTS = {"name": 3.0, "category": 2.0, "description": 1.0}
+    
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.doc_terms: Dict[str, Dict[str, float]] = {}
+        self.doc_lengths: Dict[str, float] = {}
+        self.total_length = 0.0
+        self._sorted_terms: Optional[List[str]] = None
+        self.vocabulary = TrigramIndex()
+        self.ready = False
+    
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+    
+    def add(self, product: dict):
+        product_id = product["product_id"]
+        self.remove(product_id)
+        
+        terms: Dict[str, float] = {}
+        for field, weight in self.FIELD_WEIGHTS.items():
+            for term in search_tokens(product.get(field) or ""):
+                terms[term] = terms.get(term, 0.0) + weight
+        
+        length = sum(terms.values())
+        self.doc_terms[product_id] = terms
+        self.doc_lengths[product_id] = length
+        self.total_length += length
+        for term, tf in terms.items():
+            if term not in self.postings:
+                self.postings[term] = {}
+                self._sorted_terms = None
+            self.postings[term][product_id] = tf
+            self.vocabulary.add_term(term)
+    
+    def remove(self, product_id: str):
+        terms = self.doc_terms.pop(product_id, None)
+        if terms is None:
+            return
+        
+        self.total_length -= self.doc_lengths.pop(product_id, 0.0)
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            self.vocabulary.remove_term(term)
+            if not postings:
+                del self.postings[term]
+                self._sorted_terms = None
+    
+    def expand_term(self, term: str) -> List[str]:
+        """Vocabulary terms starting with `term`, cut like the persisted prefixes"""
+        term = term[:SEARCH_PREFIX_MAX_LENGTH]
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        # Terms are [a-z0-9]+, so "{" sorts after every term with this prefix
+        start = bisect.bisect_left(self._sorted_terms, term)
+        end = bisect.bisect_left(self._sorted_terms, term + "{", start)
+        return self._sorted_terms[start:end]
+    
+    def search(self, query: str, limit: int = 100) -> List[tuple]:
+        """Return (product_id, score) pairs, best first"""
+        return heapq.nlargest(limit, self.match(query).items(), key=lambda item: item[1])
+    
+    def match(self, query: str) -> Dict[str, float]:
+        """BM25 score of every product matching the query"""
+        return self.scored_match(query)[0]
+    
+    def scored_match(self, query: str, snapshot: Optional[dict] = None) -> tuple:
+        """(scores, snapshot) for the products matching every query term
+        
+        A query term's frequency in a product sums its expansions, and its
+        document frequency is the number of products it matches. The
+        snapshot holds the corpus statistics the scores used; passing it
+        back scores later pages the same way, so a product only moves
+        between pages when that product itself changes.
+        """
+        frequencies = []
+        for query_term in dict.fromkeys(search_tokens(query)):
+            tf_by_product: Dict[str, float] = {}
+            for term in self.expand_term(query_term):
+                for product_id, tf in self.postings[term].items():
+                    tf_by_product[product_id] = tf_by_product.get(product_id, 0.0) + tf
+            if not tf_by_product:
+                return {}, None
+            frequencies.append(tf_by_product)
+        if not frequencies:
+            return {}, None
+        
+        if snapshot is None:
+            doc_count = len(self.doc_terms)
+            snapshot = {"n": doc_count, "avg": self.total_length / doc_count or 1.0, "df": [len(f) for f in frequencies]}
+        elif len(snapshot.get("df", ())) != len(frequencies):
+            raise ValueError("snapshot does not match the query")
+        
+        matched = set(min(frequencies, key=len))
+        for tf_by_product in frequencies:
+            matched.intersection_update(tf_by_product)
+        
+        scores: Dict[str, float] = {}
+        for tf_by_product, df in zip(frequencies, snapshot["df"]):
+            idf = math.log(1 + (snapshot["n"] - df + 0.5) / (df + 0.5))
+            for product_id in matched:
+                tf = tf_by_product[product_id]
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[product_id] / snapshot["avg"])
+                scores[product_id] = scores.get(product_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores, snapshot
+    
+    async def rebuild(self, batch_size: int = 1000):
+        """Load every available product from Mongo in batches and swap the index in"""
+        fresh = ProductSearchIndex(self.k1, self.b)
+        cursor = db.products.find({"available": True}, PRODUCT_INDEX_PROJECTION).batch_size(batch_size)
+        async for product in cursor:
+            fresh.add(product)
+        
+        self.postings = fresh.postings
+        self.doc_terms = fresh.doc_terms
+        self.doc_lengths = fresh.doc_lengths
+        self.total_length = fresh.total_length
+        self.vocabulary = fresh.vocabulary
+        self._sorted_terms = None
+        self.ready = True
+    
+    def correct_query(self, query: str) -> Optional[str]:
+        """Typo-corrected query for a search with no hits ("galetas" -> "galleta")"""
+        return self.vocabulary.correct_query(query, is_known=lambda term: bool(self.expand_term(term)))
+    
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "documents": len(self.doc_terms),
+            "terms": len(self.postings),
+            "trigrams": len(self.vocabulary.trigrams)
+        }
+
+product_search_index = ProductSearchIndex()
+
+def index_product_change(product: dict, deleted: bool = False):
+    """Apply a product write in this worker and log it for the others"""
+    apply_product_change(product, deleted)
+    catalog_changes.record("product", product["product_id"], deleted)
+
+def apply_product_change(product: dict, deleted: bool = False):
+    """Propagate a product write to the in-memory search structures"""
+    search_result_cache.invalidate_product(product, deleted=deleted)
+    if deleted or not product.get("available", True):
+        product_search_index.remove(product["product_id"])
+        search_suggestions.remove_source(product["product_id"])
+        category_facets.remove(product["product_id"])
+    else:
+        product_search_index.add(product)
+        search_suggestions.set_product(product)
+        category_facets.add(product)
+
+async def delete_pulperia_products(pulperia_id: str):
+    """Delete all products of a pulperia and drop them from the search structures"""
+    products = await db.products.find({"pulperia_id": pulperia_id}, PRODUCT_INDEX_PROJECTION).to_list(None)
+    await db.products.delete_many({"pulperia_id": pulperia_id})
+    for product in products:
+        index_product_change(product, deleted=True)
+
+CATALOG_CHANGE_SYNC_SECONDS = int(os.environ.get('CATALOG_CHANGE_SYNC_SECONDS', '10'))
+# Re-read window covering writes logged late or by a worker with a skewed clock
+CATALOG_CHANGE_SYNC_OVERLAP = timedelta(seconds=int(os.environ.get('CATALOG_CHANGE_SYNC_OVERLAP_SECONDS', '60')))
+CATALOG_CHANGE_TTL_SECONDS = 86400
+
+class CatalogChangeFeed:
+    """Product and pulperia writes logged in db.catalog_changes for the other workers
+    
+    A worker applies its own writes directly. sync() pulls the changes
+    logged since the last sync (by any worker), re-reads those documents and
+    applies their current state, so applying a change twice is harmless.
+    """
+    
+    def __init__(self):
+        self.last_sync: Optional[datetime] = None
+        self.seen: Dict[Any, datetime] = {}  # change _id -> changed_at, within the overlap window
+    
+    def record(self, kind: str, doc_id: str, deleted: bool):
+        async def insert():
+            try:
+                await db.catalog_changes.insert_one({
+                    "kind": kind,
+                    "doc_id": doc_id,
+                    "deleted": deleted,
+                    "changed_at": datetime.now(timezone.utc)
+                })
+            except Exception as e:
+                logger.warning(f"[SEARCH] Could not log {kind} change {doc_id}: {e}")
+        
+        run_in_background(insert())
+    
+    async def sync(self, since: Optional[datetime] = None) -> int:
+        """Apply the changes logged since `since` (default: the last sync); returns how many documents changed"""
+        now = datetime.now(timezone.utc)
+        since = since or (self.last_sync - CATALOG_CHANGE_SYNC_OVERLAP if self.last_sync else now - CATALOG_CHANGE_SYNC_OVERLAP)
+        
+        changed: Dict[str, Set[str]] = {"product": set(), "pulperia": set()}
+        async for change in db.catalog_changes.find({"changed_at": {"$gte": since}}, {"kind": 1, "doc_id": 1, "changed_at": 1}):
+            if change["_id"] not in self.seen:
+                self.seen[change["_id"]] = to_utc_datetime(change["changed_at"])
+                changed[change["kind"]].add(change["doc_id"])
+        self.seen = {change_id: changed_at for change_id, changed_at in self.seen.items() if changed_at >= since}
+        
+        if changed["product"]:
+            products = {
+                product["product_id"]: product
+                async for product in db.products.find({"product_id": {"$in": list(changed["product"])}}, PRODUCT_INDEX_PROJECTION)
+            }
+            for product_id in changed["product"]:
+                apply_product_change(products.get(product_id, {"product_id": product_id}), deleted=product_id not in products)
+        if changed["pulperia"]:
+            pulperias = {
+                pulperia["pulperia_id"]: pulperia
+                async for pulperia in db.pulperias.find({"pulperia_id": {"$in": list(changed["pulperia"])}}, PUBLIC_PROJECTION)
+            }
+            for pulperia_id in changed["pulperia"]:
+                apply_pulperia_change(pulperias.get(pulperia_id, {"pulperia_id": pulperia_id}), deleted=pulperia_id not in pulperias)
+        
+        self.last_sync = now
+        return len(changed["product"]) + len(changed["pulperia"])
+
+catalog_changes = CatalogChangeFeed()
+
+async def rebuild_search_indexes():
+    """Load the product index, vocabularies, facets and suggestions from Mongo
+    
+    Each structure is built aside and swapped in; writes made while the scan
+    ran went to the old one, so they are replayed from the change log after
+    the swap.
+    """
+    started = datetime.now(timezone.utc)
+    await product_search_index.rebuild()
+    await pulperia_vocabulary.rebuild_from("pulperias", "pulperia_id", PULPERIA_VOCABULARY_FIELDS)
+    await category_facets.rebuild()
+    await search_suggestions.rebuild()
+    search_result_cache.clear()
+    catalog_changes.seen.clear()
+    await catalog_changes.sync(since=started - CATALOG_CHANGE_SYNC_OVERLAP)
+
+async def catalog_change_sync_loop():
+    """Background task applying other workers' catalog writes"""
+    while True:
+        await asyncio.sleep(CATALOG_CHANGE_SYNC_SECONDS)
+        try:
+            await catalog_changes.sync()
+        except Exception as e:
+            logger.warning(f"[SEARCH] Catalog change sync failed: {e}")
+
+# ============================================
+# CATALOG FACETS
+# ============================================
+
+class CategoryFacets:
+    """Category -> available product count, globally and per pulperia
+    
+    Maintained from product writes so facet reads never aggregate the
+    products collection. Products without a category count as "".
+    """
+    
+    def __init__(self):
+        self.products: Dict[str, tuple] = {}
+        self.totals: Dict[str, int] = {}
+        self.by_pulperia: Dict[str, Dict[str, int]] = {}
+        self.ready = False
+    
+    @staticmethod
+    def _bump(counts: Dict[str, int], category: str, delta: int):
+        count = counts.get(category, 0) + delta
+        if count > 0:
+            counts[category] = count
+        else:
+            counts.pop(category, None)
+    
+    def add(self, product: dict):
+        product_id = product["product_id"]
+        self.remove(product_id)
+        
+        pulperia_id, category = product["pulperia_id"], product.get("category") or ""
+        self.products[product_id] = (pulperia_id, category)
+        self._bump(self.totals, category, 1)
+        self._bump(self.by_pulperia.setdefault(pulperia_id, {}), category, 1)
+    
+    def remove(self, product_id: str):
+        entry = self.products.pop(product_id, None)
+        if entry is None:
+            return
+        
+        pulperia_id, category = entry
+        self._bump(self.totals, category, -1)
+        counts = self.by_pulperia.get(pulperia_id)
+        if counts is not None:
+            self._bump(counts, category, -1)
+            if not counts:
+                del self.by_pulperia[pulperia_id]
+    
+    @staticmethod
+    def as_list(counts: Dict[str, int]) -> List[dict]:
+        return [
+            {"category": category, "count": count}
+            for category, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        ]
+    
+    def get(self, pulperia_id: Optional[str] = None) -> List[dict]:
+        counts = self.by_pulperia.get(pulperia_id, {}) if pulperia_id else self.totals
+        return self.as_list(counts)
+    
+    def count_products(self, product_ids) -> List[dict]:
+        """Facets over a result set of product ids, from the in-memory map"""
+        counts: Dict[str, int] = {}
+        for product_id in product_ids:
+            entry = self.products.get(product_id)
+            if entry is not None:
+                counts[entry[1]] = counts.get(entry[1], 0) + 1
+        return self.as_list(counts)
+    
+    async def rebuild(self, batch_size: int = 1000):
+        fresh = CategoryFacets()
+        projection = {"_id": 0, "product_id": 1, "pulperia_id": 1, "category": 1}
+        async for product in db.products.find({"available": True}, projection).batch_size(batch_size):
+            fresh.add(product)
+        
+        self.products = fresh.products
+        self.totals = fresh.totals
+        self.by_pulperia = fresh.by_pulperia
+        self.ready = True
+    
+    def stats(self) -> dict:
+        return {"ready": self.ready, "products": len(self.products), "categories": len(self.totals)}
+
+category_facets = CategoryFacets()
+
+# ============================================
+# SEARCH SUGGESTIONS
+# ============================================
+
+class SuggestNode:
+    __slots__ = ("children", "phrases", "top", "dirty")
+    
+    def __init__(self):
+        self.children: Dict[str, "SuggestNode"] = {}
+        self.phrases: Set[tuple] = set()
+        self.top: List[tuple] = []
+        self.dirty = False
+
+class SearchSuggestTrie:
+    """Prefix trie of product names, categories and pulperia names for typeahead
+    
+    Every phrase is inserted from the start of each of its words, so "cola"
+    completes "Coca Cola". Each node keeps its best TOP_K phrases; writes
+    only mark the touched paths dirty and the lists are re-merged from the
+    children on the next lookup. A phrase weighs one point per product or
+    pulperia behind it plus their order counts.
+    """
+    
+    TOP_K = 10
+    MAX_DEPTH = 24
+    
+    def __init__(self):
+        self.root = SuggestNode()
+        self.phrases: Dict[tuple, dict] = {}
+        self.sources: Dict[str, List[tuple]] = {}
+        self.order_counts: Dict[str, int] = {}
+        self.ready = False
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(re.findall(r"[a-z0-9]+", normalize_text(text or "")))
+    
+    def _suffixes(self, key: str) -> List[str]:
+        starts = [0] + [i + 1 for i, char in enumerate(key) if char == " "]
+        return [key[start:start + self.MAX_DEPTH] for start in starts]
+    
+    def _mark(self, phrase_key: tuple, insert: Optional[bool] = None):
+        """Mark every path of a phrase dirty, attaching or detaching it at the path ends"""
+        for suffix in self._suffixes(phrase_key[1]):
+            node = self.root
+            node.dirty = True
+            for char in suffix:
+                child = node.children.get(char)
+                if child is None:
+                    if insert is not True:
+                        break
+                    child = node.children[char] = SuggestNode()
+                node = child
+                node.dirty = True
+            else:
+                if insert is True:
+                    node.phrases.add(phrase_key)
+                elif insert is False:
+                    node.phrases.discard(phrase_key)
+    
+    def _add_source(self, source_id: str, kind: str, text: str, weight: float):
+        key = self.normalize(text)
+        if not key:
+            return
+        
+        phrase_key = (kind, key)
+        phrase = self.phrases.get(phrase_key)
+        if phrase is None:
+            phrase = self.phrases[phrase_key] = {"text": text.strip(), "type": kind, "sources": {}, "weight": 0.0}
+            self._mark(phrase_key, insert=True)
+        else:
+            self._mark(phrase_key)
+        
+        phrase["weight"] += weight - phrase["sources"].get(source_id, 0.0)
+        phrase["sources"][source_id] = weight
+        self.sources.setdefault(source_id, []).append(phrase_key)
+    
+    def remove_source(self, source_id: str):
+        for phrase_key in self.sources.pop(source_id, []):
+            phrase = self.phrases.get(phrase_key)
+            if phrase is None:
+                continue
+            phrase["weight"] -= phrase["sources"].pop(source_id, 0.0)
+            if phrase["sources"]:
+                self._mark(phrase_key)
+            else:
+                del self.phrases[phrase_key]
+                self._mark(phrase_key, insert=False)
+    
+    def _weight(self, source_id: str) -> float:
+        return 1.0 + self.order_counts.get(source_id, 0)
+    
+    def set_product(self, product: dict):
+        product_id = product["product_id"]
+        self.remove_source(product_id)
+        weight = self._weight(product_id)
+        self._add_source(product_id, "product", product.get("name") or "", weight)
+        self._add_source(product_id, "category", product.get("category") or "", weight)
+    
+    def set_pulperia(self, pulperia: dict):
+        pulperia_id = pulperia["pulperia_id"]
+        self.remove_source(pulperia_id)
+        self._add_source(pulperia_id, "pulperia", pulperia.get("name") or "", self._weight(pulperia_id))
+    
+    def record_order(self, order: dict):
+        """Bump the popularity of the ordered products and their pulperia"""
+        source_ids = [order["pulperia_id"]] + [item["product_id"] for item in order.get("items", [])]
+        for source_id in dict.fromkeys(source_ids):
+            self.order_counts[source_id] = self.order_counts.get(source_id, 0) + 1
+            weight = self._weight(source_id)
+            for phrase_key in self.sources.get(source_id, []):
+                phrase = self.phrases[phrase_key]
+                phrase["weight"] += weight - phrase["sources"][source_id]
+                phrase["sources"][source_id] = weight
+                self._mark(phrase_key)
+    
+    def _rank(self, phrase_key: tuple) -> tuple:
+        return (self.phrases[phrase_key]["weight"], -len(phrase_key[1]), phrase_key[1])
+    
+    def _refresh(self, node: SuggestNode) -> List[tuple]:
+        if node.dirty:
+            candidates = set(node.phrases)
+            for child in node.children.values():
+                candidates.update(self._refresh(child))
+            node.top = heapq.nlargest(self.TOP_K, candidates, key=self._rank)
+            node.dirty = False
+        return node.top
+    
+    def suggest(self, query: str, limit: int = TOP_K) -> List[dict]:
+        prefix = self.normalize(query)
+        if not prefix:
+            return []
+        
+        node = self.root
+        for char in prefix[:self.MAX_DEPTH]:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        
+        top = self._refresh(node)
+        if len(prefix) > self.MAX_DEPTH:
+            top = [key for key in top if any(suffix.startswith(prefix) for suffix in self._word_suffixes(key[1]))]
+        
+        return [
+            {"text": self.phrases[key]["text"], "type": key[0]}
+            for key in top[:limit]
+        ]
+    
+    @staticmethod
+    def _word_suffixes(key: str) -> List[str]:
+        words = key.split(" ")
+        return [" ".join(words[i:]) for i in range(len(words))]
+    
+    async def rebuild(self, batch_size: int = 1000):
+        """Load products, pulperias and order counts from Mongo and swap the trie in"""
+        fresh = SearchSuggestTrie()
+        async for row in db.orders.aggregate([
+            {"$unwind": "$items"},
+            {"$group": {"_id": {"order": "$order_id", "product": "$items.product_id"}}},
+            {"$group": {"_id": "$_id.product", "orders": {"$sum": 1}}}
+        ]):
+            fresh.order_counts[row["_id"]] = row["orders"]
+        async for row in db.orders.aggregate([{"$group": {"_id": "$pulperia_id", "orders": {"$sum": 1}}}]):
+            fresh.order_counts[row["_id"]] = row["orders"]
+        
+        async for product in db.products.find({"available": True}, PRODUCT_INDEX_PROJECTION).batch_size(batch_size):
+            fresh.set_product(product)
+        async for pulperia in db.pulperias.find({}, {"_id": 0, "pulperia_id": 1, "name": 1}).batch_size(batch_size):
+            fresh.set_pulperia(pulperia)
+        fresh._refresh(fresh.root)
+        
+        self.root = fresh.root
+        self.phrases = fresh.phrases
+        self.sources = fresh.sources
+        self.order_counts = fresh.order_counts
+        self.ready = True
+    
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phrases": len(self.phrases),
+            "sources": len(self.sources)
+        }
+
+search_suggestions = SearchSuggestTrie()
+
+# ============================================
+# GEO HELPERS
+# ============================================
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance in kilometers"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def pulperia_coordinates(pulperia: dict) -> Optional[tuple]:
+    """(lat, lng) of a pulperia, or None when it has no usable location"""
+    location = pulperia.get("location") or {}
+    try:
+        lat, lng = float(location["lat"]), float(location["lng"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+def geo_fields(pulperia: dict) -> dict:
+    """GeoJSON copy of location for the 2dsphere index
+    
+    `location` keeps its {lat, lng} shape for clients; geo_location is
+    null when the pulperia has no usable coordinates.
+    """
+    coordinates = pulperia_coordinates(pulperia)
+    if coordinates is None:
+        return {"geo_location": None}
+    lat, lng = coordinates
+    return {"geo_location": {"type": "Point", "coordinates": [lng, lat]}}
+
+async def migrate_pulperia_locations(batch_size: int = 500) -> int:
+    """Write geo_location on pulperias created before it existed"""
+    migrated = 0
+    while True:
+        legacy_pulperias = await db.pulperias.find(
+            {"geo_location": {"$exists": False}},
+            {"_id": 1, "location": 1}
+        ).to_list(batch_size)
+        if not legacy_pulperias:
+            break
+        
+        operations = [UpdateOne({"_id": p["_id"]}, {"$set": geo_fields(p)}) for p in legacy_pulperias]
+        await db.pulperias.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+    
+    return migrated
+
+# ============================================
+# OPENING HOURS
+# ============================================
+
+# Free-form `hours` is parsed at write time into minute-of-week intervals (Monday 00:00 = 0)
+STORE_TIMEZONE = ZoneInfo(os.environ.get('STORE_TIMEZONE', 'America/Tegucigalpa'))
+WEEK_MINUTES = 7 * 24 * 60
+HOURS_PARSER_VERSION = 1
+
+HOURS_DAY_NAMES = {
+    "lunes": 0, "lun": 0, "lu": 0, "l": 0,
+    "martes": 1, "mar": 1, "ma": 1,
+    "miercoles": 2, "mie": 2, "mi": 2,
+    "jueves": 3, "jue": 3, "ju": 3, "j": 3,
+    "viernes": 4, "vie": 4, "vi": 4, "v": 4,
+    "sabado": 5, "sab": 5, "sa": 5, "s": 5,
+    "domingo": 6, "dom": 6, "do": 6, "d": 6
+}
+HOURS_PHRASES = [
+    (r"\b24\s*/\s*7\b|\b24\s*(?:horas|hrs|hr|h)\b", " 0:00-24:00 "),
+    (r"\btodos\s+los\s+dias\b|\btoda\s+la\s+semana\b|\bdiari[oa](?:mente)?\b", " lun-dom "),
+    (r"\bentre\s+semana\b", " lun-vie "),
+    (r"\bfin(?:es)?\s+de\s+semana\b", " sab-dom "),
+    (r"\b12\s*(?:md|m|mediodia)\b|\bmediodia\b", " 12:00pm "),
+    (r"\bmedianoche\b", " 12:00am "),
+    (r"(?<=[\d\s])([ap])\.?\s?m\b\.?", r"\1m ")
+]
+HOURS_TOKEN_PATTERN = re.compile(r"(\d{1,2})(?:[:.h](\d{2}))?\s*(am|pm)?|([a-z]+)|(-)")
+HOURS_RANGE_WORDS = {"-", "a", "al", "hasta", "to"}
+
+def hours_clock(hour: int, minute: int, marker: Optional[str]) -> int:
+    """Minutes after midnight for a 12h or 24h clock reading"""
+    if marker == "am":
+        hour = 0 if hour == 12 else hour
+    elif marker == "pm":
+        hour = hour if hour == 12 else hour + 12
+    return hour * 60 + minute
+
+def hours_range(start: tuple, end: tuple, after: int = 0) -> tuple:
+    """(open, close) minutes after midnight, close past 1440 for overnight ranges
+    
+    A missing am/pm is inferred from the other end ("9-5pm", "7am-9").
+    Bare ranges that would end before they start are read as afternoon
+    closings ("8 a 5" -> 8:00-17:00), and a bare range starting before
+    `after` (the previous range's close) is moved to the afternoon
+    ("8-12, 2-6").
+    """
+    (h1, m1, mk1), (h2, m2, mk2) = start, end
+    if mk2 and not mk1:
+        if mk2 == "pm":
+            mk1 = "am" if h1 > h2 or h2 == 12 else "pm"
+        else:
+            mk1 = "pm" if h1 > h2 and h2 != 12 else "am"
+    elif mk1 and not mk2:
+        if mk1 == "am":
+            mk2 = "pm" if h2 <= h1 or h2 == 12 else "am"
+        else:
+            mk2 = "pm" if h1 < h2 < 12 else "am"
+    
+    opens, closes = hours_clock(h1, m1, mk1), hours_clock(h2, m2, mk2)
+    if not mk1 and not mk2:
+        if opens < after and h1 < 12:
+            opens += 12 * 60
+        if closes <= opens and h2 < 12:
+            closes += 12 * 60
+    if closes == 0:
+        closes = 24 * 60
+    if closes <= opens:
+        closes += 24 * 60
+    return opens, closes
+
+def hours_tokens(hours: str) -> List[tuple]:
+    """("day", n) / ("time", (hour, minute, am|pm|None)) / ("to",) / ("closed",) tokens"""
+    text = normalize_text(hours).replace("–", "-").replace("—", "-")
+    for pattern, replacement in HOURS_PHRASES:
+        text = re.sub(pattern, replacement, text)
+    
+    tokens = []
+    for match in HOURS_TOKEN_PATTERN.finditer(text):
+        hour, minute, marker, word, dash = match.groups()
+        if hour is not None:
+            hour, minute = int(hour), int(minute or 0)
+            if hour <= 24 and minute < 60 and not (marker and not 1 <= hour <= 12):
+                tokens.append(("time", (hour, minute, marker)))
+        elif dash or word in HOURS_RANGE_WORDS:
+            tokens.append(("to",))
+        elif word in HOURS_DAY_NAMES or word.rstrip("s") in HOURS_DAY_NAMES:
+            tokens.append(("day", HOURS_DAY_NAMES.get(word, HOURS_DAY_NAMES.get(word.rstrip("s")))))
+        elif word.startswith("cerrad"):
+            tokens.append(("closed",))
+    return tokens
+
+def parse_hours(hours: Optional[str]) -> Optional[List[dict]]:
+    """Weekly schedule as sorted, merged [{"start", "end"}] minute-of-week intervals
+    
+    Understands the usual ways owners write their hours ("Lunes a Sábado
+    7:00 AM - 9:00 PM, Domingo cerrado", "L-V 6am-8pm y 2-6pm", "24 horas").
+    Ranges without days apply to every day; later day groups override
+    earlier ones. Returns None when nothing could be read, [] when the
+    text only says closed.
+    """
+    if not hours:
+        return None
+    tokens = hours_tokens(hours)
+    
+    # Group day sets with the time ranges that follow them
+    groups = []
+    days, ranges, closed = None, [], False
+    i = 0
+    while i < len(tokens):
+        kind = tokens[i][0]
+        is_range = i + 2 < len(tokens) and tokens[i + 1][0] == "to" and tokens[i + 2][0] == kind
+        if kind == "day":
+            if ranges or closed:
+                groups.append((days, ranges, closed))
+                days, ranges, closed = None, [], False
+            first = tokens[i][1]
+            last = tokens[i + 2][1] if is_range else first
+            days = (days or []) + [(first + offset) % 7 for offset in range((last - first) % 7 + 1)]
+        elif kind == "time" and is_range:
+            ranges.append(hours_range(tokens[i][1], tokens[i + 2][1], ranges[-1][1] if ranges else 0))
+        elif kind == "closed":
+            closed = True
+        i += 3 if is_range and kind in ("day", "time") else 1
+    groups.append((days, ranges, closed))
+    
+    # "8-12, 2-6 lunes a viernes": days written after their ranges
+    merged = []
+    for days, ranges, closed in groups:
+        if merged and days and not ranges and not closed and merged[-1][0] is None and merged[-1][1]:
+            merged[-1] = (days, merged[-1][1], False)
+        else:
+            merged.append((days, ranges, closed))
+    
+    week: Dict[int, list] = {}
+    for days, ranges, closed in merged:
+        if not ranges and not closed:
+            continue
+        for day in (days if days is not None else range(7)):
+            week[day] = [] if closed else ranges
+    if not week:
+        return None
+    
+    intervals = []
+    for day, ranges in week.items():
+        for opens, closes in ranges:
+            start, end = day * 1440 + opens, day * 1440 + closes
+            if end > WEEK_MINUTES:
+                intervals.append((0, end - WEEK_MINUTES))
+                end = WEEK_MINUTES
+            intervals.append((start, end))
+    
+    schedule = []
+    for start, end in sorted(intervals):
+        if schedule and start <= schedule[-1]["end"]:
+            schedule[-1]["end"] = max(schedule[-1]["end"], end)
+        else:
+            schedule.append({"start": start, "end": end})
+    return schedule
+
+def hours_fields(pulperia: dict) -> dict:
+    """Parsed schedule stored next to the free-form hours for the open_now index"""
+    return {"hours_schedule": parse_hours(pulperia.get("hours")), "hours_schedule_version": HOURS_PARSER_VERSION}
+
+def pulperia_schedule(pulperia: dict) -> Optional[List[dict]]:
+    """Stored schedule, or a fresh parse for documents not yet backfilled"""
+    if pulperia.get("hours_schedule_version") == HOURS_PARSER_VERSION:
+        return pulperia.get("hours_schedule")
+    return parse_hours(pulperia.get("hours"))
+
+def week_minute(now: Optional[datetime] = None) -> int:
+    """Current minute of the week in the stores' timezone"""
+    local = (now or datetime.now(timezone.utc)).astimezone(STORE_TIMEZONE)
+    return local.weekday() * 1440 + local.hour * 60 + local.minute
+
+def is_open_at(schedule: Optional[List[dict]], minute: int) -> bool:
+    return any(interval["start"] <= minute < interval["end"] for interval in schedule or [])
+
+def open_now_query(minute: int) -> dict:
+    """Pulperias whose schedule has an interval covering `minute`; unknown hours never match"""
+    return {"hours_schedule": {"$elemMatch": {"start": {"$lte": minute}, "end": {"$gt": minute}}}}
+
+async def migrate_pulperia_hours(batch_size: int = 500) -> int:
+    """Parse hours on pulperias written before the current parser version"""
+    migrated = 0
+    while True:
+        legacy_pulperias = await db.pulperias.find(
+            {"hours_schedule_version": {"$ne": HOURS_PARSER_VERSION}},
+            {"_id": 1, "hours": 1}
+        ).to_list(batch_size)
+        if not legacy_pulperias:
+            break
+        
+        operations = [UpdateOne({"_id": p["_id"]}, {"$set": hours_fields(p)}) for p in legacy_pulperias]
+        await db.pulperias.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+    
+    return migrated
+
+# ============================================
+# MAP GRID INDEX
+# ============================================
+
+MAP_GRID_CELL_DEGREES = float(os.environ.get('MAP_GRID_CELL_DEGREES', '0.05'))
+MAP_BOUNDS_MAX_RESULTS = 2000
+LOGO_THUMBNAIL_SIZE = 64
+
+def logo_thumbnail_url(pulperia: dict) -> Optional[str]:
+    """Small logo URL for map payloads
+    
+    Uploaded logos are stored inline as data URLs, far too heavy for a
+    marker list, so those point to the thumbnail endpoint instead. The
+    version parameter changes with the logo so browsers can cache forever.
+    """
+    logo_url = pulperia.get("logo_url")
+    if not logo_url:
+        return None
+    if not logo_url.startswith("data:"):
+        return logo_url
+    version = hashlib.sha1(logo_url.encode()).hexdigest()[:10]
+    return f"/api/pulperias/{pulperia['pulperia_id']}/logo-thumb?v={version}"
+
+def map_marker(pulperia: dict, coordinates: tuple) -> dict:
+    """Compact pulperia payload for map views"""
+    return {
+        "id": pulperia["pulperia_id"],
+        "name": pulperia.get("name"),
+        "lat": coordinates[0],
+        "lng": coordinates[1],
+        "rating": pulperia.get("rating") or 0.0,
+        "logo": logo_thumbnail_url(pulperia)
+    }
+
+class PulperiaGridIndex:
+    """Uniform lat/lng grid of non-suspended pulperias for viewport queries
+    
+    Each cell maps pulperia_id -> compact marker and keeps a running
+    count and coordinate sum, so zoomed-out map tiles can cluster whole
+    cells without touching every marker.
+    """
+    
+    MAP_PROJECTION = {"_id": 0, "pulperia_id": 1, "name": 1, "location": 1, "rating": 1, "logo_url": 1, "is_suspended": 1, "hours": 1, "hours_schedule": 1, "hours_schedule_version": 1}
+    
+    def __init__(self, cell_degrees: float = MAP_GRID_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.cells: Dict[tuple, Dict[str, dict]] = {}
+        self.cell_sums: Dict[tuple, List[float]] = {}
+        self.pulperia_cells: Dict[str, tuple] = {}
+        self.schedules: Dict[str, Optional[List[dict]]] = {}
+        self.ready = False
+    
+    def __len__(self) -> int:
+        return len(self.pulperia_cells)
+    
+    def cell_of(self, lat: float, lng: float) -> tuple:
+        return (math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees))
+    
+    def upsert(self, pulperia: dict):
+        pulperia_id = pulperia["pulperia_id"]
+        self.remove(pulperia_id)
+        if pulperia.get("is_suspended"):
+            return
+        
+        coordinates = pulperia_coordinates(pulperia)
+        if coordinates is None:
+            return
+        
+        cell = self.cell_of(*coordinates)
+        self.cells.setdefault(cell, {})[pulperia_id] = map_marker(pulperia, coordinates)
+        self.pulperia_cells[pulperia_id] = cell
+        self.schedules[pulperia_id] = pulperia_schedule(pulperia)
+        sums = self.cell_sums.setdefault(cell, [0, 0.0, 0.0])
+        sums[0] += 1
+        sums[1] += coordinates[0]
+        sums[2] += coordinates[1]
+    
+    def remove(self, pulperia_id: str):
+        cell = self.pulperia_cells.pop(pulperia_id, None)
+        if cell is None:
+            return
+        
+        self.schedules.pop(pulperia_id, None)
+        markers = self.cells.get(cell)
+        if markers is not None:
+            marker = markers.pop(pulperia_id, None)
+            if marker is not None:
+                sums = self.cell_sums[cell]
+                sums[0] -= 1
+                sums[1] -= marker["lat"]
+                sums[2] -= marker["lng"]
+            if not markers:
+                del self.cells[cell]
+                del self.cell_sums[cell]
+    
+    def get(self, pulperia_id: str) -> Optional[dict]:
+        cell = self.pulperia_cells.get(pulperia_id)
+        return self.cells[cell][pulperia_id] if cell is not None else None
+    
+    def set_rating(self, pulperia_id: str, rating: float):
+        marker = self.get(pulperia_id)
+        if marker is not None:
+            marker["rating"] = rating
+    
+    def is_open(self, pulperia_id: str, minute: Optional[int]) -> bool:
+        """True when no minute is given or the pulperia's schedule covers it"""
+        return minute is None or is_open_at(self.schedules.get(pulperia_id), minute)
+    
+    def query(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float, limit: int = MAP_BOUNDS_MAX_RESULTS, open_at: Optional[int] = None) -> tuple:
+        """Markers inside the box, returning (markers, truncated); open_at keeps only pulperias open at that minute of the week"""
+        results = []
+        for cell in self.cells_in(min_lat, min_lng, max_lat, max_lng):
+            for marker in self.cells[cell].values():
+                if min_lat <= marker["lat"] <= max_lat and min_lng <= marker["lng"] <= max_lng and self.is_open(marker["id"], open_at):
+                    if len(results) >= limit:
+                        return results, True
+                    results.append(marker)
+        return results, False
+    
+    def within_radius(self, lat: float, lng: float, radius_km: float) -> Dict[str, float]:
+        """pulperia_id -> distance in km for every marker within radius_km of the point"""
+        d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        d_lng = d_lat / max(math.cos(math.radians(lat)), 0.01)
+        distances = {}
+        for cell in self.cells_in(lat - d_lat, lng - d_lng, lat + d_lat, lng + d_lng):
+            for pulperia_id, marker in self.cells[cell].items():
+                distance = haversine_km(lat, lng, marker["lat"], marker["lng"])
+                if distance <= radius_km:
+                    distances[pulperia_id] = distance
+        return distances
+    
+    def cells_in(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> List[tuple]:
+        """Occupied cells overlapping the box
+        
+        Visits the overlapped cells, or only the occupied cells when those
+        are fewer (zoomed far out).
+        """
+        low_row, low_col = self.cell_of(min_lat, min_lng)
+        high_row, high_col = self.cell_of(max_lat, max_lng)
+        
+        if (high_row - low_row + 1) * (high_col - low_col + 1) <= len(self.cells):
+            return [
+                (row, col)
+                for row in range(low_row, high_row + 1)
+                for col in range(low_col, high_col + 1)
+                if (row, col) in self.cells
+            ]
+        return [
+            (row, col) for row, col in self.cells
+            if low_row <= row <= high_row and low_col <= col <= high_col
+        ]
+    
+    async def rebuild(self, batch_size: int = 500):
+        fresh = PulperiaGridIndex(self.cell_degrees)
+        async for pulperia in db.pulperias.find({"is_suspended": {"$ne": True}}, self.MAP_PROJECTION).batch_size(batch_size):
+            fresh.upsert(pulperia)
+        
+        self.cells = fresh.cells
+        self.cell_sums = fresh.cell_sums
+        self.pulperia_cells = fresh.pulperia_cells
+        self.schedules = fresh.schedules
+        self.ready = True
+    
+    def stats(self) -> dict:
+        return {"ready": self.ready, "pulperias": len(self.pulperia_cells), "cells": len(self.cells)}
+
+pulperia_grid = PulperiaGridIndex()
+
+def parse_bbox(bbox: str) -> tuple:
+    """'minLng,minLat,maxLng,maxLat' -> (min_lat, min_lng, max_lat, max_lng)"""
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox inválido, use minLng,minLat,maxLng,maxLat")
+    if min_lat > max_lat or min_lng > max_lng:
+        raise HTTPException(status_code=400, detail="bbox inválido, use minLng,minLat,maxLng,maxLat")
+    return min_lat, min_lng, max_lat, max_lng
+
+def make_logo_thumbnail(data_url: str) -> bytes:
+    """Decode an inline logo and shrink it to a small WebP"""
+    encoded = data_url.split(",", 1)[1]
+    image = Image.open(io.BytesIO(base64.b64decode(encoded)))
+    image.thumbnail((LOGO_THUMBNAIL_SIZE, LOGO_THUMBNAIL_SIZE))
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    output = io.BytesIO()
+    image.save(output, format="WEBP", quality=80)
+    return output.getvalue()
+
+logo_thumbnails: "OrderedDict[str, bytes]" = OrderedDict()
+LOGO_THUMBNAIL_CACHE_ENTRIES = 2000
+
+# ============================================
+# MAP TILES
+# ============================================
+
+MAP_MAX_ZOOM = 20
+MAP_CLUSTER_MAX_ZOOM = 14
+MAP_CLUSTER_CELL_PX = 64
+MAP_TILE_SIZE_PX = 256
+MAP_TILE_CACHE_MAX_ENTRIES = int(os.environ.get('MAP_TILE_CACHE_MAX_ENTRIES', '20000'))
+
+def lat_lng_to_pixel(lat: float, lng: float, zoom: int) -> tuple:
+    """Global Web Mercator pixel coordinates at a zoom level"""
+    scale = MAP_TILE_SIZE_PX * (2 ** zoom)
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    sin_lat = math.sin(math.radians(lat))
+    x = (lng + 180.0) / 360.0 * scale
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+def tile_bounds(zoom: int, x: int, y: int) -> tuple:
+    """(min_lat, min_lng, max_lat, max_lng) of an XYZ tile"""
+    tiles = 2 ** zoom
+    
+    def tile_lat(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / tiles))))
+    
+    return tile_lat(y + 1), x / tiles * 360.0 - 180.0, tile_lat(y), (x + 1) / tiles * 360.0 - 180.0
+
+def cluster_groups(groups: Dict[tuple, list]) -> tuple:
+    """Turn screen-cell groups of (count, lat_sum, lng_sum, marker) into (clusters, single markers)"""
+    clusters, singles = [], []
+    for members in groups.values():
+        count = sum(member[0] for member in members)
+        if count == 1:
+            singles.append(members[0][3])
+            continue
+        clusters.append({
+            "lat": round(sum(member[1] for member in members) / count, 6),
+            "lng": round(sum(member[2] for member in members) / count, 6),
+            "count": count
+        })
+    return clusters, singles
+
+def clusters_grid_cells(zoom: int) -> bool:
+    """Whether tiles at this zoom draw whole grid cells at their centroid"""
+    cluster_cell_degrees = 360.0 / (2 ** zoom) * MAP_CLUSTER_CELL_PX / MAP_TILE_SIZE_PX
+    return cluster_cell_degrees >= 4 * pulperia_grid.cell_degrees
+
+def build_map_tile(zoom: int, x: int, y: int, open_at: Optional[int] = None) -> dict:
+    """Clusters and markers of one tile, read from the in-memory grid
+    
+    While a screen cluster cell spans several grid cells, whole grid cells
+    are clustered by their centroid; closer in, markers are grouped one by
+    one. Beyond MAP_CLUSTER_MAX_ZOOM every marker is returned as is.
+    open_at keeps only pulperias open at that minute of the week, which
+    rules out the per-cell sums.
+    """
+    min_lat, min_lng, max_lat, max_lng = tile_bounds(zoom, x, y)
+    by_cell = open_at is None and clusters_grid_cells(zoom)
+    
+    groups: Dict[tuple, list] = {}
+    for cell in pulperia_grid.cells_in(min_lat, min_lng, max_lat, max_lng):
+        if by_cell:
+            count, lat_sum, lng_sum = pulperia_grid.cell_sums[cell]
+            members = [(count, lat_sum, lng_sum, next(iter(pulperia_grid.cells[cell].values())))]
+            anchor = (lat_sum / count, lng_sum / count)
+        else:
+            members = [
+                (1, m["lat"], m["lng"], m) for m in pulperia_grid.cells[cell].values()
+                if pulperia_grid.is_open(m["id"], open_at)
+            ]
+            anchor = None
+        
+        for member in members:
+            px, py = lat_lng_to_pixel(*(anchor or (member[1], member[2])), zoom)
+            # Boxes are inclusive, so a point on a shared edge belongs to one tile only
+            if (int(px // MAP_TILE_SIZE_PX), int(py // MAP_TILE_SIZE_PX)) != (x, y):
+                continue
+            if zoom <= MAP_CLUSTER_MAX_ZOOM:
+                key = (int(px // MAP_CLUSTER_CELL_PX), int(py // MAP_CLUSTER_CELL_PX))
+            else:
+                key = member[3]["id"]
+            groups.setdefault(key, []).append(member)
+    
+    clusters, singles = cluster_groups(groups)
+    count = sum(cluster["count"] for cluster in clusters) + len(singles)
+    return {"z": zoom, "x": x, "y": y, "count": count, "clusters": clusters, "pulperias": singles}
+
+class MapTileCache:
+    """LRU cache of clustered tiles keyed by (z, x, y)
+    
+    A pulperia change drops the tile holding its old and new position at
+    every zoom level. Where whole grid cells are drawn at their centroid,
+    which moves with every member and can sit in a neighbouring tile,
+    every tile overlapping the marker's grid cell goes instead.
+    """
+    
+    def __init__(self, max_entries: int = MAP_TILE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.scope = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def get(self, key: tuple) -> Optional[dict]:
+        tile = self.entries.get(key)
+        if tile is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return tile
+    
+    def set(self, key: tuple, tile: dict):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = tile
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def invalidate_marker(self, marker: Optional[dict]):
+        if marker is None:
+            return
+        row, col = pulperia_grid.cell_of(marker["lat"], marker["lng"])
+        degrees = pulperia_grid.cell_degrees
+        for zoom in range(MAP_MAX_ZOOM + 1):
+            if clusters_grid_cells(zoom):
+                corners = [lat_lng_to_pixel(row * degrees, col * degrees, zoom), lat_lng_to_pixel((row + 1) * degrees, (col + 1) * degrees, zoom)]
+            else:
+                corners = [lat_lng_to_pixel(marker["lat"], marker["lng"], zoom)]
+            tiles_x = [int(px // MAP_TILE_SIZE_PX) for px, _ in corners]
+            tiles_y = [int(py // MAP_TILE_SIZE_PX) for _, py in corners]
+            for tile_x in range(min(tiles_x), max(tiles_x) + 1):
+                for tile_y in range(min(tiles_y), max(tiles_y) + 1):
+                    if self.entries.pop((zoom, tile_x, tile_y), None) is not None:
+                        self.invalidations += 1
+    
+    def use_scope(self, scope):
+        """Drop every tile once tiles are requested for another scope (open_now: another minute)"""
+        if scope != self.scope:
+            self.entries.clear()
+            self.scope = scope
+    
+    def clear(self):
+        self.entries.clear()
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+map_tile_cache = MapTileCache()
+open_map_tile_cache = MapTileCache()
+
+# ============================================
+# REVIEW AGGREGATES
+# ============================================
+
+# Per-pulperia rating counters kept on the pulperia document and updated with $inc
+RATING_STARS = range(1, 6)
+
+def empty_rating_histogram() -> Dict[str, int]:
+    return {str(star): 0 for star in RATING_STARS}
+
+def rating_histogram(pulperia: dict) -> Dict[str, int]:
+    """1-5 star counts of a pulperia, zero-filled for stars nobody gave yet"""
+    histogram = empty_rating_histogram()
+    for star, count in (pulperia.get("rating_histogram") or {}).items():
+        if star in histogram:
+            histogram[star] = count
+    return histogram
+
+def average_rating(rating_sum: float, review_count: int) -> float:
+    return round(rating_sum / review_count, 1) if review_count else 0.0
+
+async def apply_review_rating(pulperia_id: str, rating: int) -> Optional[dict]:
+    """Count a new review in the pulperia's counters and return them with the new average
+    
+    The counters move with one atomic $inc. The derived average is then
+    written only if no other review landed in between; when one did, that
+    review's own write carries the newer counters.
+    """
+    counters = await db.pulperias.find_one_and_update(
+        {"pulperia_id": pulperia_id},
+        {"$inc": {"rating_sum": rating, "review_count": 1, f"rating_histogram.{rating}": 1}},
+        projection={"_id": 0, "rating_sum": 1, "review_count": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if counters is None:
+        return None
+    
+    counters["rating"] = average_rating(counters["rating_sum"], counters["review_count"])
+    await db.pulperias.update_one(
+        {"pulperia_id": pulperia_id, "rating_sum": counters["rating_sum"], "review_count": counters["review_count"]},
+        {"$set": {"rating": counters["rating"]}}
+    )
+    return counters
+
+async def rebuild_review_counters(pulperia_ids: Optional[List[str]] = None, batch_size: int = 500) -> int:
+    """Recompute rating_sum, review_count, histogram and rating from db.reviews
+    
+    One grouped aggregation over the reviews, then unordered bulk writes of
+    the counters for every pulperia (or only `pulperia_ids`), including
+    the ones left without reviews.
+    """
+    match = {"pulperia_id": {"$in": pulperia_ids}} if pulperia_ids is not None else {}
+    grouped = db.reviews.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"pulperia_id": "$pulperia_id", "rating": "$rating"}, "count": {"$sum": 1}}}
+    ])
+    
+    histograms: Dict[str, Dict[str, int]] = {}
+    async for row in grouped:
+        star = row["_id"]["rating"]
+        if star not in RATING_STARS:
+            continue
+        histogram = histograms.setdefault(row["_id"]["pulperia_id"], empty_rating_histogram())
+        histogram[str(star)] += row["count"]
+    
+    updated = 0
+    operations = []
+    async for pulperia in db.pulperias.find(match, {"_id": 0, "pulperia_id": 1}).batch_size(batch_size):
+        histogram = histograms.get(pulperia["pulperia_id"], empty_rating_histogram())
+        review_count = sum(histogram.values())
+        rating_sum = sum(int(star) * count for star, count in histogram.items())
+        operations.append(UpdateOne({"pulperia_id": pulperia["pulperia_id"]}, {"$set": {
+            "rating_sum": rating_sum,
+            "review_count": review_count,
+            "rating_histogram": histogram,
+            "rating": average_rating(rating_sum, review_count)
+        }}))
+        pulperia_grid.set_rating(pulperia["pulperia_id"], average_rating(rating_sum, review_count))
+        leaderboards.set_rating(pulperia["pulperia_id"], rating_sum, review_count)
+        
+        if len(operations) >= batch_size:
+            await db.pulperias.bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+    
+    if operations:
+        await db.pulperias.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    
+    if pulperia_ids is None:
+        map_tile_cache.clear()
+        open_map_tile_cache.clear()
+    else:
+        for pulperia_id in pulperia_ids:
+            map_tile_cache.invalidate_marker(pulperia_grid.get(pulperia_id))
+            open_map_tile_cache.invalidate_marker(pulperia_grid.get(pulperia_id))
+    return updated
+
+# ============================================
+# UPSTREAM HTTP CLIENT
+# ============================================
+
+# Shared connection pool for Google OAuth and Emergent Auth calls
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_MAX_CONNECTIONS', '100'))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get('UPSTREAM_MAX_KEEPALIVE', '20'))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get('UPSTREAM_KEEPALIVE_EXPIRY_SECONDS', '60'))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', '50'))
+
+DEFAULT_UPSTREAM_TIMEOUT = httpx.Timeout(15.0, connect=5.0)
+UPSTREAM_TIMEOUTS = {
+    "oauth2.googleapis.com": httpx.Timeout(10.0, connect=3.0),
+    "www.googleapis.com": httpx.Timeout(10.0, connect=3.0),
+    httpx.URL(EMERGENT_AUTH_URL).host: httpx.Timeout(15.0, connect=5.0)
+}
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram per upstream host (or any other label)"""
+    
+    BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+    
+    def __init__(self, buckets_ms: Optional[List[float]] = None):
+        self.hosts: Dict[str, dict] = {}
+        if buckets_ms:
+            self.BUCKETS_MS = buckets_ms
+    
+    def record(self, host: str, seconds: float, error: bool = False):
+        stats = self.hosts.get(host)
+        if stats is None:
+            stats = {"counts": [0] * (len(self.BUCKETS_MS) + 1), "count": 0, "errors": 0, "total_ms": 0.0}
+            self.hosts[host] = stats
+        
+        elapsed_ms = seconds * 1000
+        bucket = next((i for i, bound in enumerate(self.BUCKETS_MS) if elapsed_ms <= bound), len(self.BUCKETS_MS))
+        stats["counts"][bucket] += 1
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        if error:
+            stats["errors"] += 1
+    
+    def percentile(self, host: str, fraction: float) -> Optional[float]:
+        """Upper bucket bound (ms) containing the given fraction of calls"""
+        stats = self.hosts.get(host)
+        if not stats or not stats["count"]:
+            return None
+        
+        threshold = fraction * stats["count"]
+        seen = 0
+        for i, count in enumerate(stats["counts"]):
+            seen += count
+            if seen >= threshold:
+                return self.BUCKETS_MS[i] if i < len(self.BUCKETS_MS) else float("inf")
+        return float("inf")
+    
+    def snapshot(self) -> dict:
+        labels = [f"<={bound}ms" for bound in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        return {
+            host: {
+                "count": stats["count"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total_ms"] / stats["count"], 1) if stats["count"] else 0.0,
+                "p50_ms": self.percentile(host, 0.5),
+                "p95_ms": self.percentile(host, 0.95),
+                "p99_ms": self.percentile(host, 0.99),
+                "buckets": dict(zip(labels, stats["counts"]))
+            }
+            for host, stats in self.hosts.items()
+        }
+
+class UpstreamClient:
+    """Application-lifetime httpx client with pooling, keep-alive and bounded concurrency"""
+    
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.semaphore = asyncio.Semaphore(UPSTREAM_MAX_CONCURRENCY)
+        self.latency = LatencyHistogram()
+    
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=UPSTREAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                    keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+                ),
+                timeout=DEFAULT_UPSTREAM_TIMEOUT
+            )
+    
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        if self.client is None:
+            await self.start()
+        
+        host = httpx.URL(url).host
+        kwargs.setdefault("timeout", UPSTREAM_TIMEOUTS.get(host, DEFAULT_UPSTREAM_TIMEOUT))
+        
+        async with self.semaphore:
+            started = time.perf_counter()
+            error = True
+            try:
+                response = await self.client.request(method, url, **kwargs)
+                error = response.is_error
+                return response
+            finally:
+                self.latency.record(host, time.perf_counter() - started, error)
+    
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+    
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+    
+    def stats(self) -> dict:
+        return {
+            "max_connections": UPSTREAM_MAX_CONNECTIONS,
+            "max_keepalive_connections": UPSTREAM_MAX_KEEPALIVE,
+            "max_concurrency": UPSTREAM_MAX_CONCURRENCY,
+            "latency": self.latency.snapshot()
+        }
+
+upstream = UpstreamClient()
+
+# ============================================
+# GOOGLE ID TOKEN VERIFICATION
+# ============================================
+
+GOOGLE_JWKS_URL = os.environ.get('GOOGLE_JWKS_URL', 'https://www.googleapis.com/oauth2/v3/certs')
+GOOGLE_JWKS_REFRESH_SECONDS = int(os.environ.get('GOOGLE_JWKS_REFRESH_SECONDS', '3600'))
+GOOGLE_ISSUERS = ["https://accounts.google.com", "accounts.google.com"]
+
+class GoogleKeySetError(Exception):
+    """The JWKS endpoint answered with something that is not a usable key set"""
+
+class GoogleKeySet:
+    """Cached Google JWKS used to verify ID tokens locally
+    
+    Keys are refreshed in the background and on demand when a token
+    references an unknown key id (at most once per minute). `load` accepts
+    any JWKS dict, so tests can install a local stand-in key set.
+    """
+    
+    MIN_FORCED_REFRESH_SECONDS = 60
+    
+    def __init__(self, jwks_url: str = GOOGLE_JWKS_URL):
+        self.jwks_url = jwks_url
+        self.keys: Dict[str, object] = {}
+        self.refresh_seconds = GOOGLE_JWKS_REFRESH_SECONDS
+        self.fetched_at: Optional[float] = None
+        self.lock = asyncio.Lock()
+    
+    def load(self, jwks: dict, max_age: Optional[int] = None):
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("kty") == "RSA" and jwk.get("kid"):
+                keys[jwk["kid"]] = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+        self.keys = keys
+        self.fetched_at = time.monotonic()
+        if max_age:
+            self.refresh_seconds = max_age
+    
+    def is_stale(self) -> bool:
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.refresh_seconds
+    
+    async def refresh(self, force: bool = False):
+        async with self.lock:
+            if not force and not self.is_stale():
+                return
+            if force and self.fetched_at and time.monotonic() - self.fetched_at < self.MIN_FORCED_REFRESH_SECONDS:
+                return
+            
+            response = await upstream.get(self.jwks_url)
+            response.raise_for_status()
+            
+            max_age = None
+            match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+            if match:
+                max_age = int(match.group(1))
+            try:
+                self.load(response.json(), max_age)
+            except (ValueError, KeyError, TypeError, AttributeError, jwt.PyJWTError) as e:
+                # Malformed body: keep the current keys and let callers fall back
+                raise GoogleKeySetError(f"Malformed JWKS from {self.jwks_url}: {e}") from e
+    
+    async def get_key(self, kid: Optional[str]):
+        if self.is_stale():
+            await self.refresh()
+        if kid not in self.keys:
+            await self.refresh(force=True)
+        return self.keys.get(kid)
+    
+    async def verify_id_token(self, id_token: str, audience: str) -> dict:
+        """Verify signature, audience, issuer and expiry of a Google ID token"""
+        header = jwt.get_unverified_header(id_token)
+        key = await self.get_key(header.get("kid"))
+        if key is None:
+            raise jwt.InvalidTokenError("Unknown signing key")
+        
+        return jwt.decode(
+            id_token,
+            key,
+            algorithms=["RS256"],
+            audience=audience,
+            issuer=GOOGLE_ISSUERS
+        )
+
+google_keys = GoogleKeySet()
+
+async def google_jwks_refresh_loop():
+    """Background task keeping the Google key set fresh"""
+    while True:
+        try:
+            await google_keys.refresh()
+        except Exception as e:
+            logger.warning(f"[AUTH] Google JWKS refresh failed: {e}")
+        await asyncio.sleep(google_keys.refresh_seconds)
 
 # ============================================
 # AUTHENTICATION ENDPOINTS
@@ -536,44 +2801,55 @@ async def google_oauth_callback(code: str, redirect_uri: str, response: Response
     
     logger.info("[AUTH] Processing Google OAuth callback")
     
-    async with httpx.AsyncClient() as http_client:
-        try:
-            # Exchange code for tokens
-            token_response = await http_client.post(
-                "https://oauth2.googleapis.com/token",
-                data={
-                    "client_id": GOOGLE_CLIENT_ID,
-                    "client_secret": GOOGLE_CLIENT_SECRET,
-                    "code": code,
-                    "redirect_uri": redirect_uri,
-                    "grant_type": "authorization_code"
-                },
-                timeout=15
-            )
-            token_response.raise_for_status()
-            tokens = token_response.json()
-            
-            # Get user info
-            userinfo_response = await http_client.get(
+    try:
+        # Exchange code for tokens
+        token_response = await upstream.post(
+            "https://oauth2.googleapis.com/token",
+            data={
+                "client_id": GOOGLE_CLIENT_ID,
+                "client_secret": GOOGLE_CLIENT_SECRET,
+                "code": code,
+                "redirect_uri": redirect_uri,
+                "grant_type": "authorization_code"
+            }
+        )
+        token_response.raise_for_status()
+        tokens = token_response.json()
+        
+        # Verify the ID token locally; avoids a second round trip to Google
+        user_info = None
+        if tokens.get("id_token"):
+            try:
+                claims = await google_keys.verify_id_token(tokens["id_token"], GOOGLE_CLIENT_ID)
+                if claims.get("email") and claims.get("email_verified", False):
+                    user_info = {
+                        "email": claims["email"],
+                        "name": claims.get("name", ""),
+                        "picture": claims.get("picture", "")
+                    }
+            except (jwt.InvalidTokenError, httpx.HTTPError, GoogleKeySetError) as e:
+                logger.warning(f"[AUTH] Local ID token verification failed, using userinfo: {e}")
+        
+        if user_info is None:
+            # Fallback: get user info from Google
+            userinfo_response = await upstream.get(
                 "https://www.googleapis.com/oauth2/v2/userinfo",
-                headers={"Authorization": f"Bearer {tokens['access_token']}"},
-                timeout=15
+                headers={"Authorization": f"Bearer {tokens['access_token']}"}
             )
             userinfo_response.raise_for_status()
             user_info = userinfo_response.json()
-            
-            logger.info(f"[AUTH] Google OAuth successful for: {user_info.get('email')}")
-            
-        except httpx.HTTPStatusError as e:
-            logger.error(f"[AUTH] Google OAuth failed: {e.response.status_code} - {e.response.text}")
-            raise HTTPException(status_code=401, detail="Autenticación con Google fallida")
-        except Exception as e:
-            logger.error(f"[AUTH] Google OAuth error: {str(e)}")
-            raise HTTPException(status_code=502, detail="Error del servicio de autenticación")
+        
+        logger.info(f"[AUTH] Google OAuth successful for: {user_info.get('email')}")
+        
+    except httpx.HTTPStatusError as e:
+        logger.error(f"[AUTH] Google OAuth failed: {e.response.status_code} - {e.response.text}")
+        raise HTTPException(status_code=401, detail="Autenticación con Google fallida")
+    except Exception as e:
+        logger.error(f"[AUTH] Google OAuth error: {str(e)}")
+        raise HTTPException(status_code=502, detail="Error del servicio de autenticación")
     
     # Create or update user
     user_id = f"user_{uuid.uuid4().hex[:12]}"
-    session_token = f"sess_{uuid.uuid4().hex}"
     
     existing_user = await db.users.find_one({"email": user_info["email"]}, {"_id": 0})
     
@@ -587,6 +2863,7 @@ async def google_oauth_callback(code: str, redirect_uri: str, response: Response
                 "picture": user_info.get("picture", "")
             }}
         )
+        session_cache.invalidate_user(user_id)
         is_new_user = False
     else:
         logger.info(f"[AUTH] Creating new user: {user_id}")
@@ -603,13 +2880,8 @@ async def google_oauth_callback(code: str, redirect_uri: str, response: Response
         is_new_user = True
     
     # Create session
-    session_doc = {
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.user_sessions.insert_one(session_doc)
+    user_type = existing_user.get("user_type") if existing_user else None
+    session_token = await create_user_session(user_id, user_type)
     logger.info(f"[AUTH] Session created for: {user_id}")
     
     response.set_cookie(
@@ -633,25 +2905,22 @@ async def create_session(request: SessionRequest, response: Response):
     """Create user session from Emergent Auth session_id"""
     logger.info("[AUTH] Processing session request")
     
-    async with httpx.AsyncClient() as http_client:
-        try:
-            emergent_response = await http_client.get(
-                EMERGENT_AUTH_URL,
-                headers={"X-Session-ID": request.session_id},
-                timeout=15
-            )
-            emergent_response.raise_for_status()
-            auth_data = emergent_response.json()
-            logger.info(f"[AUTH] Google OAuth successful for: {auth_data.get('email')}")
-        except httpx.HTTPStatusError as e:
-            logger.error(f"[AUTH] Auth validation failed: {e.response.status_code}")
-            raise HTTPException(status_code=401, detail="Autenticación fallida")
-        except Exception as e:
-            logger.error(f"[AUTH] Auth service error: {str(e)}")
-            raise HTTPException(status_code=502, detail="Error del servicio de autenticación")
+    try:
+        emergent_response = await upstream.get(
+            EMERGENT_AUTH_URL,
+            headers={"X-Session-ID": request.session_id}
+        )
+        emergent_response.raise_for_status()
+        auth_data = emergent_response.json()
+        logger.info(f"[AUTH] Google OAuth successful for: {auth_data.get('email')}")
+    except httpx.HTTPStatusError as e:
+        logger.error(f"[AUTH] Auth validation failed: {e.response.status_code}")
+        raise HTTPException(status_code=401, detail="Autenticación fallida")
+    except Exception as e:
+        logger.error(f"[AUTH] Auth service error: {str(e)}")
+        raise HTTPException(status_code=502, detail="Error del servicio de autenticación")
     
     user_id = f"user_{uuid.uuid4().hex[:12]}"
-    session_token = auth_data["session_token"]
     
     existing_user = await db.users.find_one({"email": auth_data["email"]}, {"_id": 0})
     
@@ -665,6 +2934,7 @@ async def create_session(request: SessionRequest, response: Response):
                 "picture": auth_data["picture"]
             }}
         )
+        session_cache.invalidate_user(user_id)
         is_new_user = False
     else:
         logger.info(f"[AUTH] Creating new user: {user_id}")
@@ -680,13 +2950,8 @@ async def create_session(request: SessionRequest, response: Response):
         await db.users.insert_one(user_doc)
         is_new_user = True
     
-    session_doc = {
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.user_sessions.insert_one(session_doc)
+    user_type = existing_user.get("user_type") if existing_user else None
+    session_token = await create_user_session(user_id, user_type, auth_data["session_token"])
     logger.info(f"[AUTH] Session created for: {user_id}")
     
     response.set_cookie(
@@ -716,7 +2981,14 @@ async def logout(response: Response, authorization: Optional[str] = Header(None)
     token = session_token or (authorization.replace("Bearer ", "") if authorization else None)
     
     if token:
-        await db.user_sessions.delete_one({"session_token": token})
+        if is_signed_session_token(token):
+            try:
+                await revoked_sessions.revoke(decode_signed_session_token(token))
+            except HTTPException:
+                pass  # Already expired or invalid, nothing to revoke
+        else:
+            await db.user_sessions.delete_one({"session_token": token})
+        session_cache.invalidate(token)
     
     response.delete_cookie(key="session_token", path="/")
     return {"message": "Sesión cerrada exitosamente"}
@@ -730,6 +3002,7 @@ async def set_user_type(user_type: Literal["cliente", "pulperia"], authorization
         {"user_id": user.user_id},
         {"$set": {"user_type": user_type}}
     )
+    session_cache.invalidate_user(user.user_id)
     
     updated_user = await db.users.find_one({"user_id": user.user_id}, {"_id": 0})
     updated_user["is_admin"] = updated_user.get("email") == ADMIN_EMAIL
@@ -751,6 +3024,7 @@ async def change_user_type(type_change: UserTypeChange, authorization: Optional[
         {"user_id": user.user_id},
         {"$set": {"user_type": type_change.new_type, "name": new_name}}
     )
+    session_cache.invalidate_user(user.user_id)
     
     updated_user = await db.users.find_one({"user_id": user.user_id}, {"_id": 0})
     updated_user["is_admin"] = updated_user.get("email") == ADMIN_EMAIL
@@ -760,30 +3034,151 @@ async def change_user_type(type_change: UserTypeChange, authorization: Optional[
 # PULPERIA ENDPOINTS
 # ============================================
 
+PULPERIA_PAGE_SIZE = 100
+
 @api_router.get("/pulperias")
-async def get_pulperias(lat: Optional[float] = None, lng: Optional[float] = None, search: Optional[str] = None, sort_by: Optional[str] = None):
-    """Get all pulperias with optional search and sorting"""
-    query = {}
+async def get_pulperias(lat: Optional[float] = None, lng: Optional[float] = None, radius_km: Optional[float] = None, search: Optional[str] = None, sort_by: Optional[str] = None, limit: int = PULPERIA_PAGE_SIZE, cursor: Optional[str] = None, with_meta: bool = False, open_now: bool = False):
+    """Get all pulperias with optional search and sorting
+    
+    With lat/lng the results are the nearest pulperias (within radius_km
+    when given), ordered by distance and carrying distance_km.
+    with_meta=true wraps the list as {"results": [...], "did_you_mean": ...,
+    "next_cursor": ...}; next_cursor pages through nearby results.
+    open_now=true keeps pulperias whose parsed hours cover the current time.
+    """
+    limit = max(1, min(limit, PULPERIA_PAGE_SIZE))
+    geo = lat is not None and lng is not None
+    
+    async def fetch(query: dict) -> tuple:
+        if geo:
+            return await nearby_pulperia_page(lat, lng, radius_km, query, limit, cursor)
+        sort_options = [("rating", -1)] if sort_by == "rating" else [("created_at", -1)]
+        return await db.pulperias.find(query, PUBLIC_PROJECTION).sort(sort_options).to_list(limit), None
+    
+    base_query = open_now_query(week_minute()) if open_now else {}
+    query = dict(base_query)
     if search:
-        pattern = create_search_pattern(search)
-        query["$or"] = [
-            {"name": {"$regex": pattern, "$options": "i"}},
-            {"address": {"$regex": pattern, "$options": "i"}}
-        ]
+        query.update(prefix_search_query("pulperias", search))
+    
+    pulperias, next_cursor = await fetch(query)
     
-    sort_options = [("created_at", -1)]
-    if sort_by == "rating":
-        sort_options = [("rating", -1)]
+    # No hits: retry once with a typo-corrected query
+    did_you_mean = None
+    if search and not pulperias and not cursor:
+        did_you_mean = pulperia_vocabulary.correct_query(search)
+        if did_you_mean:
+            pulperias, next_cursor = await fetch({**base_query, **prefix_search_query("pulperias", did_you_mean)})
     
-    pulperias = await db.pulperias.find(query, {"_id": 0}).sort(sort_options).to_list(100)
+    if with_meta:
+        return {"results": pulperias, "did_you_mean": did_you_mean, "next_cursor": next_cursor}
     return pulperias
 
+async def nearby_pulperia_page(lat: float, lng: float, radius_km: Optional[float], query: dict, limit: int, cursor: Optional[str] = None) -> tuple:
+    """One page of pulperias ordered by distance with $geoNear, returning (pulperias, next_cursor)
+    
+    The cursor holds the last distance and the ids seen at exactly that
+    distance, so the next page starts there through minDistance instead of
+    skipping over earlier pages.
+    """
+    geo_near = {
+        "near": {"type": "Point", "coordinates": [lng, lat]},
+        "key": "geo_location",
+        "distanceField": "distance_m",
+        "spherical": True,
+        "query": dict(query)
+    }
+    if radius_km is not None:
+        geo_near["maxDistance"] = radius_km * 1000
+    if cursor:
+        after = decode_cursor(cursor, "distance")["after"]
+        geo_near["minDistance"] = after[0]
+        geo_near["query"]["pulperia_id"] = {"$nin": after[1]}
+    
+    pulperias = await db.pulperias.aggregate([
+        {"$geoNear": geo_near},
+        {"$limit": limit + 1},
+        {"$project": PUBLIC_PROJECTION}
+    ]).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(pulperias) > limit:
+        pulperias = pulperias[:limit]
+        last_distance = pulperias[-1]["distance_m"]
+        tied_ids = [p["pulperia_id"] for p in pulperias if p["distance_m"] == last_distance]
+        if cursor and after[0] == last_distance:
+            tied_ids += after[1]
+        next_cursor = encode_cursor({"sort": "distance", "after": [last_distance, tied_ids]})
+    
+    for pulperia in pulperias:
+        pulperia["distance_km"] = round(pulperia.pop("distance_m") / 1000, 2)
+    return pulperias, next_cursor
+
+@api_router.get("/pulperias/in-bounds")
+async def get_pulperias_in_bounds(bbox: str, limit: int = MAP_BOUNDS_MAX_RESULTS, open_now: bool = False):
+    """Compact markers of the pulperias inside a map viewport, from the in-memory grid"""
+    min_lat, min_lng, max_lat, max_lng = parse_bbox(bbox)
+    open_at = week_minute() if open_now else None
+    markers, truncated = pulperia_grid.query(min_lat, min_lng, max_lat, max_lng, max(1, min(limit, MAP_BOUNDS_MAX_RESULTS)), open_at)
+    return {"count": len(markers), "truncated": truncated, "pulperias": markers}
+
+@api_router.get("/map/tiles/{z}/{x}/{y}")
+async def get_map_tile(z: int, x: int, y: int, open_now: bool = False):
+    """Clustered pulperia markers for one XYZ map tile
+    
+    Up to MAP_CLUSTER_MAX_ZOOM, markers sharing a 64px screen cell come back
+    as a centroid with a count; beyond it every pulperia is listed.
+    open_now=true tiles are cached for the current minute only.
+    """
+    if not 0 <= z <= MAP_MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise HTTPException(status_code=400, detail="Tile inválido")
+    
+    open_at = None
+    cache = map_tile_cache
+    if open_now:
+        open_at = week_minute()
+        cache = open_map_tile_cache
+        cache.use_scope(open_at)
+    
+    tile = cache.get((z, x, y))
+    if tile is None:
+        tile = build_map_tile(z, x, y, open_at)
+        if pulperia_grid.ready:
+            cache.set((z, x, y), tile)
+    return tile
+
+@api_router.get("/pulperias/{pulperia_id}/logo-thumb")
+async def get_pulperia_logo_thumbnail(pulperia_id: str, v: Optional[str] = None):
+    """Small WebP version of an uploaded pulperia logo"""
+    cache_key = f"{pulperia_id}:{v}"
+    thumbnail = logo_thumbnails.get(cache_key)
+    if thumbnail is None:
+        pulperia = await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0, "pulperia_id": 1, "logo_url": 1})
+        if not pulperia or not (pulperia.get("logo_url") or "").startswith("data:"):
+            raise HTTPException(status_code=404, detail="Logo no encontrado")
+        try:
+            thumbnail = await asyncio.to_thread(make_logo_thumbnail, pulperia["logo_url"])
+        except Exception:
+            raise HTTPException(status_code=404, detail="Logo no encontrado")
+        
+        # Only versions matching the current logo are cached
+        if logo_thumbnail_url(pulperia).endswith(f"?v={v}"):
+            logo_thumbnails[cache_key] = thumbnail
+            while len(logo_thumbnails) > LOGO_THUMBNAIL_CACHE_ENTRIES:
+                logo_thumbnails.popitem(last=False)
+        else:
+            return Response(content=thumbnail, media_type="image/webp", headers={"Cache-Control": "no-cache"})
+    else:
+        logo_thumbnails.move_to_end(cache_key)
+    
+    return Response(content=thumbnail, media_type="image/webp", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
 @api_router.get("/pulperias/{pulperia_id}")
 async def get_pulperia(pulperia_id: str):
     """Get single pulperia by ID"""
-    pulperia = await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0})
+    pulperia = await db.pulperias.find_one({"pulperia_id": pulperia_id}, PUBLIC_PROJECTION)
     if not pulperia:
         raise HTTPException(status_code=404, detail="Pulpería no encontrada")
+    pulperia["rating_histogram"] = rating_histogram(pulperia)
     return pulperia
 
 @api_router.post("/pulperias")
@@ -799,13 +3194,26 @@ async def create_pulperia(pulperia_data: PulperiaCreate, authorization: Optional
         "pulperia_id": pulperia_id,
         "owner_user_id": user.user_id,
         **pulperia_data.model_dump(),
+        **build_search_fields("pulperias", pulperia_data.model_dump()),
+        **geo_fields(pulperia_data.model_dump()),
+        **hours_fields(pulperia_data.model_dump()),
         "rating": 0.0,
         "review_count": 0,
+        "rating_sum": 0,
+        "rating_histogram": empty_rating_histogram(),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
     await db.pulperias.insert_one(pulperia_doc)
-    return await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0})
+    await db.pulperia_stats.insert_one({
+        "pulperia_id": pulperia_id,
+        **{counter: 0 for counter in PULPERIA_STATS_COUNTERS},
+        "is_verified": False,
+        "updated_at": pulperia_doc["created_at"]
+    })
+    pulperia = await db.pulperias.find_one({"pulperia_id": pulperia_id}, PUBLIC_PROJECTION)
+    index_pulperia_change(pulperia)
+    return pulperia
 
 @api_router.put("/pulperias/{pulperia_id}")
 async def update_pulperia(pulperia_id: str, pulperia_data: PulperiaCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -821,6 +3229,9 @@ async def update_pulperia(pulperia_id: str, pulperia_data: PulperiaCreate, autho
     
     # Get all data including None values to properly update
     update_data = pulperia_data.model_dump(exclude_unset=False)
+    update_data.update(build_search_fields("pulperias", update_data))
+    update_data.update(geo_fields(update_data))
+    update_data.update(hours_fields(update_data))
     
     # Log for debugging
     logger.info(f"[PULPERIA UPDATE] Updating {pulperia_id} with banner_url: {update_data.get('banner_url', 'NOT SET')}")
@@ -830,7 +3241,9 @@ async def update_pulperia(pulperia_id: str, pulperia_data: PulperiaCreate, autho
         {"$set": update_data}
     )
     
-    return await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0})
+    updated_pulperia = await db.pulperias.find_one({"pulperia_id": pulperia_id}, PUBLIC_PROJECTION)
+    index_pulperia_change(updated_pulperia)
+    return updated_pulperia
 
 @api_router.delete("/admin/pulperias/{pulperia_id}")
 async def admin_delete_pulperia(pulperia_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -842,15 +3255,17 @@ async def admin_delete_pulperia(pulperia_id: str, authorization: Optional[str] =
         raise HTTPException(status_code=404, detail="Pulpería no encontrada")
     
     # Delete all related data
-    await db.products.delete_many({"pulperia_id": pulperia_id})
+    await delete_pulperia_products(pulperia_id)
     await db.orders.delete_many({"pulperia_id": pulperia_id})
     await db.reviews.delete_many({"pulperia_id": pulperia_id})
     await db.achievements.delete_many({"pulperia_id": pulperia_id})
+    await db.pulperia_stats.delete_one({"pulperia_id": pulperia_id})
     await db.announcements.delete_many({"pulperia_id": pulperia_id})
     await db.jobs.delete_many({"pulperia_id": pulperia_id})
     await db.featured_ads.delete_many({"pulperia_id": pulperia_id})
     await db.featured_ad_slots.delete_many({"pulperia_id": pulperia_id})
     await db.pulperias.delete_one({"pulperia_id": pulperia_id})
+    index_pulperia_change(pulperia, deleted=True)
     
     return {"message": f"Pulpería '{pulperia.get('name', pulperia_id)}' eliminada"}
 
@@ -877,15 +3292,17 @@ async def close_own_pulperia(pulperia_id: str, close_request: ClosePulperiaReque
     pulperia_name = pulperia.get('name', pulperia_id)
     
     # Eliminar todos los datos relacionados
-    await db.products.delete_many({"pulperia_id": pulperia_id})
+    await delete_pulperia_products(pulperia_id)
     await db.orders.delete_many({"pulperia_id": pulperia_id})
     await db.reviews.delete_many({"pulperia_id": pulperia_id})
     await db.achievements.delete_many({"pulperia_id": pulperia_id})
+    await db.pulperia_stats.delete_one({"pulperia_id": pulperia_id})
     await db.announcements.delete_many({"pulperia_id": pulperia_id})
     await db.jobs.delete_many({"pulperia_id": pulperia_id})
     await db.featured_ads.delete_many({"pulperia_id": pulperia_id})
     await db.featured_ad_slots.delete_many({"pulperia_id": pulperia_id})
     await db.pulperias.delete_one({"pulperia_id": pulperia_id})
+    index_pulperia_change(pulperia, deleted=True)
     
     # NO cambiar tipo de usuario - mantener como "pulperia" para que pueda crear otra
     # El usuario sigue siendo tipo pulpería y puede crear una nueva tienda
@@ -901,7 +3318,7 @@ async def close_own_pulperia(pulperia_id: str, close_request: ClosePulperiaReque
 @api_router.get("/pulperias/{pulperia_id}/products")
 async def get_pulperia_products(pulperia_id: str):
     """Get all products for a pulperia"""
-    products = await db.products.find({"pulperia_id": pulperia_id}, {"_id": 0}).to_list(100)
+    products = await db.products.find({"pulperia_id": pulperia_id}, PUBLIC_PROJECTION).to_list(100)
     return products
 
 @api_router.get("/pulperias/{pulperia_id}/reviews")
@@ -942,13 +3359,25 @@ async def create_review(pulperia_id: str, review_data: ReviewCreate, authorizati
     
     await db.reviews.insert_one(review_doc)
     
-    all_reviews = await db.reviews.find({"pulperia_id": pulperia_id}, {"_id": 0}).to_list(1000)
-    avg_rating = sum(r["rating"] for r in all_reviews) / len(all_reviews)
+    # Pulperias from before the counters existed get them rebuilt instead of incremented
+    if "rating_sum" in pulperia:
+        counters = await apply_review_rating(pulperia_id, review_data.rating)
+        if counters is not None:
+            leaderboards.set_rating(pulperia_id, counters["rating_sum"], counters["review_count"])
+    else:
+        await rebuild_review_counters([pulperia_id])
+        counters = await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0, "rating": 1})
+    if counters is None:
+        # Deleted while the review was being written
+        await db.reviews.delete_one({"review_id": review_id})
+        raise HTTPException(status_code=404, detail="Pulpería no encontrada")
     
-    await db.pulperias.update_one(
-        {"pulperia_id": pulperia_id},
-        {"$set": {"rating": round(avg_rating, 1), "review_count": len(all_reviews)}}
-    )
+    pulperia_grid.set_rating(pulperia_id, counters["rating"])
+    map_tile_cache.invalidate_marker(pulperia_grid.get(pulperia_id))
+    open_map_tile_cache.invalidate_marker(pulperia_grid.get(pulperia_id))
+    if review_data.rating >= 4:
+        await bump_pulperia_stats(pulperia_id, happy_customers=1)
+        schedule_achievement_check(pulperia_id, "review_posted")
     
     return await db.reviews.find_one({"review_id": review_id}, {"_id": 0})
 
@@ -1007,7 +3436,7 @@ async def delete_announcement(announcement_id: str, authorization: Optional[str]
 @api_router.get("/pulperias/{pulperia_id}/jobs")
 async def get_pulperia_jobs(pulperia_id: str):
     """Get all jobs for a pulperia"""
-    jobs = await db.jobs.find({"pulperia_id": pulperia_id}, {"_id": 0}).sort("created_at", -1).to_list(50)
+    jobs = await db.jobs.find({"pulperia_id": pulperia_id}, PUBLIC_PROJECTION).sort("created_at", -1).to_list(50)
     return jobs
 
 # ============================================
@@ -1015,44 +3444,368 @@ async def get_pulperia_jobs(pulperia_id: str):
 # ============================================
 
 @api_router.get("/products")
-async def search_products(search: Optional[str] = None, category: Optional[str] = None, sort_by: Optional[str] = None):
-    """Search products across all pulperias with fuzzy matching"""
+async def search_products(search: Optional[str] = None, category: Optional[str] = None, sort_by: Optional[str] = None, limit: int = PRODUCT_PAGE_SIZE, cursor: Optional[str] = None, with_meta: bool = False, facets: bool = False, lat: Optional[float] = None, lng: Optional[float] = None, radius_km: Optional[float] = None):
+    """Search products across all pulperias with fuzzy matching
+    
+    sort_by (price_asc, price_desc, newest) is applied by Mongo on indexed
+    keys; searches without it are ranked by relevance. with_meta=true wraps
+    the page as {"results": [...], "did_you_mean": ..., "next_cursor": ...}
+    and next_cursor goes back as `cursor` for the following page.
+    facets=true implies with_meta and adds category counts for the whole
+    match set. First pages are cached until a product or pulperia in them
+    changes.
+    
+    With lat/lng only products of pulperias within radius_km are returned,
+    ranked by a blend of relevance, distance and price, each carrying
+    distance_km.
+    """
+    limit = max(1, min(limit, PRODUCT_PAGE_SIZE))
+    if lat is not None and lng is not None:
+        page = await run_nearby_product_search(search, category, lat, lng, radius_km, limit, cursor)
+    else:
+        page = await cached_product_search(search, category, sort_by, limit, cursor)
+    
+    if with_meta or facets:
+        response = dict(page)
+        response.pop("facets", None)
+        if facets:
+            response["facets"] = page.get("facets") or search_facets(page["did_you_mean"] or search, page["results"])
+        return response
+    return page["results"]
+
+def search_facets(search: Optional[str], products: list) -> List[dict]:
+    """Category counts for a search, read from the in-memory structures only"""
+    if not search:
+        return category_facets.get()
+    if product_search_index.ready and category_facets.ready:
+        return category_facets.count_products(product_search_index.match(search))
+    
+    counts: Dict[str, int] = {}
+    for product in products:
+        category = product.get("category") or ""
+        counts[category] = counts.get(category, 0) + 1
+    return CategoryFacets.as_list(counts)
+
+@api_router.get("/products/facets")
+async def get_product_facets(pulperia_id: Optional[str] = None):
+    """Category counts of available products, globally or for one pulperia"""
+    categories = category_facets.get(pulperia_id)
+    return {
+        "pulperia_id": pulperia_id,
+        "categories": categories,
+        "total": sum(facet["count"] for facet in categories)
+    }
+
+async def cached_product_search(search: Optional[str], category: Optional[str], sort_by: Optional[str], limit: int = PRODUCT_PAGE_SIZE, cursor: Optional[str] = None) -> dict:
+    """run_product_search through the search result cache"""
+    # Only first pages are cached, and search results only once the in-memory index serves them
+    cache_key = None
+    if not cursor and (not search or product_search_index.ready):
+        cache_key = search_result_cache.make_key(search, category, sort_by, limit)
+    
+    cached = search_result_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        return {"results": cached["results"], "did_you_mean": cached["did_you_mean"], "next_cursor": cached["next_cursor"]}
+    
+    generation = search_result_cache.generation
+    page = await run_product_search(search, category, sort_by, limit, cursor)
+    if cache_key:
+        search_result_cache.set(cache_key, page["results"], page["did_you_mean"], page["next_cursor"], generation)
+    return page
+
+async def run_product_search(search: Optional[str], category: Optional[str], sort_by: Optional[str], limit: int = PRODUCT_PAGE_SIZE, cursor: Optional[str] = None) -> dict:
+    """Fetch one page of products and enrich it with pulperia info
+    
+    Explicit sorts use the Mongo prefix lookup and relevance ranking the
+    in-memory BM25 index; both match products containing every term. A
+    relevance cursor carries the scoring snapshot of its first page.
+    """
+    if sort_by in PRODUCT_SORTS:
+        sort_name = sort_by
+    else:
+        sort_name = "relevance" if search and product_search_index.ready else "newest"
+    
+    after = None
+    cursor_snapshot = None
+    if cursor:
+        payload = decode_cursor(cursor, sort_name)
+        after = payload["after"]
+        search = payload.get("q") or search
+        cursor_snapshot = payload.get("stats")
+    
+    async def fetch_page(query: Optional[str]) -> tuple:
+        if sort_name == "relevance":
+            return await relevance_product_page(query, category, limit, after, cursor_snapshot)
+        products, last = await sorted_product_page(query, category, sort_name, limit, after)
+        return products, last, None
+    
+    products, last, snapshot = await fetch_page(search)
+    
+    # No hits: retry once with a typo-corrected query
+    did_you_mean = None
+    if search and not products and not after and product_search_index.ready:
+        did_you_mean = product_search_index.correct_query(search)
+        if did_you_mean:
+            search = did_you_mean
+            products, last, snapshot = await fetch_page(search)
+    
+    next_cursor = None
+    if last:
+        next_cursor = encode_cursor({"sort": sort_name, "after": last, "q": search, **({"stats": snapshot} if snapshot else {})})
+    await attach_pulperia_info(products)
+    return {"results": products, "did_you_mean": did_you_mean, "next_cursor": next_cursor}
+
+async def attach_pulperia_info(products: list):
+    """Enrich a page of products with pulperia name and logo in one query"""
+    pulperia_ids = list(set(p["pulperia_id"] for p in products))
+    if not pulperia_ids:
+        return
+    
+    pulperias_list = await db.pulperias.find(
+        {"pulperia_id": {"$in": pulperia_ids}},
+        {"_id": 0, "pulperia_id": 1, "name": 1, "logo_url": 1}
+    ).to_list(len(pulperia_ids))
+    pulperias_dict = {p["pulperia_id"]: p for p in pulperias_list}
     
+    for product in products:
+        pulperia = pulperias_dict.get(product["pulperia_id"])
+        if pulperia:
+            product["pulperia_name"] = pulperia["name"]
+            product["pulperia_logo"] = pulperia.get("logo_url")
+
+# Products near the customer: geo lookup first, then a product query restricted to those pulperias
+NEARBY_PRODUCTS_DEFAULT_RADIUS_KM = 5.0
+NEARBY_PRODUCTS_MAX_RADIUS_KM = 50.0
+NEARBY_PRODUCTS_MAX_CANDIDATES = 2000
+NEARBY_PULPERIA_BATCH = 50
+NEARBY_RANK_WEIGHTS = {"relevance": 0.5, "distance": 0.3, "price": 0.2}
+NEARBY_CANDIDATE_PROJECTION = {"_id": 0, "product_id": 1, "pulperia_id": 1, "name": 1, "description": 1, "category": 1, "price": 1}
+
+async def nearby_pulperia_distances(lat: float, lng: float, radius_km: float) -> Dict[str, float]:
+    """pulperia_id -> km for the non-suspended pulperias within radius_km
+    
+    Served by the in-memory map grid; $geoNear on the 2dsphere index covers
+    the window before the grid has loaded.
+    """
+    if pulperia_grid.ready:
+        return pulperia_grid.within_radius(lat, lng, radius_km)
+    
+    pulperias = await db.pulperias.aggregate([
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [lng, lat]},
+            "key": "geo_location",
+            "distanceField": "distance_m",
+            "spherical": True,
+            "maxDistance": radius_km * 1000,
+            "query": {"is_suspended": {"$ne": True}}
+        }},
+        {"$limit": MAP_BOUNDS_MAX_RESULTS},
+        {"$project": {"_id": 0, "pulperia_id": 1, "distance_m": 1}}
+    ]).to_list(MAP_BOUNDS_MAX_RESULTS)
+    return {p["pulperia_id"]: p["distance_m"] / 1000 for p in pulperias}
+
+def nearby_rank(candidates: list, relevance: Dict[str, float], distances: Dict[str, float], radius_km: float) -> List[tuple]:
+    """(-score, product_id) keys, best first, blending relevance, distance and price
+    
+    Each signal is scaled to 0-1 within the candidate set: relevance against
+    the best match, distance against the radius, price between the
+    cheapest and the most expensive candidate.
+    """
+    best_relevance = max(relevance.values(), default=0.0)
+    prices = [float(p.get("price") or 0) for p in candidates]
+    low_price, high_price = min(prices, default=0.0), max(prices, default=0.0)
+    
+    keys = []
+    for product, price in zip(candidates, prices):
+        product_id = product["product_id"]
+        relevance_part = relevance.get(product_id, 0.0) / best_relevance if best_relevance else 1.0
+        distance_part = 1 - min(distances[product["pulperia_id"]] / radius_km, 1.0) if radius_km else 1.0
+        price_part = (high_price - price) / (high_price - low_price) if high_price > low_price else 1.0
+        score = (
+            NEARBY_RANK_WEIGHTS["relevance"] * relevance_part
+            + NEARBY_RANK_WEIGHTS["distance"] * distance_part
+            + NEARBY_RANK_WEIGHTS["price"] * price_part
+        )
+        keys.append((-round(score, 6), product_id))
+    keys.sort()
+    return keys
+
+async def nearby_product_candidates(search: Optional[str], category: Optional[str], distances: Dict[str, float]) -> list:
+    """Available products matching every search term from the nearest pulperias, nearest first
+    
+    Pulperias are queried in batches by distance until
+    NEARBY_PRODUCTS_MAX_CANDIDATES products are found; the cap then applies
+    to the (distance, product_id) order, so a dense area always ranks the
+    same nearest products.
+    """
+    conditions = [{"available": True}]
+    if category:
+        conditions.append({"category": category})
     if search:
-        products = await fuzzy_search_products(search)
+        conditions.append(prefix_search_query("products", search))
+    
+    nearest = sorted(distances, key=lambda pulperia_id: (distances[pulperia_id], pulperia_id))
+    candidates = []
+    for start in range(0, len(nearest), NEARBY_PULPERIA_BATCH):
+        if len(candidates) >= NEARBY_PRODUCTS_MAX_CANDIDATES:
+            break
+        batch = nearest[start:start + NEARBY_PULPERIA_BATCH]
+        candidates += await db.products.find(
+            {"$and": [{"pulperia_id": {"$in": batch}}, *conditions]}, NEARBY_CANDIDATE_PROJECTION
+        ).to_list(None)
+    candidates.sort(key=lambda p: (distances[p["pulperia_id"]], p["product_id"]))
+    return candidates[:NEARBY_PRODUCTS_MAX_CANDIDATES]
+
+async def run_nearby_product_search(search: Optional[str], category: Optional[str], lat: float, lng: float, radius_km: Optional[float], limit: int = PRODUCT_PAGE_SIZE, cursor: Optional[str] = None) -> dict:
+    """One page of products from pulperias near (lat, lng), with distance_km
+    
+    Candidates are scored on slim documents and only the page is loaded in
+    full. The cursor carries the query, location and last (score, id), so
+    following pages rank the same candidate set. Not cached: the location
+    makes nearly every request unique.
+    """
+    after = None
+    if cursor:
+        payload = decode_cursor(cursor, "nearby")
+        after = payload["after"]
+        search = payload.get("q") or search
+        lat, lng, radius_km = payload["lat"], payload["lng"], payload["radius_km"]
+    
+    if radius_km is None:
+        radius_km = NEARBY_PRODUCTS_DEFAULT_RADIUS_KM
+    radius_km = max(0.0, min(radius_km, NEARBY_PRODUCTS_MAX_RADIUS_KM))
+    
+    distances = await nearby_pulperia_distances(lat, lng, radius_km)
+    candidates = await nearby_product_candidates(search, category, distances) if distances else []
+    
+    # No hits: retry once with a typo-corrected query
+    did_you_mean = None
+    if search and distances and not candidates and not after and product_search_index.ready:
+        did_you_mean = product_search_index.correct_query(search)
+        if did_you_mean:
+            search = did_you_mean
+            candidates = await nearby_product_candidates(search, category, distances)
+    
+    # Scored on the candidates alone; BM25 would score every match in the catalog
+    if search:
+        terms = search_tokens(search)
+        relevance = {p["product_id"]: relevance_score(terms, "products", p) for p in candidates}
     else:
-        query = {"available": True}
-        if category:
-            query["category"] = category
-        products = await db.products.find(query, {"_id": 0}).to_list(100)
-    
-    # Sort results
-    if sort_by == "price_asc":
-        products.sort(key=lambda x: x.get("price", 0))
-    elif sort_by == "price_desc":
-        products.sort(key=lambda x: x.get("price", 0), reverse=True)
-    
-    # Enrich with pulperia info
-    pulperia_ids = list(set(p["pulperia_id"] for p in products))
-    if pulperia_ids:
-        pulperias_list = await db.pulperias.find(
-            {"pulperia_id": {"$in": pulperia_ids}},
-            {"_id": 0, "pulperia_id": 1, "name": 1, "logo_url": 1}
-        ).to_list(len(pulperia_ids))
-        pulperias_dict = {p["pulperia_id"]: p for p in pulperias_list}
-        
+        relevance = {}
+    
+    keys = nearby_rank(candidates, relevance, distances, radius_km)
+    if after:
+        after_key = (-after[0], after[1])
+        keys = [key for key in keys if key > after_key]
+    
+    page = keys[:limit]
+    next_cursor = None
+    if len(keys) > limit:
+        next_cursor = encode_cursor({
+            "sort": "nearby", "after": [-page[-1][0], page[-1][1]],
+            "q": search, "lat": lat, "lng": lng, "radius_km": radius_km
+        })
+    
+    products = []
+    if page:
+        product_ids = [product_id for _, product_id in page]
+        products = await db.products.find(
+            {"product_id": {"$in": product_ids}, "available": True},
+            PUBLIC_PROJECTION
+        ).to_list(len(product_ids))
+        position = {product_id: i for i, product_id in enumerate(product_ids)}
+        products.sort(key=lambda p: position[p["product_id"]])
         for product in products:
-            pulperia = pulperias_dict.get(product["pulperia_id"])
-            if pulperia:
-                product["pulperia_name"] = pulperia["name"]
-                product["pulperia_logo"] = pulperia.get("logo_url")
+            product["distance_km"] = round(distances[product["pulperia_id"]], 2)
+        await attach_pulperia_info(products)
     
-    return products
+    counts: Dict[str, int] = {}
+    for product in candidates:
+        category_name = product.get("category") or ""
+        counts[category_name] = counts.get(category_name, 0) + 1
+    
+    return {
+        "results": products,
+        "did_you_mean": did_you_mean,
+        "next_cursor": next_cursor,
+        "facets": CategoryFacets.as_list(counts)
+    }
+
+def normalize_code(code: Optional[str]) -> Optional[str]:
+    """Canonical barcode/SKU: no spaces or dashes, upper case, None when empty"""
+    if not code:
+        return None
+    return re.sub(r"[\s-]", "", code).upper() or None
+
+PRODUCT_CODE_FIELDS = ("barcode", "sku")
+
+def product_fields(product_data: ProductCreate, update: bool = False) -> dict:
+    """Fields to store for a product; on update, codes the request leaves out are kept as they are"""
+    fields = product_data.model_dump()
+    for code_field in PRODUCT_CODE_FIELDS:
+        if update and code_field not in product_data.model_fields_set:
+            del fields[code_field]
+        else:
+            fields[code_field] = normalize_code(fields[code_field])
+    return fields
+
+BARCODE_LOOKUP_LIMIT = 50
+
+@api_router.get("/products/by-barcode/{code}")
+async def get_products_by_barcode(code: str, lat: Optional[float] = None, lng: Optional[float] = None, radius_km: float = 10.0):
+    """Products with a barcode across pulperias, nearest first when lat/lng are given, else cheapest first
+    
+    With a location the pulperias within radius_km are resolved first (map
+    grid or $geoNear), so the barcode query only reads their products and
+    every nearby match is ranked before the limit applies.
+    """
+    barcode = normalize_code(code)
+    if not barcode:
+        raise HTTPException(status_code=400, detail="Código de barras inválido")
+    
+    if lat is not None and lng is not None:
+        distances = await nearby_pulperia_distances(lat, lng, max(0.1, min(radius_km, NEARBY_PRODUCTS_MAX_RADIUS_KM)))
+        if not distances:
+            return []
+        products = await db.products.find(
+            {"barcode": barcode, "available": True, "pulperia_id": {"$in": list(distances)}},
+            PUBLIC_PROJECTION
+        ).to_list(None)
+        for product in products:
+            product["distance_km"] = round(distances[product["pulperia_id"]], 2)
+        products.sort(key=lambda p: (p["distance_km"], p["price"], p["product_id"]))
+        products = products[:BARCODE_LOOKUP_LIMIT]
+        await attach_pulperia_info(products)
+        return products
+    
+    products = await db.products.find(
+        {"barcode": barcode, "available": True},
+        PUBLIC_PROJECTION
+    ).sort("price", 1).to_list(BARCODE_LOOKUP_LIMIT)
+    if not products:
+        return []
+    
+    pulperia_ids = list(set(p["pulperia_id"] for p in products))
+    pulperias_list = await db.pulperias.find(
+        {"pulperia_id": {"$in": pulperia_ids}, "is_suspended": {"$ne": True}},
+        {"_id": 0, "pulperia_id": 1, "name": 1, "logo_url": 1}
+    ).to_list(len(pulperia_ids))
+    pulperias_dict = {p["pulperia_id"]: p for p in pulperias_list}
+    
+    results = []
+    for product in products:
+        pulperia = pulperias_dict.get(product["pulperia_id"])
+        if not pulperia:
+            continue
+        product["pulperia_name"] = pulperia["name"]
+        product["pulperia_logo"] = pulperia.get("logo_url")
+        results.append(product)
+    return results
 
 @api_router.get("/products/{product_id}")
 async def get_product(product_id: str):
     """Get single product by ID"""
-    product = await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    product = await db.products.find_one({"product_id": product_id}, PUBLIC_PROJECTION)
     if not product:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     return product
@@ -1070,15 +3823,24 @@ async def create_product(product_data: ProductCreate, pulperia_id: str, authoriz
         raise HTTPException(status_code=403, detail="No tienes permiso para agregar productos a esta pulpería")
     
     product_id = f"product_{uuid.uuid4().hex[:12]}"
+    fields = product_fields(product_data)
     product_doc = {
         "product_id": product_id,
         "pulperia_id": pulperia_id,
-        **product_data.model_dump(),
+        **fields,
+        **build_search_fields("products", fields),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.products.insert_one(product_doc)
-    return await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    try:
+        await db.products.insert_one(product_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Ya existe un producto con ese código de barras o SKU en esta pulpería")
+    product = await db.products.find_one({"product_id": product_id}, PUBLIC_PROJECTION)
+    index_product_change(product)
+    await bump_pulperia_stats(pulperia_id, products_count=1)
+    schedule_achievement_check(pulperia_id, "product_created")
+    return product
 
 @api_router.put("/products/{product_id}")
 async def update_product(product_id: str, product_data: ProductCreate, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -1093,12 +3855,18 @@ async def update_product(product_id: str, product_data: ProductCreate, authoriza
     if pulperia["owner_user_id"] != user.user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso para editar este producto")
     
-    await db.products.update_one(
-        {"product_id": product_id},
-        {"$set": product_data.model_dump()}
-    )
+    fields = product_fields(product_data, update=True)
+    try:
+        await db.products.update_one(
+            {"product_id": product_id},
+            {"$set": {**fields, **build_search_fields("products", fields)}}
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Ya existe un producto con ese código de barras o SKU en esta pulpería")
     
-    return await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    updated_product = await db.products.find_one({"product_id": product_id}, PUBLIC_PROJECTION)
+    index_product_change(updated_product)
+    return updated_product
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -1114,6 +3882,8 @@ async def delete_product(product_id: str, authorization: Optional[str] = Header(
         raise HTTPException(status_code=403, detail="No tienes permiso para eliminar este producto")
     
     await db.products.delete_one({"product_id": product_id})
+    index_product_change(product, deleted=True)
+    await bump_pulperia_stats(product["pulperia_id"], products_count=-1)
     return {"message": "Producto eliminado exitosamente"}
 
 @api_router.put("/products/{product_id}/availability")
@@ -1136,106 +3906,1034 @@ async def toggle_product_availability(product_id: str, authorization: Optional[s
         {"$set": {"available": new_available}}
     )
     
-    return await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    updated_product = await db.products.find_one({"product_id": product_id}, PUBLIC_PROJECTION)
+    index_product_change(updated_product)
+    return updated_product
 
 # ============================================
-# ACHIEVEMENT SYSTEM ENDPOINTS
+# SEARCH ENDPOINTS
 # ============================================
 
-async def calculate_pulperia_stats(pulperia_id: str) -> dict:
-    """Calculate statistics for a pulperia to determine achievements"""
-    # Contar productos
-    products_count = await db.products.count_documents({"pulperia_id": pulperia_id})
+suggest_latency = LatencyHistogram(buckets_ms=[0.5, 1, 2, 5, 10, 25, 50, 100])
+
+@api_router.get("/search/suggest")
+async def search_suggest(q: str = "", limit: int = 8):
+    """Typeahead suggestions for the search box, served from the in-memory trie"""
+    started = time.perf_counter()
+    suggestions = search_suggestions.suggest(q, limit=max(1, min(limit, SearchSuggestTrie.TOP_K)))
+    suggest_latency.record("suggest", time.perf_counter() - started)
+    return {"query": q, "suggestions": suggestions}
+
+SEARCH_GROUPS = ["pulperias", "products", "jobs", "services"]
+UNIFIED_SEARCH_MAX_LIMIT = 20
+# Newest prefix matches ranked per pulperia/job/service group; older matches beyond it are not considered
+UNIFIED_SEARCH_CANDIDATES = int(os.environ.get('UNIFIED_SEARCH_CANDIDATES', '200'))
+
+def relevance_score(terms: List[str], collection_name: str, doc: dict) -> float:
+    """Shared 0-1 ranking for unified search: title matches beat text matches, whole words beat prefixes"""
+    name_field, text_fields = SEARCH_FIELD_SOURCES[collection_name]
+    title_tokens = search_tokens(doc.get(name_field) or "")
+    text_tokens = [token for field in text_fields for token in search_tokens(doc.get(field) or "")]
+    
+    score = 0.0
+    for term in terms:
+        if term in title_tokens:
+            score += 1.0
+        elif any(token.startswith(term) for token in title_tokens):
+            score += 0.75
+        elif term in text_tokens:
+            score += 0.5
+        elif any(token.startswith(term) for token in text_tokens):
+            score += 0.25
+    return round(score / len(terms), 4) if terms else 0.0
+
+@api_router.get("/search")
+async def unified_search(q: str = "", limit: int = 5, types: Optional[str] = None):
+    """Search pulperias, products, jobs and services in one round trip
+    
+    The query is normalized once and the sources are queried concurrently.
+    Products keep the BM25 order of the product index; pulperias, jobs and
+    services are ranked with relevance_score over their newest
+    UNIFIED_SEARCH_CANDIDATES prefix matches, an approximation that only
+    misses strong matches older than that window. Every result carries its
+    relevance_score and groups come back ordered by their first result;
+    `limit` caps each group and `types` (comma separated) restricts the
+    sources.
+    """
+    terms = list(dict.fromkeys(search_tokens(q)))
+    if not terms:
+        return {"query": q, "did_you_mean": None, "groups": []}
+    
+    limit = max(1, min(limit, UNIFIED_SEARCH_MAX_LIMIT))
+    requested = [name for name in (types.split(",") if types else SEARCH_GROUPS) if name in SEARCH_GROUPS]
+    
+    async def search_group(collection_name: str) -> tuple:
+        """([(score, doc)] best first, has_more, did_you_mean) for one source"""
+        if collection_name == "products":
+            page = await cached_product_search(q, None, None, limit=limit)
+            scoring_terms = search_tokens(page["did_you_mean"]) if page["did_you_mean"] else terms
+            scored = [(relevance_score(scoring_terms, collection_name, doc), doc) for doc in page["results"]]
+            return scored, page["next_cursor"] is not None, page["did_you_mean"]
+        
+        docs = await db[collection_name].find(
+            prefix_search_query(collection_name, q, terms=terms),
+            PUBLIC_PROJECTION
+        ).sort("created_at", -1).to_list(UNIFIED_SEARCH_CANDIDATES)
+        scored = sorted(
+            ((relevance_score(terms, collection_name, doc), doc) for doc in docs),
+            key=lambda item: item[0],
+            reverse=True
+        )
+        return scored[:limit], len(docs) > limit, None
     
-    # Contar ventas completadas
-    sales_count = await db.orders.count_documents({
-        "pulperia_id": pulperia_id,
-        "status": "completed"
-    })
+    outcomes = await asyncio.gather(*(search_group(name) for name in requested))
     
-    # Contar clientes felices (reviews con rating >= 4)
-    happy_customers = await db.reviews.count_documents({
-        "pulperia_id": pulperia_id,
-        "rating": {"$gte": 4}
-    })
+    groups = []
+    did_you_mean = None
+    for collection_name, (scored, has_more, corrected) in zip(requested, outcomes):
+        groups.append({
+            "type": collection_name,
+            "results": [{**doc, "score": score} for score, doc in scored],
+            "has_more": has_more
+        })
+        did_you_mean = did_you_mean or corrected
     
-    # Obtener visitas al perfil (si existe el contador)
-    pulperia = await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 0})
-    profile_views = pulperia.get("profile_views", 0) if pulperia else 0
+    groups.sort(key=lambda group: group["results"][0]["score"] if group["results"] else -1.0, reverse=True)
+    return {"query": q, "did_you_mean": did_you_mean, "groups": groups}
+
+# ============================================
+# PULPERIA STATS READ MODEL
+# ============================================
+
+# db.pulperia_stats holds one counter document per pulperia, moved with $inc by the write paths
+PULPERIA_STATS_COUNTERS = ("sales_count", "products_count", "happy_customers", "profile_views", "unique_visitors")
+PULPERIA_STATS_RECONCILE_HOURS = float(os.environ.get('PULPERIA_STATS_RECONCILE_HOURS', '24'))
+
+async def bump_pulperia_stats(pulperia_id: str, **deltas: int):
+    """Apply counter deltas to a pulperia's stats document
+    
+    A pulperia without a stats document yet is reconciled from the source
+    collections instead, which already include the change being counted.
+    """
+    result = await db.pulperia_stats.update_one(
+        {"pulperia_id": pulperia_id},
+        {"$inc": deltas, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    if result.matched_count == 0:
+        await reconcile_pulperia_stats([pulperia_id])
+
+async def count_by_pulperia(collection, match: dict) -> Dict[str, int]:
+    """pulperia_id -> matching document count, from one grouped aggregation"""
+    counts = {}
+    async for row in collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$pulperia_id", "count": {"$sum": 1}}}
+    ]):
+        counts[row["_id"]] = row["count"]
+    return counts
+
+async def reconcile_pulperia_stats(pulperia_ids: Optional[List[str]] = None, batch_size: int = 500) -> int:
+    """Recompute stats documents from products, orders, reviews and pulperias
+    
+    Three grouped aggregations cover every pulperia at once (or only
+    `pulperia_ids`); the results are upserted with unordered bulk writes.
+    unique_visitors only exists as counted by the view flushes and is left
+    as is.
+    """
+    scope = {"pulperia_id": {"$in": pulperia_ids}} if pulperia_ids is not None else {}
+    products = await count_by_pulperia(db.products, scope)
+    sales = await count_by_pulperia(db.orders, {**scope, "status": "completed"})
+    happy = await count_by_pulperia(db.reviews, {**scope, "rating": {"$gte": 4}})
+    
+    now = datetime.now(timezone.utc).isoformat()
+    updated = 0
+    operations = []
+    projection = {"_id": 0, "pulperia_id": 1, "profile_views": 1, "is_verified": 1}
+    async for pulperia in db.pulperias.find(scope, projection).batch_size(batch_size):
+        pulperia_id = pulperia["pulperia_id"]
+        operations.append(UpdateOne({"pulperia_id": pulperia_id}, {"$set": {
+            "sales_count": sales.get(pulperia_id, 0),
+            "products_count": products.get(pulperia_id, 0),
+            "happy_customers": happy.get(pulperia_id, 0),
+            "profile_views": pulperia.get("profile_views", 0),
+            "is_verified": pulperia.get("is_verified", False),
+            "updated_at": now
+        }, "$setOnInsert": {"unique_visitors": 0}}, upsert=True))
+        
+        if len(operations) >= batch_size:
+            await db.pulperia_stats.bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+    
+    if operations:
+        await db.pulperia_stats.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    return updated
+
+async def pulperia_stats_reconcile_loop():
+    """Background task correcting any counter drift"""
+    while True:
+        try:
+            reconciled = await reconcile_pulperia_stats()
+            logger.info(f"[STATS] Reconciled stats for {reconciled} pulperias")
+        except Exception as e:
+            logger.warning(f"[STATS] Stats reconciliation failed: {e}")
+        await asyncio.sleep(PULPERIA_STATS_RECONCILE_HOURS * 3600)
+
+# ============================================
+# PROFILE VIEW COUNTER
+# ============================================
+
+# Views are buffered per worker, deduplicated per visitor and flushed in bulk
+VIEW_FLUSH_SECONDS = float(os.environ.get('VIEW_FLUSH_SECONDS', '10'))
+VIEW_DEDUPE_WINDOW_SECONDS = int(os.environ.get('VIEW_DEDUPE_WINDOW_SECONDS', '1800'))
+VIEW_DEDUPE_MAX_ENTRIES = int(os.environ.get('VIEW_DEDUPE_MAX_ENTRIES', '200000'))
+VISITOR_DAYS_RETENTION = int(os.environ.get('VISITOR_DAYS_RETENTION', '90'))
+# `day` of the sketch merging every day's registers of a pulperia; it never expires
+VISITOR_ALL_TIME = "all"
+# Peers whose X-Forwarded-For is believed (the load balancer); anyone else is identified by their own address
+TRUSTED_PROXIES = {address.strip() for address in os.environ.get('TRUSTED_PROXIES', '').split(',') if address.strip()}
+
+# HyperLogLog with 2^10 registers (about 3% standard error)
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+
+def visitor_hash(visitor: str) -> int:
+    return int.from_bytes(hashlib.blake2b(visitor.encode(), digest_size=8).digest(), "big")
+
+def hll_position(hashed: int) -> tuple:
+    """(register index, rank) of a 64-bit hash"""
+    index = hashed >> (64 - HLL_PRECISION)
+    remainder = hashed & ((1 << (64 - HLL_PRECISION)) - 1)
+    rank = (64 - HLL_PRECISION) - remainder.bit_length() + 1
+    return index, rank
+
+def merge_registers(target: Dict[str, int], registers: Dict[str, int]):
+    """Union of two sketches, in place: the larger rank of each register"""
+    for index, rank in registers.items():
+        if rank > target.get(index, 0):
+            target[index] = rank
+
+def hll_estimate(registers: Dict[str, int]) -> int:
+    """Distinct count from sparse registers ({"index": rank}); missing registers are 0"""
+    alpha = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+    zeros = HLL_REGISTERS - len(registers)
+    harmonic = zeros + sum(2.0 ** -rank for rank in registers.values())
+    estimate = alpha * HLL_REGISTERS * HLL_REGISTERS / harmonic
+    if estimate <= 2.5 * HLL_REGISTERS and zeros:
+        estimate = HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+    return int(round(estimate))
+
+def store_day(now: Optional[datetime] = None) -> str:
+    return (now or datetime.now(timezone.utc)).astimezone(STORE_TIMEZONE).date().isoformat()
+
+class ProfileViewBuffer:
+    """Pending view counts and visitor registers waiting for the next flush
+    
+    A visitor is counted once per pulperia within the dedupe window; every
+    visitor still updates that day's HyperLogLog registers, which only
+    change when a hash raises a register.
+    """
+    
+    def __init__(self, dedupe_seconds: int = VIEW_DEDUPE_WINDOW_SECONDS, max_entries: int = VIEW_DEDUPE_MAX_ENTRIES):
+        self.dedupe_seconds = dedupe_seconds
+        self.max_entries = max_entries
+        self.recent: "OrderedDict[tuple, float]" = OrderedDict()
+        self.views: Dict[str, int] = {}
+        self.registers: Dict[tuple, Dict[str, int]] = {}
+        self.counted = 0
+        self.deduplicated = 0
+    
+    def record(self, pulperia_id: str, visitor: str, now: Optional[float] = None) -> bool:
+        """Buffer one view; False when the visitor was already counted within the window"""
+        now = now if now is not None else time.monotonic()
+        hashed = visitor_hash(visitor)
+        
+        index, rank = hll_position(hashed)
+        merge_registers(self.registers.setdefault((pulperia_id, store_day()), {}), {str(index): rank})
+        
+        key = (pulperia_id, hashed)
+        seen_at = self.recent.get(key)
+        if seen_at is not None and now - seen_at < self.dedupe_seconds:
+            self.deduplicated += 1
+            return False
+        
+        self.recent[key] = now
+        self.recent.move_to_end(key)
+        while len(self.recent) > self.max_entries:
+            self.recent.popitem(last=False)
+        self.views[pulperia_id] = self.views.get(pulperia_id, 0) + 1
+        self.counted += 1
+        return True
+    
+    def drain(self) -> tuple:
+        """Hand over (views, registers) and start empty ones"""
+        views, registers = self.views, self.registers
+        self.views, self.registers = {}, {}
+        return views, registers
+    
+    def restore(self, views: Dict[str, int], registers: Dict[tuple, Dict[str, int]]):
+        """Put back what a failed flush could not write, merged with anything buffered since"""
+        for pulperia_id, count in views.items():
+            self.views[pulperia_id] = self.views.get(pulperia_id, 0) + count
+        for key, day_registers in registers.items():
+            merge_registers(self.registers.setdefault(key, {}), day_registers)
+    
+    def stats(self) -> dict:
+        return {
+            "pending_pulperias": len(self.views),
+            "pending_views": sum(self.views.values()),
+            "tracked_visitors": len(self.recent),
+            "counted": self.counted,
+            "deduplicated": self.deduplicated
+        }
+
+profile_view_buffer = ProfileViewBuffer()
+
+def client_address(request: Request) -> str:
+    """Address of the caller, taken from X-Forwarded-For only behind a trusted proxy
+    
+    The nearest hop not added by one of TRUSTED_PROXIES is used; anything
+    further left is client-supplied.
+    """
+    address = request.client.host if request.client else ""
+    if address in TRUSTED_PROXIES:
+        hops = [hop.strip() for hop in (request.headers.get("x-forwarded-for") or "").split(",") if hop.strip()]
+        for hop in reversed(hops):
+            address = hop
+            if hop not in TRUSTED_PROXIES:
+                break
+    return address
+
+async def request_visitor(request: Request, authorization: Optional[str], session_token: Optional[str]) -> str:
+    """Stable identity of whoever is viewing: their user when the session is valid, else their address
+    
+    Sessions are validated through get_current_user (and its session
+    cache); an invalid or made-up token counts as anonymous. Headers the
+    client controls, like the user agent, are not part of the identity.
+    """
+    if session_token or authorization:
+        try:
+            user = await get_current_user(authorization, session_token)
+            return f"user:{user.user_id}"
+        except HTTPException:
+            pass
+    return f"anon:{client_address(request)}"
+
+async def merge_visitor_registers(registers: Dict[tuple, Dict[str, int]]) -> Dict[str, int]:
+    """Merge buffered registers into db.profile_visitors and return each pulperia's all-time unique visitors
+    
+    Registers merge with $max into that day's sketch and into the
+    pulperia's all-time sketch, so flushes from several workers combine and
+    a visitor seen on several days is still one visitor.
+    """
+    if not registers:
+        return {}
+    
+    all_time: Dict[str, Dict[str, int]] = {}
+    for (pulperia_id, _), day_registers in registers.items():
+        merge_registers(all_time.setdefault(pulperia_id, {}), day_registers)
+    
+    expires_at = datetime.now(timezone.utc) + timedelta(days=VISITOR_DAYS_RETENTION)
+    await db.profile_visitors.bulk_write([
+        UpdateOne(
+            {"pulperia_id": pulperia_id, "day": day},
+            {
+                "$max": {f"registers.{index}": rank for index, rank in day_registers.items()},
+                "$setOnInsert": {"expires_at": expires_at}
+            },
+            upsert=True
+        )
+        for (pulperia_id, day), day_registers in registers.items()
+    ] + [
+        UpdateOne(
+            {"pulperia_id": pulperia_id, "day": VISITOR_ALL_TIME},
+            {"$max": {f"registers.{index}": rank for index, rank in pulperia_registers.items()}},
+            upsert=True
+        )
+        for pulperia_id, pulperia_registers in all_time.items()
+    ], ordered=False)
+    
+    return {
+        sketch["pulperia_id"]: hll_estimate(sketch.get("registers") or {})
+        async for sketch in db.profile_visitors.find(
+            {"pulperia_id": {"$in": list(all_time)}, "day": VISITOR_ALL_TIME},
+            {"_id": 0, "pulperia_id": 1, "registers": 1}
+        )
+    }
+
+async def flush_profile_views(buffer: Optional[ProfileViewBuffer] = None) -> int:
+    """Write buffered views and visitor sketches in bulk and check view achievements
+    
+    Views land on the pulperia (source of truth) and on its stats document,
+    and unique_visitors is raised to the all-time sketch estimate; a
+    pulperia whose counters crossed a badge threshold gets an achievement
+    check. Views or registers a failed write could not store go back into
+    the buffer for the next flush. The endpoint only records existing
+    pulperias; views of one deleted before the flush match nothing, and its
+    sketches stay behind.
+    """
+    buffer = buffer or profile_view_buffer
+    views, registers = buffer.drain()
+    if not views and not registers:
+        return 0
+    
+    if views:
+        pulperia_ids = list(views)
+        try:
+            await db.pulperias.bulk_write([
+                UpdateOne({"pulperia_id": pulperia_id}, {"$inc": {"profile_views": views[pulperia_id]}})
+                for pulperia_id in pulperia_ids
+            ], ordered=False)
+        except BulkWriteError as e:
+            failed = [pulperia_ids[error["index"]] for error in e.details.get("writeErrors", [])]
+            buffer.restore({pulperia_id: views[pulperia_id] for pulperia_id in failed}, registers)
+            raise
+        except Exception:
+            buffer.restore(views, registers)
+            raise
+    
+    try:
+        unique_visitors = await merge_visitor_registers(registers)
+    except Exception as e:
+        # $max merges are idempotent, so the registers are simply retried
+        buffer.restore({}, registers)
+        logger.warning(f"[VIEWS] Visitor sketch merge failed: {e}")
+        unique_visitors = {}
+    
+    pulperia_ids = list(set(views) | set(unique_visitors))
+    if not pulperia_ids:
+        return 0
+    
+    async def read_stats() -> Dict[str, dict]:
+        return {
+            stats["pulperia_id"]: stats
+            async for stats in db.pulperia_stats.find(
+                {"pulperia_id": {"$in": pulperia_ids}},
+                {"_id": 0, "pulperia_id": 1, "profile_views": 1, "unique_visitors": 1}
+            )
+        }
+    
+    before = await read_stats()
+    now = datetime.now(timezone.utc).isoformat()
+    updates = []
+    for pulperia_id in pulperia_ids:
+        update = {"$set": {"updated_at": now}}
+        if views.get(pulperia_id):
+            update["$inc"] = {"profile_views": views[pulperia_id]}
+        if pulperia_id in unique_visitors:
+            update["$max"] = {"unique_visitors": unique_visitors[pulperia_id]}
+        updates.append(UpdateOne({"pulperia_id": pulperia_id}, update))
+    await db.pulperia_stats.bulk_write(updates, ordered=False)
+    
+    # Other workers may write in between; comparing the read before with the one after never misses a crossing
+    after = await read_stats()
+    for pulperia_id in pulperia_ids:
+        stats = after.get(pulperia_id)
+        if stats is None:
+            # No stats document yet: build it, then add what only this path knows
+            await reconcile_pulperia_stats([pulperia_id])
+            result = await db.pulperia_stats.update_one(
+                {"pulperia_id": pulperia_id},
+                {"$max": {"unique_visitors": unique_visitors.get(pulperia_id, 0)}}
+            )
+            if result.matched_count:
+                schedule_achievement_check(pulperia_id, "profile_views")
+            continue
+        
+        previous = before.get(pulperia_id, {})
+        if any(
+            crossed_view_threshold(stat, previous.get(stat, 0), stats.get(stat, 0))
+            for stat in VIEW_THRESHOLDS
+        ):
+            schedule_achievement_check(pulperia_id, "profile_views")
+    return len(pulperia_ids)
+
+async def profile_view_flush_loop():
+    """Background task writing buffered views"""
+    while True:
+        await asyncio.sleep(VIEW_FLUSH_SECONDS)
+        try:
+            await flush_profile_views()
+        except Exception as e:
+            logger.warning(f"[VIEWS] View flush failed: {e}")
+
+# ============================================
+# LEADERBOARDS
+# ============================================
+
+LEADERBOARD_METRICS = ("sales", "rating", "growth")
+LEADERBOARD_GLOBAL = "global"
+LEADERBOARD_MAX_LIMIT = 100
+LEADERBOARD_REFRESH_SECONDS = int(os.environ.get('LEADERBOARD_REFRESH_SECONDS', '900'))
+# Completed sales compared between the last two windows of this many days
+LEADERBOARD_GROWTH_WINDOW_DAYS = 30
+LEADERBOARD_GROWTH_MIN_SALES = 5
+# Ratings are pulled toward the prior until a pulperia has a few reviews
+LEADERBOARD_RATING_PRIOR = 3.0
+LEADERBOARD_RATING_PRIOR_WEIGHT = 5
+LEADERBOARD_REGION_MAX_KM = 150
+# top_rank only counts boards with this many pulperias, and scores above what no activity gives
+LEADERBOARD_MIN_RANKED = int(os.environ.get('LEADERBOARD_MIN_RANKED', '30'))
+LEADERBOARD_BASELINES = {"sales": 0, "rating": LEADERBOARD_RATING_PRIOR, "growth": 0}
+
+# Departamentos, located by their cabecera; a pulperia belongs to the nearest one
+LEADERBOARD_REGIONS = {
+    "atlantida": (15.7597, -86.7822),
+    "choluteca": (13.3007, -87.1908),
+    "colon": (15.9163, -85.9537),
+    "comayagua": (14.4514, -87.6375),
+    "copan": (14.7667, -88.7833),
+    "cortes": (15.5042, -88.0250),
+    "el_paraiso": (13.9440, -86.8510),
+    "francisco_morazan": (14.0723, -87.1921),
+    "gracias_a_dios": (15.2667, -83.7667),
+    "intibuca": (14.3000, -88.1833),
+    "islas_de_la_bahia": (16.3167, -86.5333),
+    "la_paz": (14.3167, -87.6833),
+    "lempira": (14.5833, -88.5833),
+    "ocotepeque": (14.4333, -89.1833),
+    "olancho": (14.6667, -86.2167),
+    "santa_barbara": (14.9167, -88.2333),
+    "valle": (13.5333, -87.4833),
+    "yoro": (15.1333, -87.1333)
+}
+
+def pulperia_region(pulperia: dict) -> Optional[str]:
+    """Region of a pulperia, or None without a location or far from every region"""
+    coordinates = pulperia_coordinates(pulperia)
+    if coordinates is None:
+        return None
+    distance, region = min(
+        (haversine_km(coordinates[0], coordinates[1], lat, lng), region)
+        for region, (lat, lng) in LEADERBOARD_REGIONS.items()
+    )
+    return region if distance <= LEADERBOARD_REGION_MAX_KM else None
+
+def rating_score(rating_sum: float, review_count: int) -> float:
+    return round((rating_sum + LEADERBOARD_RATING_PRIOR * LEADERBOARD_RATING_PRIOR_WEIGHT) / (review_count + LEADERBOARD_RATING_PRIOR_WEIGHT), 4)
+
+class RankedBoard:
+    """Pulperias kept sorted by score, best first
+    
+    Keys are (-score, pulperia_id) in a SortedList, so score updates and
+    rank lookups are O(log n). Equal scores share a rank (1, 2, 2, 4).
+    """
     
-    # Verificar si está verificado
-    is_verified = pulperia.get("is_verified", False) if pulperia else False
+    def __init__(self):
+        self.keys = SortedList()
+        self.scores: Dict[str, float] = {}
+    
+    def __len__(self) -> int:
+        return len(self.keys)
+    
+    def set(self, pulperia_id: str, score: float):
+        if self.scores.get(pulperia_id) == score:
+            return
+        self.discard(pulperia_id)
+        self.keys.add((-score, pulperia_id))
+        self.scores[pulperia_id] = score
+    
+    def discard(self, pulperia_id: str):
+        score = self.scores.pop(pulperia_id, None)
+        if score is not None:
+            self.keys.remove((-score, pulperia_id))
+    
+    def rank_of_score(self, score: float) -> int:
+        return self.keys.bisect_left((-score,)) + 1
+    
+    def rank(self, pulperia_id: str) -> Optional[int]:
+        score = self.scores.get(pulperia_id)
+        return self.rank_of_score(score) if score is not None else None
+    
+    def page(self, limit: int, offset: int = 0) -> List[tuple]:
+        """(rank, pulperia_id, score) for one page of the board"""
+        return [(self.rank_of_score(-key), pulperia_id, -key) for key, pulperia_id in self.keys.islice(offset, offset + limit)]
+
+class Leaderboards:
+    """Sales, rating and growth boards, globally and per region
+    
+    Order completions and reviews update the raw values and move the
+    pulperia on its boards. Each worker only sees its own events, and
+    growth depends on the date, so everything is rebuilt from the database
+    every LEADERBOARD_REFRESH_SECONDS. top_rank is only taken from those
+    rebuilt boards.
+    """
+    
+    def __init__(self):
+        self.boards: Dict[tuple, RankedBoard] = {}
+        self.regions: Dict[str, Optional[str]] = {}
+        self.sales: Dict[str, int] = {}
+        self.ratings: Dict[str, tuple] = {}
+        self.daily_sales: Dict[str, Dict[str, int]] = {}
+        self.top_ranks: Dict[str, int] = {}
+        self.ready = False
+    
+    def board(self, metric: str, region: Optional[str] = None) -> RankedBoard:
+        return self.boards.setdefault((metric, region or LEADERBOARD_GLOBAL), RankedBoard())
+    
+    def place(self, metric: str, pulperia_id: str, score: Optional[float]):
+        """Put a pulperia on the global and regional board of a metric, or take it off (score None)"""
+        if pulperia_id not in self.regions:
+            return
+        region = self.regions[pulperia_id]
+        for board_region in (LEADERBOARD_GLOBAL, region) if region else (LEADERBOARD_GLOBAL,):
+            if score is None:
+                self.board(metric, board_region).discard(pulperia_id)
+            else:
+                self.board(metric, board_region).set(pulperia_id, score)
+    
+    def scores(self, pulperia_id: str) -> Dict[str, Optional[float]]:
+        sales = self.sales.get(pulperia_id, 0)
+        rating_sum, review_count = self.ratings.get(pulperia_id, (0, 0))
+        recent, _ = self.window_sales(pulperia_id)
+        return {
+            "sales": sales if sales > 0 else None,
+            "rating": rating_score(rating_sum, review_count) if review_count else None,
+            "growth": self.growth_rate(pulperia_id) if recent >= LEADERBOARD_GROWTH_MIN_SALES else None
+        }
+    
+    def refresh(self, pulperia_id: str, metrics: tuple = LEADERBOARD_METRICS):
+        scores = self.scores(pulperia_id)
+        for metric in metrics:
+            self.place(metric, pulperia_id, scores[metric])
+    
+    def set_pulperia(self, pulperia: dict):
+        """Register a pulperia (or its new location); suspended ones leave the boards"""
+        pulperia_id = pulperia["pulperia_id"]
+        if pulperia.get("is_suspended"):
+            self.remove(pulperia_id)
+            return
+        
+        region = pulperia_region(pulperia)
+        if pulperia_id in self.regions and self.regions[pulperia_id] == region:
+            return
+        for metric in LEADERBOARD_METRICS:
+            self.place(metric, pulperia_id, None)
+        self.regions[pulperia_id] = region
+        self.refresh(pulperia_id)
+    
+    def remove(self, pulperia_id: str):
+        for metric in LEADERBOARD_METRICS:
+            self.place(metric, pulperia_id, None)
+        self.regions.pop(pulperia_id, None)
+    
+    def forget(self, pulperia_id: str):
+        """Drop a deleted pulperia and its counters"""
+        self.remove(pulperia_id)
+        self.sales.pop(pulperia_id, None)
+        self.ratings.pop(pulperia_id, None)
+        self.daily_sales.pop(pulperia_id, None)
+    
+    def record_sale(self, pulperia_id: str, delta: int = 1, day: Optional[str] = None):
+        """Count (or uncount, delta -1) a completed order"""
+        self.sales[pulperia_id] = max(0, self.sales.get(pulperia_id, 0) + delta)
+        days = self.daily_sales.setdefault(pulperia_id, {})
+        day = day or store_day()
+        days[day] = max(0, days.get(day, 0) + delta)
+        self.refresh(pulperia_id, ("sales", "growth"))
+    
+    def set_rating(self, pulperia_id: str, rating_sum: float, review_count: int):
+        self.ratings[pulperia_id] = (rating_sum, review_count)
+        self.refresh(pulperia_id, ("rating",))
+    
+    def window_sales(self, pulperia_id: str, today: Optional[str] = None) -> tuple:
+        """Completed sales in the current and in the previous growth window"""
+        today_date = datetime.fromisoformat(today).date() if today else datetime.fromisoformat(store_day()).date()
+        recent_start = (today_date - timedelta(days=LEADERBOARD_GROWTH_WINDOW_DAYS - 1)).isoformat()
+        previous_start = (today_date - timedelta(days=2 * LEADERBOARD_GROWTH_WINDOW_DAYS - 1)).isoformat()
+        
+        recent = previous = 0
+        for day, count in self.daily_sales.get(pulperia_id, {}).items():
+            if day >= recent_start:
+                recent += count
+            elif day >= previous_start:
+                previous += count
+        return recent, previous
+    
+    def growth_rate(self, pulperia_id: str, today: Optional[str] = None) -> float:
+        """Percent change of completed sales between the last two windows"""
+        recent, previous = self.window_sales(pulperia_id, today)
+        return round((recent - previous) / max(previous, 1) * 100, 1)
+    
+    def rank(self, metric: str, pulperia_id: str, region: Optional[str] = None) -> Optional[int]:
+        return self.board(metric, region).rank(pulperia_id)
+    
+    def compute_top_ranks(self) -> Dict[str, int]:
+        """Best global rank of each pulperia, skipping small boards and scores at the baseline"""
+        top_ranks = {}
+        for metric in LEADERBOARD_METRICS:
+            board = self.board(metric)
+            if len(board) < LEADERBOARD_MIN_RANKED:
+                continue
+            for rank, pulperia_id, score in board.page(len(board)):
+                if score <= LEADERBOARD_BASELINES[metric]:
+                    break
+                top_ranks[pulperia_id] = min(rank, top_ranks.get(pulperia_id, rank))
+        return top_ranks
+    
+    def top_rank(self, pulperia_id: str) -> int:
+        """Best global rank of a pulperia as of the last rebuild; 999 when unranked"""
+        return self.top_ranks.get(pulperia_id, 999)
+    
+    async def rebuild(self, batch_size: int = 500):
+        """Recompute every board from pulperias, pulperia_stats and recent orders"""
+        fresh = Leaderboards()
+        
+        async for stats in db.pulperia_stats.find({}, {"_id": 0, "pulperia_id": 1, "sales_count": 1}).batch_size(batch_size):
+            fresh.sales[stats["pulperia_id"]] = stats.get("sales_count", 0)
+        
+        # Grouped by UTC hour so every bucket maps to one store-local day
+        since = datetime.now(timezone.utc) - timedelta(days=2 * LEADERBOARD_GROWTH_WINDOW_DAYS + 1)
+        hourly = db.orders.aggregate([
+            {"$match": {"status": "completed", "updated_at": {"$gte": since.isoformat()}}},
+            {"$group": {"_id": {"pulperia_id": "$pulperia_id", "hour": {"$substr": ["$updated_at", 0, 13]}}, "count": {"$sum": 1}}}
+        ])
+        async for row in hourly:
+            hour = datetime.fromisoformat(row["_id"]["hour"] + ":00:00+00:00")
+            days = fresh.daily_sales.setdefault(row["_id"]["pulperia_id"], {})
+            day = store_day(hour)
+            days[day] = days.get(day, 0) + row["count"]
+        
+        projection = {"_id": 0, "pulperia_id": 1, "location": 1, "is_suspended": 1, "rating": 1, "rating_sum": 1, "review_count": 1}
+        async for pulperia in db.pulperias.find({}, projection).batch_size(batch_size):
+            review_count = pulperia.get("review_count") or 0
+            rating_sum = pulperia.get("rating_sum", (pulperia.get("rating") or 0) * review_count)
+            fresh.ratings[pulperia["pulperia_id"]] = (rating_sum, review_count)
+            fresh.set_pulperia(pulperia)
+        
+        self.boards = fresh.boards
+        self.regions = fresh.regions
+        self.sales = fresh.sales
+        self.ratings = fresh.ratings
+        self.daily_sales = fresh.daily_sales
+        self.top_ranks = fresh.compute_top_ranks()
+        self.ready = True
+    
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "pulperias": len(self.regions),
+            "boards": {f"{metric}:{region}": len(board) for (metric, region), board in self.boards.items() if board}
+        }
+
+leaderboards = Leaderboards()
+
+async def leaderboard_refresh_loop():
+    """Background task rebuilding the boards"""
+    while True:
+        try:
+            await leaderboards.rebuild()
+            await award_rank_achievements()
+        except Exception as e:
+            logger.warning(f"[LEADERBOARDS] Rebuild failed: {e}")
+        await asyncio.sleep(LEADERBOARD_REFRESH_SECONDS)
+
+@api_router.get("/leaderboards")
+async def get_leaderboards(metric: str = "sales", region: Optional[str] = None, limit: int = 20, offset: int = 0, pulperia_id: Optional[str] = None):
+    """One page of a leaderboard, plus the position of `pulperia_id` when given"""
+    if metric not in LEADERBOARD_METRICS:
+        raise HTTPException(status_code=400, detail="Métrica no válida")
+    if region is not None and region not in LEADERBOARD_REGIONS:
+        raise HTTPException(status_code=400, detail="Región no válida")
+    if not leaderboards.ready:
+        # Built in the background at startup; never rebuilt on the request path
+        raise HTTPException(status_code=503, detail="Las clasificaciones se están calculando, intenta de nuevo en un momento", headers={"Retry-After": "30"})
+    
+    board = leaderboards.board(metric, region)
+    page = board.page(max(1, min(limit, LEADERBOARD_MAX_LIMIT)), max(0, offset))
+    pulperias = {
+        pulperia["pulperia_id"]: pulperia
+        async for pulperia in db.pulperias.find(
+            {"pulperia_id": {"$in": [entry_id for _, entry_id, _ in page]}},
+            {"_id": 0, "pulperia_id": 1, "name": 1, "logo_url": 1, "rating": 1}
+        )
+    }
+    
+    response = {
+        "metric": metric,
+        "region": region or LEADERBOARD_GLOBAL,
+        "total": len(board),
+        "entries": [
+            {"rank": rank, "score": score, **pulperias.get(entry_id, {"pulperia_id": entry_id})}
+            for rank, entry_id, score in page
+        ]
+    }
+    if pulperia_id is not None:
+        response["position"] = {
+            "pulperia_id": pulperia_id,
+            "rank": board.rank(pulperia_id),
+            "score": board.scores.get(pulperia_id),
+            "region": leaderboards.regions.get(pulperia_id)
+        }
+    return response
+
+# ============================================
+# ACHIEVEMENT SYSTEM ENDPOINTS
+# ============================================
+
+# Which stats each achievement event can change; only badges depending on them are re-checked
+ACHIEVEMENT_EVENT_STATS = {
+    "order_completed": {"sales_count"},
+    "product_created": {"products_count"},
+    "review_posted": {"happy_customers"},
+    "verified": {"is_verified"},
+    "profile_views": {"profile_views", "unique_visitors"},
+    "leaderboards_rebuilt": {"top_rank"}
+}
+ACHIEVEMENT_BADGES_BY_STAT = {
+    stat: [badge_id for badge_id, definition in ACHIEVEMENT_DEFINITIONS.items() if stat in definition.get("criteria", {})]
+    for stat in {key for definition in ACHIEVEMENT_DEFINITIONS.values() for key in definition.get("criteria", {})}
+}
+
+# View counter values at which a flush can unlock a badge
+VIEW_THRESHOLDS = {
+    stat: sorted({
+        definition["criteria"][stat]
+        for definition in ACHIEVEMENT_DEFINITIONS.values()
+        if stat in definition.get("criteria", {})
+    })
+    for stat in ("profile_views", "unique_visitors")
+}
+# Worst global rank any badge rewards; the rebuild only re-checks pulperias at or above it
+RANK_THRESHOLD = max(
+    (definition["criteria"]["top_rank"] for definition in ACHIEVEMENT_DEFINITIONS.values() if "top_rank" in definition.get("criteria", {})),
+    default=0
+)
+
+def crossed_view_threshold(stat: str, before: int, after: int) -> bool:
+    return any(before < threshold <= after for threshold in VIEW_THRESHOLDS[stat])
+
+async def calculate_pulperia_stats(pulperia_id: str) -> dict:
+    """Statistics for a pulperia to determine achievements, from its stats document"""
+    stats = await db.pulperia_stats.find_one({"pulperia_id": pulperia_id}, {"_id": 0, "updated_at": 0})
+    if stats is None:
+        await reconcile_pulperia_stats([pulperia_id])
+        stats = await db.pulperia_stats.find_one({"pulperia_id": pulperia_id}, {"_id": 0, "updated_at": 0}) or {}
     
     return {
         "pulperia_id": pulperia_id,
-        "products_count": products_count,
-        "sales_count": sales_count,
-        "happy_customers": happy_customers,
-        "profile_views": profile_views,
-        "is_verified": is_verified,
+        **{counter: stats.get(counter, 0) for counter in PULPERIA_STATS_COUNTERS},
+        "is_verified": stats.get("is_verified", False),
         "avg_response_time": 999,  # Placeholder
-        "growth_rate": 0,  # Placeholder
+        "growth_rate": leaderboards.growth_rate(pulperia_id),
         "community_score": 0,  # Placeholder
-        "top_rank": 999  # Placeholder
+        "top_rank": leaderboards.top_rank(pulperia_id)
     }
 
-async def check_and_award_achievements(pulperia_id: str) -> list:
-    """Check stats and award any new achievements"""
-    stats = await calculate_pulperia_stats(pulperia_id)
+def criteria_met(criteria: dict, stats: dict) -> bool:
+    """Whether stats satisfy every criterion of an achievement"""
+    for key, value in criteria.items():
+        stat_value = stats.get(key, ACHIEVEMENT_STAT_DEFAULTS.get(key, 0))
+        
+        if key == "is_verified":
+            if stat_value != value:
+                return False
+        elif key in ["avg_response_time", "top_rank"]:
+            # Menor es mejor (top_rank 1 es mejor que 10)
+            if stat_value > value:
+                return False
+        else:
+            # Mayor es mejor
+            if stat_value < value:
+                return False
+    return True
+
+async def check_and_award_achievements(pulperia_id: str, event: Optional[str] = None) -> list:
+    """Check stats and award any new achievements
+    
+    With an event, only the badges whose criteria use a stat that event
+    changes are considered; stats are not even read once all of them are
+    unlocked.
+    """
+    if event is None:
+        candidates = list(ACHIEVEMENT_DEFINITIONS)
+    else:
+        candidates = list(dict.fromkeys(
+            badge_id
+            for stat in ACHIEVEMENT_EVENT_STATS[event]
+            for badge_id in ACHIEVEMENT_BADGES_BY_STAT.get(stat, [])
+        ))
+    if not candidates:
+        return []
     
     # Obtener logros ya desbloqueados
     existing_achievements = await db.achievements.find(
-        {"pulperia_id": pulperia_id},
+        {"pulperia_id": pulperia_id, "badge_id": {"$in": candidates}},
         {"_id": 0, "badge_id": 1}
-    ).to_list(100)
+    ).to_list(len(candidates))
     existing_badges = {a["badge_id"] for a in existing_achievements}
+    pending = [badge_id for badge_id in candidates if badge_id not in existing_badges]
+    if not pending:
+        return []
+    
+    stats = await calculate_pulperia_stats(pulperia_id)
     
     new_achievements = []
     
     # Verificar cada logro
-    for badge_id, definition in ACHIEVEMENT_DEFINITIONS.items():
-        if badge_id in existing_badges:
+    for badge_id in pending:
+        definition = ACHIEVEMENT_DEFINITIONS[badge_id]
+        if not criteria_met(definition.get("criteria", {}), stats):
             continue
         
-        criteria = definition.get("criteria", {})
-        unlocked = True
-        
-        for key, value in criteria.items():
-            stat_value = stats.get(key, 0)
+        achievement_id = f"achievement_{uuid.uuid4().hex[:12]}"
+        achievement_doc = {
+            "achievement_id": achievement_id,
+            "pulperia_id": pulperia_id,
+            "badge_id": badge_id,
+            "unlocked_at": datetime.now(timezone.utc).isoformat()
+        }
+        try:
+            await db.achievements.insert_one(achievement_doc)
+        except DuplicateKeyError:
+            # A concurrent event awarded it first
+            continue
+        new_achievements.append({
+            "badge_id": badge_id,
+            "name": definition["name"],
+            "description": definition["description"],
+            "tier": definition.get("tier", "gold"),
+            "unlocked_at": achievement_doc["unlocked_at"]
+        })
+    
+    return new_achievements
+
+def schedule_achievement_check(pulperia_id: str, event: str):
+    """Evaluate the achievements an event can unlock without delaying the response"""
+    async def run_check():
+        try:
+            new_achievements = await check_and_award_achievements(pulperia_id, event)
+            if new_achievements:
+                logger.info(f"[ACHIEVEMENTS] {pulperia_id} unlocked {[a['badge_id'] for a in new_achievements]} on {event}")
+        except Exception as e:
+            logger.warning(f"[ACHIEVEMENTS] Check after {event} failed for {pulperia_id}: {e}")
+    
+    run_in_background(run_check())
+
+async def award_rank_achievements():
+    """Check the rank badges of the pulperias the freshly rebuilt boards rank high enough"""
+    for pulperia_id, rank in list(leaderboards.top_ranks.items()):
+        if rank > RANK_THRESHOLD:
+            continue
+        new_achievements = await check_and_award_achievements(pulperia_id, "leaderboards_rebuilt")
+        if new_achievements:
+            logger.info(f"[ACHIEVEMENTS] {pulperia_id} unlocked {[a['badge_id'] for a in new_achievements]} at rank {rank}")
+
+# Batch sweep: every pulperia against every definition at once
+ACHIEVEMENT_STAT_DEFAULTS = {"avg_response_time": 999, "growth_rate": 0, "community_score": 0, "top_rank": 999}
+ACHIEVEMENT_SWEEP_INSERT_BATCH = 5000
+ACHIEVEMENT_SWEEP_SAMPLE_SIZE = 20
+
+async def load_pulperia_metrics(batch_size: int = 5000) -> tuple:
+    """(pulperia_ids, {stat: array aligned with pulperia_ids}) from grouped aggregations over the source collections
+    
+    unique_visitors has no source collection and is read from the stats
+    documents; growth_rate and top_rank come from the leaderboards.
+    """
+    products = await count_by_pulperia(db.products, {})
+    sales = await count_by_pulperia(db.orders, {"status": "completed"})
+    happy = await count_by_pulperia(db.reviews, {"rating": {"$gte": 4}})
+    
+    pulperia_ids, views, verified = [], [], []
+    projection = {"_id": 0, "pulperia_id": 1, "profile_views": 1, "is_verified": 1}
+    async for pulperia in db.pulperias.find({}, projection).batch_size(batch_size):
+        pulperia_ids.append(pulperia["pulperia_id"])
+        views.append(pulperia.get("profile_views") or 0)
+        verified.append(bool(pulperia.get("is_verified")))
+    
+    unique_visitors = {
+        stats["pulperia_id"]: stats.get("unique_visitors", 0)
+        async for stats in db.pulperia_stats.find({}, {"_id": 0, "pulperia_id": 1, "unique_visitors": 1}).batch_size(batch_size)
+    }
+    
+    metrics = {
+        "unique_visitors": np.fromiter((unique_visitors.get(p, 0) for p in pulperia_ids), dtype=np.int64, count=len(pulperia_ids)),
+        "products_count": np.fromiter((products.get(p, 0) for p in pulperia_ids), dtype=np.int64, count=len(pulperia_ids)),
+        "sales_count": np.fromiter((sales.get(p, 0) for p in pulperia_ids), dtype=np.int64, count=len(pulperia_ids)),
+        "happy_customers": np.fromiter((happy.get(p, 0) for p in pulperia_ids), dtype=np.int64, count=len(pulperia_ids)),
+        "profile_views": np.array(views, dtype=np.int64),
+        "is_verified": np.array(verified, dtype=bool),
+        "growth_rate": np.fromiter((leaderboards.growth_rate(p) for p in pulperia_ids), dtype=np.float64, count=len(pulperia_ids)),
+        "top_rank": np.fromiter((leaderboards.top_rank(p) for p in pulperia_ids), dtype=np.int64, count=len(pulperia_ids))
+    }
+    return pulperia_ids, metrics
+
+def achievement_masks(metrics: Dict[str, "np.ndarray"], size: int) -> Dict[str, "np.ndarray"]:
+    """badge_id -> boolean array of the pulperias meeting its criteria, same rules as criteria_met"""
+    masks = {}
+    for badge_id, definition in ACHIEVEMENT_DEFINITIONS.items():
+        mask = np.ones(size, dtype=bool)
+        for key, value in definition.get("criteria", {}).items():
+            column = metrics.get(key)
+            if column is None:
+                column = np.full(size, ACHIEVEMENT_STAT_DEFAULTS.get(key, 0))
             
             if key == "is_verified":
-                if stat_value != value:
-                    unlocked = False
-                    break
+                mask &= column == value
             elif key in ["avg_response_time", "top_rank"]:
-                # Menor es mejor (top_rank 1 es mejor que 10)
-                if stat_value > value:
-                    unlocked = False
-                    break
+                mask &= column <= value
             else:
-                # Mayor es mejor
-                if stat_value < value:
-                    unlocked = False
-                    break
-        
-        if unlocked:
-            achievement_id = f"achievement_{uuid.uuid4().hex[:12]}"
-            achievement_doc = {
-                "achievement_id": achievement_id,
-                "pulperia_id": pulperia_id,
+                mask &= column >= value
+        masks[badge_id] = mask
+    return masks
+
+async def sweep_achievements(dry_run: bool = True) -> dict:
+    """Award every achievement any pulperia qualifies for but does not have yet
+    
+    Metrics come from a few grouped aggregations, criteria are evaluated as
+    array comparisons and the new awards go in with unordered insert_many,
+    so the unique (pulperia_id, badge_id) index drops any awarded
+    concurrently. dry_run only reports what would be inserted.
+    """
+    started = time.perf_counter()
+    pulperia_ids, metrics = await load_pulperia_metrics()
+    size = len(pulperia_ids)
+    masks = achievement_masks(metrics, size)
+    
+    # Mark what is already unlocked
+    position = {pulperia_id: i for i, pulperia_id in enumerate(pulperia_ids)}
+    unlocked = {badge_id: np.zeros(size, dtype=bool) for badge_id in ACHIEVEMENT_DEFINITIONS}
+    async for achievement in db.achievements.find({}, {"_id": 0, "pulperia_id": 1, "badge_id": 1}).batch_size(5000):
+        i = position.get(achievement["pulperia_id"])
+        if i is not None and achievement["badge_id"] in unlocked:
+            unlocked[achievement["badge_id"]][i] = True
+    
+    new_awards = {badge_id: np.flatnonzero(mask & ~unlocked[badge_id]) for badge_id, mask in masks.items()}
+    sample = [
+        {"pulperia_id": pulperia_ids[i], "badge_id": badge_id}
+        for badge_id, indices in new_awards.items() for i in indices[:ACHIEVEMENT_SWEEP_SAMPLE_SIZE]
+    ][:ACHIEVEMENT_SWEEP_SAMPLE_SIZE]
+    
+    inserted = 0
+    if not dry_run:
+        unlocked_at = datetime.now(timezone.utc).isoformat()
+        new_docs = [
+            {
+                "achievement_id": f"achievement_{uuid.uuid4().hex[:12]}",
+                "pulperia_id": pulperia_ids[i],
                 "badge_id": badge_id,
-                "unlocked_at": datetime.now(timezone.utc).isoformat()
+                "unlocked_at": unlocked_at
             }
-            await db.achievements.insert_one(achievement_doc)
-            new_achievements.append({
-                "badge_id": badge_id,
-                "name": definition["name"],
-                "description": definition["description"],
-                "tier": definition.get("tier", "gold"),
-                "unlocked_at": achievement_doc["unlocked_at"]
-            })
+            for badge_id, indices in new_awards.items() for i in indices
+        ]
+        for start in range(0, len(new_docs), ACHIEVEMENT_SWEEP_INSERT_BATCH):
+            batch = new_docs[start:start + ACHIEVEMENT_SWEEP_INSERT_BATCH]
+            try:
+                result = await db.achievements.insert_many(batch, ordered=False)
+                inserted += len(result.inserted_ids)
+            except BulkWriteError as e:
+                inserted += e.details.get("nInserted", 0)
     
-    return new_achievements
+    return {
+        "dry_run": dry_run,
+        "pulperias": size,
+        "new_achievements": sum(int(indices.size) for indices in new_awards.values()),
+        "inserted": inserted,
+        "by_badge": {badge_id: int(indices.size) for badge_id, indices in new_awards.items() if indices.size},
+        "sample": sample,
+        "elapsed_seconds": round(time.perf_counter() - started, 3)
+    }
 
 @api_router.get("/achievements/definitions")
 async def get_achievement_definitions():
@@ -1266,15 +4964,14 @@ async def get_pulperia_achievements(pulperia_id: str):
     return result
 
 @api_router.get("/pulperias/{pulperia_id}/stats")
-async def get_pulperia_stats(pulperia_id: str, auto_check: bool = True):
-    """Get statistics for a pulperia and optionally check achievements"""
-    stats = await calculate_pulperia_stats(pulperia_id)
+async def get_pulperia_stats(pulperia_id: str):
+    """Get statistics for a pulperia
     
-    # Auto-check achievements when stats are fetched
-    if auto_check:
-        await check_and_award_achievements(pulperia_id)
-    
-    return stats
+    Read only: achievements are evaluated when orders complete, products
+    are created, reviews are posted, the store is verified or its views
+    cross a threshold.
+    """
+    return await calculate_pulperia_stats(pulperia_id)
 
 @api_router.post("/pulperias/{pulperia_id}/check-achievements")
 async def check_achievements(pulperia_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -1297,16 +4994,16 @@ async def check_achievements(pulperia_id: str, authorization: Optional[str] = He
     }
 
 @api_router.post("/pulperias/{pulperia_id}/increment-views")
-async def increment_profile_views(pulperia_id: str):
-    """Increment the profile view counter for a pulperia"""
-    result = await db.pulperias.update_one(
-        {"pulperia_id": pulperia_id},
-        {"$inc": {"profile_views": 1}}
-    )
+async def increment_profile_views(pulperia_id: str, request: Request, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    """Count a profile view
     
-    if result.modified_count == 0:
+    Buffered in memory and written every VIEW_FLUSH_SECONDS; repeat views
+    from the same visitor within VIEW_DEDUPE_WINDOW_SECONDS are not counted.
+    """
+    if pulperia_grid.get(pulperia_id) is None and not await db.pulperias.find_one({"pulperia_id": pulperia_id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="Pulpería no encontrada")
     
+    profile_view_buffer.record(pulperia_id, await request_visitor(request, authorization, session_token))
     return {"message": "Vista registrada"}
 
 @api_router.post("/admin/pulperias/{pulperia_id}/verify")
@@ -1321,9 +5018,10 @@ async def verify_pulperia(pulperia_id: str, authorization: Optional[str] = Heade
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Pulpería no encontrada")
+    await db.pulperia_stats.update_one({"pulperia_id": pulperia_id}, {"$set": {"is_verified": True}})
     
     # Check achievements after verification
-    new_achievements = await check_and_award_achievements(pulperia_id)
+    new_achievements = await check_and_award_achievements(pulperia_id, "verified")
     
     return {
         "message": "Pulpería verificada",
@@ -1626,7 +5324,7 @@ async def get_favorites(authorization: Optional[str] = Header(None), session_tok
     if not pulperia_ids:
         return []
     
-    pulperias = await db.pulperias.find({"pulperia_id": {"$in": pulperia_ids}}, {"_id": 0}).to_list(100)
+    pulperias = await db.pulperias.find({"pulperia_id": {"$in": pulperia_ids}}, PUBLIC_PROJECTION).to_list(100)
     return pulperias
 
 @api_router.post("/favorites/{pulperia_id}")
@@ -1702,6 +5400,7 @@ async def create_order(order_data: OrderCreate, authorization: Optional[str] = H
     }
     
     await db.orders.insert_one(order_doc)
+    search_suggestions.record_order(order_doc)
     
     order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     await broadcast_order_update(order, "new_order")
@@ -1721,15 +5420,27 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate, a
     if pulperia["owner_user_id"] != user.user_id and order["customer_user_id"] != user.user_id:
         raise HTTPException(status_code=403, detail="No tienes permiso para actualizar esta orden")
     
-    await db.orders.update_one(
+    # The status read back from this same write decides whether a sale is counted
+    previous = await db.orders.find_one_and_update(
         {"order_id": order_id},
-        {"$set": {"status": status_update.status, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": status_update.status, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0, "status": 1},
+        return_document=ReturnDocument.BEFORE
     )
+    was_completed = previous is not None and previous["status"] == "completed"
     
     updated_order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     event_type = "cancelled" if status_update.status == "cancelled" else "status_changed"
     await broadcast_order_update(updated_order, event_type)
     
+    if status_update.status == "completed" and not was_completed:
+        await bump_pulperia_stats(order["pulperia_id"], sales_count=1)
+        leaderboards.record_sale(order["pulperia_id"], 1)
+        schedule_achievement_check(order["pulperia_id"], "order_completed")
+    elif was_completed and status_update.status != "completed":
+        await bump_pulperia_stats(order["pulperia_id"], sales_count=-1)
+        leaderboards.record_sale(order["pulperia_id"], -1, store_day(datetime.fromisoformat(order["updated_at"])) if order.get("updated_at") else None)
+    
     return updated_order
 
 @api_router.get("/orders/completed")
@@ -1929,13 +5640,9 @@ async def get_jobs(category: Optional[str] = None, search: Optional[str] = None)
     if category:
         query["category"] = category
     if search:
-        pattern = create_search_pattern(search)
-        query["$or"] = [
-            {"title": {"$regex": pattern, "$options": "i"}},
-            {"description": {"$regex": pattern, "$options": "i"}}
-        ]
+        query.update(prefix_search_query("jobs", search))
     
-    jobs = await db.jobs.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
+    jobs = await db.jobs.find(query, PUBLIC_PROJECTION).sort("created_at", -1).to_list(100)
     return jobs
 
 @api_router.post("/jobs")
@@ -1960,11 +5667,12 @@ async def create_job(job_data: JobCreate, authorization: Optional[str] = Header(
         "pulperia_name": pulperia_name,
         "pulperia_logo": pulperia_logo,
         **{k: v for k, v in job_data.model_dump().items() if k != 'pulperia_id'},
+        **build_search_fields("jobs", job_data.model_dump()),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
     await db.jobs.insert_one(job_doc)
-    return await db.jobs.find_one({"job_id": job_id}, {"_id": 0})
+    return await db.jobs.find_one({"job_id": job_id}, PUBLIC_PROJECTION)
 
 @api_router.delete("/jobs/{job_id}")
 async def delete_job(job_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -1993,13 +5701,9 @@ async def get_services(category: Optional[str] = None, search: Optional[str] = N
     if category:
         query["category"] = category
     if search:
-        pattern = create_search_pattern(search)
-        query["$or"] = [
-            {"title": {"$regex": pattern, "$options": "i"}},
-            {"description": {"$regex": pattern, "$options": "i"}}
-        ]
+        query.update(prefix_search_query("services", search))
     
-    services = await db.services.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
+    services = await db.services.find(query, PUBLIC_PROJECTION).sort("created_at", -1).to_list(100)
     return services
 
 @api_router.post("/services")
@@ -2013,11 +5717,12 @@ async def create_service(service_data: ServiceCreate, authorization: Optional[st
         "provider_user_id": user.user_id,
         "provider_name": user.name,
         **service_data.model_dump(),
+        **build_search_fields("services", service_data.model_dump()),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
     await db.services.insert_one(service_doc)
-    return await db.services.find_one({"service_id": service_id}, {"_id": 0})
+    return await db.services.find_one({"service_id": service_id}, PUBLIC_PROJECTION)
 
 @api_router.delete("/services/{service_id}")
 async def delete_service(service_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -2062,7 +5767,7 @@ async def get_featured_pulperias():
     
     featured = []
     for ad in active_ads:
-        pulperia = await db.pulperias.find_one({"pulperia_id": ad["pulperia_id"]}, {"_id": 0})
+        pulperia = await db.pulperias.find_one({"pulperia_id": ad["pulperia_id"]}, PUBLIC_PROJECTION)
         if pulperia:
             pulperia["ad_plan"] = ad["plan"]
             featured.append(pulperia)
@@ -2087,7 +5792,7 @@ async def get_recommended_pulperias():
     
     recommended = []
     for ad in active_ads:
-        pulperia = await db.pulperias.find_one({"pulperia_id": ad["pulperia_id"]}, {"_id": 0})
+        pulperia = await db.pulperias.find_one({"pulperia_id": ad["pulperia_id"]}, PUBLIC_PROJECTION)
         if pulperia:
             pulperia["ad_plan"] = "recomendado"
             pulperia["ad_end_date"] = ad.get("end_date")
@@ -2161,9 +5866,60 @@ async def get_ad_assignment_log():
 async def admin_get_all_pulperias(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     """Admin: Get all pulperias for ad management"""
     await get_admin_user(authorization, session_token)
-    pulperias = await db.pulperias.find({}, {"_id": 0}).sort("created_at", -1).to_list(500)
+    pulperias = await db.pulperias.find({}, PUBLIC_PROJECTION).sort("created_at", -1).to_list(500)
     return pulperias
 
+@api_router.get("/admin/metrics")
+async def admin_get_metrics(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    """Admin: Get in-process cache and performance counters"""
+    await get_admin_user(authorization, session_token)
+    
+    return {
+        "session_cache": session_cache.stats(),
+        "upstream": upstream.stats(),
+        "product_search_index": product_search_index.stats(),
+        "pulperia_vocabulary": pulperia_vocabulary.stats(),
+        "search_result_cache": search_result_cache.stats(),
+        "category_facets": category_facets.stats(),
+        "pulperia_grid": pulperia_grid.stats(),
+        "map_tile_cache": map_tile_cache.stats(),
+        "open_map_tile_cache": open_map_tile_cache.stats(),
+        "profile_view_buffer": profile_view_buffer.stats(),
+        "leaderboards": leaderboards.stats(),
+        "search_suggestions": {**search_suggestions.stats(), "latency": suggest_latency.snapshot().get("suggest")}
+    }
+
+@api_router.post("/admin/maintenance/backfill-search-fields")
+async def admin_backfill_search_fields(only_missing: bool = True, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    """Admin: Write normalized search fields on existing products, pulperias, jobs and services"""
+    await get_admin_user(authorization, session_token)
+    
+    updated = {}
+    for collection_name in SEARCH_FIELD_SOURCES:
+        updated[collection_name] = await backfill_search_fields(collection_name, only_missing)
+    
+    return {"message": "Campos de búsqueda actualizados", "updated": updated}
+
+@api_router.post("/admin/maintenance/rebuild-review-counters")
+async def admin_rebuild_review_counters(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    """Admin: Recompute every pulperia's rating counters and star histogram from the reviews"""
+    await get_admin_user(authorization, session_token)
+    updated = await rebuild_review_counters()
+    return {"message": "Contadores de reseñas reconstruidos", "updated": updated}
+
+@api_router.post("/admin/maintenance/reconcile-pulperia-stats")
+async def admin_reconcile_pulperia_stats(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    """Admin: Recompute every pulperia's stats document from the source collections"""
+    await get_admin_user(authorization, session_token)
+    updated = await reconcile_pulperia_stats()
+    return {"message": "Estadísticas recalculadas", "updated": updated}
+
+@api_router.post("/admin/maintenance/achievement-sweep")
+async def admin_achievement_sweep(dry_run: bool = True, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    """Admin: Evaluate every achievement for every pulperia; dry_run (default) only reports the diff"""
+    await get_admin_user(authorization, session_token)
+    return await sweep_achievements(dry_run)
+
 @api_router.get("/admin/ads")
 async def admin_get_all_ads(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     """Admin: Get all advertisements"""
@@ -2293,6 +6049,7 @@ async def admin_suspend_pulperia(pulperia_id: str, reason: str = "", days: int =
             "suspend_days": days
         }}
     )
+    index_pulperia_change(await db.pulperias.find_one({"pulperia_id": pulperia_id}, PUBLIC_PROJECTION))
     
     # Create admin message to notify pulperia
     message_id = f"msg_{uuid.uuid4().hex[:12]}"
@@ -2325,6 +6082,7 @@ async def admin_unsuspend_pulperia(pulperia_id: str, authorization: Optional[str
         {"pulperia_id": pulperia_id},
         {"$set": {"is_suspended": False, "suspension_reason": None, "suspend_until": None, "suspend_days": None}}
     )
+    index_pulperia_change(await db.pulperias.find_one({"pulperia_id": pulperia_id}, PUBLIC_PROJECTION))
     
     # Create admin message to notify pulperia
     message_id = f"msg_{uuid.uuid4().hex[:12]}"
@@ -2601,6 +6359,8 @@ async def admin_clear_orders(authorization: Optional[str] = Header(None), sessio
     await get_admin_user(authorization, session_token)
     
     result = await db.orders.delete_many({})
+    await db.pulperia_stats.update_many({}, {"$set": {"sales_count": 0}})
+    await leaderboards.rebuild()
     return {"message": f"Se eliminaron {result.deleted_count} órdenes del sistema"}
 
 @api_router.delete("/admin/clear-data")
@@ -2613,6 +6373,7 @@ async def admin_clear_data(keep_products: bool = True, authorization: Optional[s
     # Clear orders
     result = await db.orders.delete_many({})
     deleted["orders"] = result.deleted_count
+    await db.pulperia_stats.update_many({}, {"$set": {"sales_count": 0}})
     
     # Clear announcements
     result = await db.announcements.delete_many({})
@@ -2625,6 +6386,14 @@ async def admin_clear_data(keep_products: bool = True, authorization: Optional[s
     if not keep_products:
         result = await db.products.delete_many({})
         deleted["products"] = result.deleted_count
+        await db.pulperia_stats.update_many({}, {"$set": {"products_count": 0}})
+        await product_search_index.rebuild()
+        await category_facets.rebuild()
+        search_result_cache.clear()
+    
+    # Order counts are gone, so suggestion weights and leaderboards start over
+    await search_suggestions.rebuild()
+    await leaderboards.rebuild()
     
     return {"message": "Datos limpiados", "deleted": deleted}
 
@@ -2665,45 +6434,241 @@ async def api_health_check():
 
 app.include_router(api_router)
 
+async def ensure_index(collection, keys, **options):
+    """Create one index; a failure (e.g. duplicates under a unique index) is logged and never skips the others"""
+    try:
+        await collection.create_index(keys, **options)
+    except Exception as e:
+        logger.warning(f"[STARTUP] Index {collection.name} {keys} warning: {e}")
+
 @app.on_event("startup")
 async def startup_db_client():
-    """Create indexes for faster queries on startup"""
+    """Create indexes for faster queries on startup, each one independently"""
+    # Índices para pulperías
+    await ensure_index(db.pulperias, "pulperia_id", unique=True)
+    await ensure_index(db.pulperias, "owner_user_id")
+    await ensure_index(db.pulperias, [("geo_location", "2dsphere")])
+    await ensure_index(db.pulperias, [("hours_schedule.start", 1), ("hours_schedule.end", 1)])
+    
+    # Índices para productos
+    await ensure_index(db.products, "product_id", unique=True)
+    await ensure_index(db.products, "pulperia_id")
+    await ensure_index(db.products, [("pulperia_id", 1), ("available", 1), ("category", 1)])
+    await ensure_index(db.products, [("name", "text"), ("description", "text")])
+    await ensure_index(db.products, [("search_prefixes", 1), ("available", 1), ("price", 1), ("product_id", 1)])
+    # Keyset pagination: every server-side sort ends with product_id
+    await ensure_index(db.products, [("available", 1), ("price", 1), ("product_id", 1)])
+    await ensure_index(db.products, [("available", 1), ("category", 1), ("price", 1), ("product_id", 1)])
+    await ensure_index(db.products, [("available", 1), ("created_at", -1), ("product_id", -1)])
+    await ensure_index(db.products, [("available", 1), ("category", 1), ("created_at", -1), ("product_id", -1)])
+    # Barcode/SKU: unique per pulperia when set, plus a global barcode lookup
+    await ensure_index(
+        db.products,
+        [("pulperia_id", 1), ("barcode", 1)],
+        unique=True,
+        partialFilterExpression={"barcode": {"$type": "string"}}
+    )
+    await ensure_index(
+        db.products,
+        [("pulperia_id", 1), ("sku", 1)],
+        unique=True,
+        partialFilterExpression={"sku": {"$type": "string"}}
+    )
+    await ensure_index(db.products, [("barcode", 1), ("available", 1), ("price", 1)])
+    
+    # Índices de búsqueda por prefijo
+    await ensure_index(db.pulperias, "search_prefixes")
+    await ensure_index(db.jobs, [("search_prefixes", 1), ("created_at", -1)])
+    await ensure_index(db.services, [("search_prefixes", 1), ("created_at", -1)])
+    
+    # Cambios del catálogo que cada worker aplica a sus índices en memoria
+    await ensure_index(db.catalog_changes, "changed_at", expireAfterSeconds=CATALOG_CHANGE_TTL_SECONDS)
+    
+    # Índices para reseñas
+    await ensure_index(db.reviews, [("pulperia_id", 1), ("user_id", 1)])
+    
+    # Índices para órdenes
+    await ensure_index(db.orders, "order_id", unique=True)
+    await ensure_index(db.orders, "pulperia_id")
+    await ensure_index(db.orders, "customer_user_id")
+    await ensure_index(db.orders, "status")
+    
+    # Índices para usuarios
+    await ensure_index(db.users, "user_id", unique=True)
+    await ensure_index(db.users, "email", unique=True)
+    
+    # Índices para sesiones
+    await ensure_index(db.user_sessions, "session_token", unique=True)
+    await ensure_index(db.user_sessions, "user_id")
+    await ensure_index(db.user_sessions, "expires_at", expireAfterSeconds=0)
+    
+    # Índices para revocación de sesiones firmadas (se purgan al expirar el token)
+    await ensure_index(db.revoked_sessions, "jti", unique=True)
+    await ensure_index(db.revoked_sessions, "revoked_at")
+    await ensure_index(db.revoked_sessions, "expires_at", expireAfterSeconds=0)
+    
+    # Índices para logros
+    await ensure_index(db.achievements, "pulperia_id")
+    await ensure_index(db.achievements, [("pulperia_id", 1), ("badge_id", 1)], unique=True)
+    
+    # Índices para estadísticas de pulperías
+    await ensure_index(db.pulperia_stats, "pulperia_id", unique=True)
+    await ensure_index(db.profile_visitors, [("pulperia_id", 1), ("day", 1)], unique=True)
+    await ensure_index(db.profile_visitors, "expires_at", expireAfterSeconds=0)
+    
+    # Índices para favoritos
+    await ensure_index(db.favorites, [("user_id", 1), ("pulperia_id", 1)], unique=True)
+    
+    logger.info("[STARTUP] Database indexes checked")
+
+@app.on_event("startup")
+async def startup_search_fields_backfill():
+    """Backfill persisted search fields on documents written before they existed"""
+    async def backfill():
+        for collection_name in SEARCH_FIELD_SOURCES:
+            try:
+                updated = await backfill_search_fields(collection_name)
+                if updated:
+                    logger.info(f"[STARTUP] Backfilled search fields on {updated} {collection_name}")
+            except Exception as e:
+                logger.warning(f"[STARTUP] Search field backfill warning ({collection_name}): {e}")
+    
+    run_in_background(backfill())
+
+@app.on_event("startup")
+async def startup_search_index():
+    """Build the in-memory search indexes in the background, then keep applying other workers' writes"""
+    async def build():
+        try:
+            await rebuild_search_indexes()
+            logger.info(f"[STARTUP] Product search index built with {len(product_search_index)} products")
+            logger.info(f"[STARTUP] Search suggestions built with {len(search_suggestions.phrases)} phrases")
+        except Exception as e:
+            logger.warning(f"[STARTUP] Product search index warning: {e}")
+        await catalog_change_sync_loop()
+    
+    run_in_background(build())
+
+@app.on_event("startup")
+async def startup_map_index():
+    """Build the in-memory map grid in the background"""
+    async def build():
+        try:
+            await pulperia_grid.rebuild()
+            map_tile_cache.clear()
+            open_map_tile_cache.clear()
+            logger.info(f"[STARTUP] Map grid built with {len(pulperia_grid)} pulperias")
+        except Exception as e:
+            logger.warning(f"[STARTUP] Map grid warning: {e}")
+    
+    run_in_background(build())
+
+@app.on_event("startup")
+async def startup_http_client():
+    """Open the shared upstream HTTP connection pool"""
+    await upstream.start()
+
+@app.on_event("startup")
+async def startup_google_keys():
+    """Keep the Google JWKS cached for local ID token verification"""
+    if GOOGLE_CLIENT_ID:
+        run_in_background(google_jwks_refresh_loop())
+
+@app.on_event("startup")
+async def startup_session_migration():
+    """Convert legacy string session dates in the background so the TTL index can purge them"""
+    async def run_migration():
+        try:
+            migrated = await migrate_session_datetimes()
+            if migrated:
+                logger.info(f"[STARTUP] Migrated {migrated} sessions to BSON dates")
+        except Exception as e:
+            logger.warning(f"[STARTUP] Session migration warning: {e}")
+    
+    run_in_background(run_migration())
+
+@app.on_event("startup")
+async def startup_pulperia_location_migration():
+    """Write GeoJSON locations on legacy pulperias in the background"""
+    async def run_migration():
+        try:
+            migrated = await migrate_pulperia_locations()
+            if migrated:
+                logger.info(f"[STARTUP] Migrated {migrated} pulperia locations to GeoJSON")
+        except Exception as e:
+            logger.warning(f"[STARTUP] Pulperia location migration warning: {e}")
+    
+    run_in_background(run_migration())
+
+@app.on_event("startup")
+async def startup_pulperia_hours_migration():
+    """Parse free-form hours on legacy pulperias in the background"""
+    async def run_migration():
+        try:
+            migrated = await migrate_pulperia_hours()
+            if migrated:
+                logger.info(f"[STARTUP] Parsed opening hours on {migrated} pulperias")
+        except Exception as e:
+            logger.warning(f"[STARTUP] Pulperia hours migration warning: {e}")
+    
+    run_in_background(run_migration())
+
+@app.on_event("startup")
+async def startup_review_counters_migration():
+    """Build rating counters for pulperias created before they existed"""
+    async def run_migration():
+        try:
+            legacy_ids = await db.pulperias.distinct("pulperia_id", {"rating_sum": {"$exists": False}})
+            if legacy_ids:
+                migrated = await rebuild_review_counters(legacy_ids)
+                logger.info(f"[STARTUP] Built review counters for {migrated} pulperias")
+        except Exception as e:
+            logger.warning(f"[STARTUP] Review counters migration warning: {e}")
+    
+    run_in_background(run_migration())
+
+@app.on_event("startup")
+async def startup_pulperia_stats():
+    """Reconcile pulperia stats now and then periodically in the background"""
+    run_in_background(pulperia_stats_reconcile_loop())
+
+@app.on_event("startup")
+async def startup_leaderboards():
+    """Build the leaderboards now and then periodically in the background"""
+    run_in_background(leaderboard_refresh_loop())
+
+@app.on_event("startup")
+async def startup_profile_view_flush():
+    """Flush buffered profile views periodically"""
+    run_in_background(profile_view_flush_loop())
+
+@app.on_event("startup")
+async def startup_session_revocations():
+    """Load revoked signed sessions and keep them in sync
+    
+    Signed tokens are accepted whenever a signing key is set, even with
+    issuing turned off, so their revocations must be enforced too.
+    """
+    if not SESSION_SIGNING_KEY:
+        return
+    try:
+        await revoked_sessions.sync()
+    except Exception as e:
+        logger.warning(f"[STARTUP] Revocation list load warning: {e}")
+    run_in_background(revocation_sync_loop())
+
+@app.on_event("shutdown")
+async def shutdown_profile_views():
+    """Write views still in the buffer before the client closes"""
     try:
-        # Índices para pulperías
-        await db.pulperias.create_index("pulperia_id", unique=True)
-        await db.pulperias.create_index("owner_user_id")
-        await db.pulperias.create_index([("location.lat", 1), ("location.lng", 1)])
-        
-        # Índices para productos
-        await db.products.create_index("product_id", unique=True)
-        await db.products.create_index("pulperia_id")
-        await db.products.create_index([("name", "text"), ("description", "text")])
-        
-        # Índices para órdenes
-        await db.orders.create_index("order_id", unique=True)
-        await db.orders.create_index("pulperia_id")
-        await db.orders.create_index("customer_user_id")
-        await db.orders.create_index("status")
-        
-        # Índices para usuarios
-        await db.users.create_index("user_id", unique=True)
-        await db.users.create_index("email", unique=True)
-        
-        # Índices para sesiones
-        await db.user_sessions.create_index("session_token", unique=True)
-        await db.user_sessions.create_index("user_id")
-        
-        # Índices para logros
-        await db.achievements.create_index("pulperia_id")
-        await db.achievements.create_index([("pulperia_id", 1), ("badge_id", 1)], unique=True)
-        
-        # Índices para favoritos
-        await db.favorites.create_index([("user_id", 1), ("pulperia_id", 1)], unique=True)
-        
-        logger.info("[STARTUP] Database indexes created successfully")
+        await flush_profile_views()
     except Exception as e:
-        logger.warning(f"[STARTUP] Index creation warning: {e}")
+        logger.warning(f"[SHUTDOWN] View flush failed: {e}")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    await upstream.close()
@@ -0,0 +1,278 @@
+"""
+Geo Tests - La Pulpería
+Testing the location helpers in backend/server.py:
+1. Distances and GeoJSON locations for the 2dsphere index
+2. In-memory map grid for viewport queries
+3. Clustered map tiles and their cache
+4. Nearby product ranking
+5. Parsed opening hours and the open_now filters
+"""
+import pytest
+import os
+import sys
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+server = pytest.importorskip("server")
+
+TEGUCIGALPA = (14.0723, -87.1921)
+SAN_PEDRO_SULA = (15.5042, -88.0250)
+
+
+def make_pulperia(pulperia_id, lat, lng, **extra):
+    return {
+        "pulperia_id": pulperia_id,
+        "name": f"Pulpería {pulperia_id}",
+        "location": {"lat": lat, "lng": lng},
+        **extra
+    }
+
+
+class TestGeoLocations:
+    """Test distance math and GeoJSON conversion"""
+
+    def test_haversine_between_cities(self):
+        """Tegucigalpa to San Pedro Sula is about 180 km in a straight line"""
+        distance = server.haversine_km(*TEGUCIGALPA, *SAN_PEDRO_SULA)
+        assert 175 < distance < 185
+        assert server.haversine_km(*TEGUCIGALPA, *TEGUCIGALPA) == 0
+
+    def test_geo_fields_use_lng_lat_order(self):
+        """GeoJSON points are [lng, lat]"""
+        fields = server.geo_fields(make_pulperia("p1", *TEGUCIGALPA))
+        assert fields == {"geo_location": {"type": "Point", "coordinates": [-87.1921, 14.0723]}}
+
+    def test_invalid_locations_are_null(self):
+        """Missing, malformed or out-of-range coordinates never reach the index"""
+        assert server.geo_fields({"location": None}) == {"geo_location": None}
+        assert server.geo_fields({"location": {"lat": "x", "lng": 1}}) == {"geo_location": None}
+        assert server.geo_fields(make_pulperia("p1", 95.0, -87.0)) == {"geo_location": None}
+        assert server.pulperia_coordinates(make_pulperia("p1", "14.5", "-87.1")) == (14.5, -87.1)
+
+
+class TestPulperiaGridIndex:
+    """Test the viewport grid behind /api/pulperias/in-bounds"""
+
+    @pytest.fixture
+    def grid(self):
+        grid = server.PulperiaGridIndex(cell_degrees=0.05)
+        grid.upsert(make_pulperia("tgu_1", 14.0723, -87.1921, rating=4.5))
+        grid.upsert(make_pulperia("tgu_2", 14.0801, -87.2050))
+        grid.upsert(make_pulperia("sps_1", *SAN_PEDRO_SULA))
+        return grid
+
+    def ids(self, grid, *box, **kwargs):
+        markers, _ = grid.query(*box, **kwargs)
+        return sorted(marker["id"] for marker in markers)
+
+    def test_bbox_query(self, grid):
+        """Only markers inside the box come back, also for country-wide boxes"""
+        assert self.ids(grid, 14.0, -87.3, 14.1, -87.1) == ["tgu_1", "tgu_2"]
+        assert self.ids(grid, 13.0, -90.0, 16.5, -83.0) == ["sps_1", "tgu_1", "tgu_2"]
+        assert self.ids(grid, 14.075, -87.3, 14.1, -87.1) == ["tgu_2"]
+
+    def test_compact_marker(self, grid):
+        """Markers carry only what the map needs; inline logos become thumbnail URLs"""
+        grid.upsert(make_pulperia("tgu_3", 14.07, -87.19, logo_url="data:image/png;base64,AAAA", address="Col. Palmira"))
+        marker = grid.get("tgu_3")
+        assert set(marker) == {"id", "name", "lat", "lng", "rating", "logo"}
+        assert marker["logo"].startswith("/api/pulperias/tgu_3/logo-thumb?v=")
+        assert grid.get("tgu_1")["rating"] == 4.5
+
+    def test_suspend_move_and_delete(self, grid):
+        """Suspended pulperias leave the grid; moves and deletes apply immediately"""
+        grid.upsert(make_pulperia("tgu_1", 14.0723, -87.1921, is_suspended=True))
+        grid.upsert(make_pulperia("tgu_2", *SAN_PEDRO_SULA))
+        grid.remove("sps_1")
+        assert self.ids(grid, 13.0, -90.0, 16.5, -83.0) == ["tgu_2"]
+
+    def test_limit_truncates(self, grid):
+        """Large viewports are capped and flagged"""
+        markers, truncated = grid.query(13.0, -90.0, 16.5, -83.0, limit=2)
+        assert len(markers) == 2 and truncated
+
+    def test_parse_bbox(self):
+        """bbox is minLng,minLat,maxLng,maxLat like Leaflet's toBBoxString"""
+        assert server.parse_bbox("-87.3,14.0,-87.1,14.1") == (14.0, -87.3, 14.1, -87.1)
+        with pytest.raises(server.HTTPException):
+            server.parse_bbox("-87.1,14.1,-87.3,14.0")
+
+
+class TestMapTiles:
+    """Test XYZ tile clustering over the map grid"""
+
+    @pytest.fixture
+    def grid(self, monkeypatch):
+        grid = server.PulperiaGridIndex(cell_degrees=0.05)
+        for i in range(5):
+            grid.upsert(make_pulperia(f"tgu_{i}", 14.07 + i * 0.001, -87.19))
+        grid.upsert(make_pulperia("sps_1", *SAN_PEDRO_SULA))
+        monkeypatch.setattr(server, "pulperia_grid", grid)
+        return grid
+
+    def tile_at(self, lat, lng, zoom):
+        px, py = server.lat_lng_to_pixel(lat, lng, zoom)
+        return zoom, int(px // 256), int(py // 256)
+
+    def test_tile_bounds_roundtrip(self):
+        """A point falls inside the bounds of the tile it maps to"""
+        zoom, x, y = self.tile_at(*TEGUCIGALPA, 12)
+        min_lat, min_lng, max_lat, max_lng = server.tile_bounds(zoom, x, y)
+        assert min_lat <= TEGUCIGALPA[0] <= max_lat
+        assert min_lng <= TEGUCIGALPA[1] <= max_lng
+
+    def test_low_zoom_clusters(self, grid):
+        """Zoomed out, nearby stores become one cluster; the lone store stays a marker"""
+        tile = server.build_map_tile(*self.tile_at(*TEGUCIGALPA, 8))
+        assert [cluster["count"] for cluster in tile["clusters"]] == [5]
+        assert tile["pulperias"] == []
+
+        tile = server.build_map_tile(*self.tile_at(*SAN_PEDRO_SULA, 8))
+        assert tile["clusters"] == []
+        assert [marker["id"] for marker in tile["pulperias"]] == ["sps_1"]
+
+    def test_high_zoom_lists_stores(self, grid):
+        """Past MAP_CLUSTER_MAX_ZOOM every store is returned individually"""
+        tile = server.build_map_tile(*self.tile_at(*TEGUCIGALPA, server.MAP_CLUSTER_MAX_ZOOM + 1))
+        assert tile["clusters"] == []
+        assert {marker["id"] for marker in tile["pulperias"]} <= {f"tgu_{i}" for i in range(5)}
+
+    def test_tiles_partition_markers(self, grid):
+        """The four children of a tile hold exactly the parent's markers"""
+        zoom, x, y = self.tile_at(*TEGUCIGALPA, 9)
+        parent = server.build_map_tile(zoom, x, y)["count"]
+        children = sum(
+            server.build_map_tile(zoom + 1, 2 * x + dx, 2 * y + dy)["count"]
+            for dx in (0, 1) for dy in (0, 1)
+        )
+        assert parent == children == 5
+
+    def test_change_invalidates_tiles_of_marker(self, grid):
+        """Only tiles under the changed marker are dropped"""
+        cache = server.MapTileCache()
+        tgu_key, sps_key = self.tile_at(*TEGUCIGALPA, 10), self.tile_at(*SAN_PEDRO_SULA, 10)
+        cache.set(tgu_key, {})
+        cache.set(sps_key, {})
+        cache.invalidate_marker(grid.get("tgu_0"))
+        assert cache.get(tgu_key) is None
+        assert cache.get(sps_key) == {}
+
+    def test_change_invalidates_tile_of_cell_centroid(self, monkeypatch):
+        """Zoomed out, a new marker drops the tile where its cell's cluster is drawn"""
+        grid = server.PulperiaGridIndex(cell_degrees=0.05)
+        monkeypatch.setattr(server, "pulperia_grid", grid)
+        # The cell spans the z8 tile edge at -87.1875; the new marker lands west of it
+        grid.upsert(make_pulperia("a", 14.07, -87.18))
+        grid.upsert(make_pulperia("b", 14.071, -87.18))
+        cache = server.MapTileCache()
+        key = self.tile_at(14.07, -87.18, 8)
+        cache.set(key, server.build_map_tile(*key))
+
+        grid.upsert(make_pulperia("c", 14.07, -87.199))
+        assert self.tile_at(14.07, -87.199, 8) != key
+        cache.invalidate_marker(grid.get("c"))
+        assert cache.get(key) is None
+        assert server.build_map_tile(*key)["count"] == 3
+
+
+class TestNearbyProducts:
+    """Test the pulperia lookup and ranking behind /api/products?lat=&lng="""
+
+    @pytest.fixture
+    def grid(self):
+        grid = server.PulperiaGridIndex(cell_degrees=0.05)
+        grid.upsert(make_pulperia("tgu_1", *TEGUCIGALPA))
+        grid.upsert(make_pulperia("tgu_2", 14.10, -87.22))
+        grid.upsert(make_pulperia("sps_1", *SAN_PEDRO_SULA))
+        return grid
+
+    def product(self, product_id, pulperia_id, price):
+        return {"product_id": product_id, "pulperia_id": pulperia_id, "price": price}
+
+    def test_within_radius(self, grid):
+        """Only pulperias inside the circle come back, with their distance"""
+        distances = grid.within_radius(*TEGUCIGALPA, 10)
+        assert sorted(distances) == ["tgu_1", "tgu_2"]
+        assert distances["tgu_1"] == 0
+        assert 4 < distances["tgu_2"] < 5
+        assert sorted(grid.within_radius(*TEGUCIGALPA, 200)) == ["sps_1", "tgu_1", "tgu_2"]
+
+    def test_rank_blends_signals(self):
+        """Relevance weighs most, then distance, then price"""
+        distances = {"near": 0.0, "far": 4.0}
+        candidates = [self.product("a", "far", 20), self.product("b", "near", 20), self.product("c", "near", 40)]
+        ranked = [product_id for _, product_id in server.nearby_rank(candidates, {}, distances, 5.0)]
+        assert ranked == ["b", "c", "a"]
+
+        relevance = {"a": 9.0, "b": 1.0, "c": 1.0}
+        ranked = [product_id for _, product_id in server.nearby_rank(candidates, relevance, distances, 5.0)]
+        assert ranked[0] == "a"
+
+    def test_rank_is_stable_for_ties(self):
+        """Equal scores fall back to product_id so cursors stay consistent"""
+        candidates = [self.product("b", "near", 10), self.product("a", "near", 10)]
+        ranked = server.nearby_rank(candidates, {}, {"near": 1.0}, 5.0)
+        assert [product_id for _, product_id in ranked] == ["a", "b"]
+
+
+class TestOpeningHours:
+    """Test parsing free-form hours into minute-of-week intervals"""
+
+    MONDAY, SATURDAY, SUNDAY = 0, 5 * 1440, 6 * 1440
+
+    def test_days_and_ranges(self):
+        """Day ranges, 12h clocks and closed days"""
+        schedule = server.parse_hours("Lunes a Sábado 7:00 AM - 9:00 PM, Domingo cerrado")
+        assert len(schedule) == 6
+        assert schedule[0] == {"start": 7 * 60, "end": 21 * 60}
+        assert schedule[-1] == {"start": self.SATURDAY + 7 * 60, "end": self.SATURDAY + 21 * 60}
+
+    def test_inferred_meridiem(self):
+        """Missing am/pm is inferred; split shifts land in the afternoon"""
+        assert server.parse_hours("9-5pm")[0] == {"start": 9 * 60, "end": 17 * 60}
+        assert server.parse_hours("8 a 5")[0] == {"start": 8 * 60, "end": 17 * 60}
+        assert server.parse_hours("8-12, 2-6 lunes a viernes")[:2] == [
+            {"start": 8 * 60, "end": 12 * 60},
+            {"start": 14 * 60, "end": 18 * 60}
+        ]
+
+    def test_overnight_wraps_the_week(self):
+        """Sunday night hours continue into Monday morning"""
+        schedule = server.parse_hours("Domingo 6pm-2am")
+        assert schedule == [
+            {"start": 0, "end": 2 * 60},
+            {"start": self.SUNDAY + 18 * 60, "end": server.WEEK_MINUTES}
+        ]
+
+    def test_special_cases(self):
+        """Always open, always closed and unreadable text"""
+        assert server.parse_hours("Abierto 24 horas") == [{"start": 0, "end": server.WEEK_MINUTES}]
+        assert server.parse_hours("Cerrado") == []
+        assert server.parse_hours("Horario variable") is None
+        assert server.parse_hours(None) is None
+
+    def test_later_groups_override(self):
+        """A specific day overrides an earlier every-day range"""
+        schedule = server.parse_hours("Todos los días 7am-9pm, domingo 8am-12pm")
+        assert schedule[-1] == {"start": self.SUNDAY + 8 * 60, "end": self.SUNDAY + 12 * 60}
+
+    def test_week_minute_uses_store_timezone(self):
+        """Monday 14:30 UTC is Monday 08:30 in Honduras"""
+        now = server.datetime(2025, 6, 2, 14, 30, tzinfo=server.timezone.utc)
+        assert server.week_minute(now) == 8 * 60 + 30
+
+    def test_open_filter_on_grid(self):
+        """The map grid keeps only pulperias whose schedule covers the minute"""
+        grid = server.PulperiaGridIndex(cell_degrees=0.05)
+        grid.upsert(make_pulperia("early", *TEGUCIGALPA, hours="6am-12pm"))
+        grid.upsert(make_pulperia("late", 14.08, -87.20, hours="2pm-10pm"))
+        grid.upsert(make_pulperia("unknown", 14.09, -87.20))
+        markers, _ = grid.query(14.0, -87.3, 14.1, -87.1, open_at=self.MONDAY + 9 * 60)
+        assert [marker["id"] for marker in markers] == ["early"]
+        markers, _ = grid.query(14.0, -87.3, 14.1, -87.1)
+        assert len(markers) == 3
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,288 @@
+"""
+Pulperia Stats Tests - La Pulpería
+Testing the per-pulperia counters in backend/server.py:
+1. Review rating counters and the star histogram
+2. Event-driven achievement evaluation
+3. Vectorized achievement sweep
+4. Buffered profile views and unique visitor estimates
+5. Incremental leaderboards
+"""
+import pytest
+import os
+import sys
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+server = pytest.importorskip("server")
+
+
+class TestReviewCounters:
+    """Test the rating aggregates kept on the pulperia document"""
+
+    def test_histogram_is_zero_filled(self):
+        """Stars nobody gave show up as zero; unknown keys are dropped"""
+        pulperia = {"rating_histogram": {"5": 3, "1": 1, "7": 2}}
+        assert server.rating_histogram(pulperia) == {"1": 1, "2": 0, "3": 0, "4": 0, "5": 3}
+        assert server.rating_histogram({}) == server.empty_rating_histogram()
+
+    def test_average_from_counters(self):
+        """The average is rounded like the stored rating and 0 without reviews"""
+        assert server.average_rating(14, 4) == 3.5
+        assert server.average_rating(13, 3) == 4.3
+        assert server.average_rating(0, 0) == 0.0
+
+
+class TestAchievementEvents:
+    """Test which badges an event re-checks and how criteria are evaluated"""
+
+    def test_events_only_touch_dependent_badges(self):
+        """A product event never re-checks sales or view badges"""
+        badges = server.ACHIEVEMENT_BADGES_BY_STAT["products_count"]
+        assert badges == ["catalogo_inicial", "catalogo_completo", "super_catalogo"]
+        assert "leyenda" in server.ACHIEVEMENT_BADGES_BY_STAT["happy_customers"]
+        assert "leyenda" in server.ACHIEVEMENT_BADGES_BY_STAT["unique_visitors"]
+        assert set(server.ACHIEVEMENT_EVENT_STATS) == {
+            "order_completed", "product_created", "review_posted", "verified", "profile_views",
+            "leaderboards_rebuilt"
+        }
+        assert "top_diez" not in server.ACHIEVEMENT_BADGES_BY_STAT["sales_count"]
+        assert server.RANK_THRESHOLD == 10
+
+    def test_view_thresholds(self):
+        """A flush only triggers a check when a counter crosses a badge threshold"""
+        assert server.VIEW_THRESHOLDS == {"profile_views": [50, 500], "unique_visitors": [200, 1000]}
+        assert server.crossed_view_threshold("profile_views", 45, 52)
+        assert not server.crossed_view_threshold("profile_views", 50, 60)
+        assert server.crossed_view_threshold("unique_visitors", 150, 1200)
+
+    def test_criteria_met(self):
+        """Every criterion must hold; rank-like stats are lower-is-better"""
+        leyenda = server.ACHIEVEMENT_DEFINITIONS["leyenda"]["criteria"]
+        assert server.criteria_met(leyenda, {"unique_visitors": 1200, "happy_customers": 50})
+        assert not server.criteria_met(leyenda, {"unique_visitors": 1200, "happy_customers": 49})
+        assert server.criteria_met({"is_verified": True}, {"is_verified": True})
+        assert server.criteria_met({"top_rank": 10}, {"top_rank": 3})
+        assert not server.criteria_met({"top_rank": 10}, {"top_rank": 11})
+
+    def test_scheduled_check_is_held_until_done(self, monkeypatch):
+        """The background check stays referenced while it runs and is released after"""
+        import asyncio
+        checked = []
+
+        async def fake_check(pulperia_id, event=None):
+            await asyncio.sleep(0)
+            checked.append((pulperia_id, event))
+            return []
+
+        async def run():
+            server.schedule_achievement_check("pulp_a", "product_created")
+            assert len(server.background_tasks) == 1
+            await asyncio.gather(*server.background_tasks)
+            await asyncio.sleep(0)
+
+        monkeypatch.setattr(server, "check_and_award_achievements", fake_check)
+        asyncio.run(run())
+        assert checked == [("pulp_a", "product_created")]
+        assert not server.background_tasks
+
+
+class TestAchievementSweep:
+    """Test the array evaluation used by the batch sweep"""
+
+    def test_masks_match_criteria_met(self):
+        """Every pulperia gets the same verdict as the one-at-a-time check"""
+        np = pytest.importorskip("numpy")
+        rng = np.random.default_rng(7)
+        size = 500
+        metrics = {
+            "sales_count": rng.integers(0, 300, size),
+            "products_count": rng.integers(0, 40, size),
+            "happy_customers": rng.integers(0, 60, size),
+            "profile_views": rng.integers(0, 1500, size),
+            "unique_visitors": rng.integers(0, 1500, size),
+            "is_verified": rng.random(size) < 0.2
+        }
+        masks = server.achievement_masks(metrics, size)
+
+        for i in range(size):
+            stats = {key: column[i].item() for key, column in metrics.items()}
+            for badge_id, definition in server.ACHIEVEMENT_DEFINITIONS.items():
+                assert masks[badge_id][i] == server.criteria_met(definition["criteria"], stats)
+
+    def test_missing_stats_use_defaults(self):
+        """A criterion on a stat without data is judged on its default"""
+        np = pytest.importorskip("numpy")
+        masks = server.achievement_masks({}, 3)
+        assert not masks["primera_venta"].any()
+        assert masks["primera_venta"].shape == (3,)
+
+
+class TestProfileViews:
+    """Test the write-behind view buffer and the HyperLogLog estimate"""
+
+    def test_repeat_views_are_deduplicated(self):
+        """The same visitor counts once per window, other visitors count"""
+        buffer = server.ProfileViewBuffer(dedupe_seconds=60)
+        assert buffer.record("pulp_a", "anon:1.2.3.4|ua", now=0)
+        assert not buffer.record("pulp_a", "anon:1.2.3.4|ua", now=30)
+        assert buffer.record("pulp_b", "anon:1.2.3.4|ua", now=30)
+        assert buffer.record("pulp_a", "anon:1.2.3.4|ua", now=61)
+        assert buffer.record("pulp_a", "session:sess_x", now=61)
+
+        views, registers = buffer.drain()
+        assert views == {"pulp_a": 3, "pulp_b": 1}
+        assert {pulperia_id for pulperia_id, _ in registers} == {"pulp_a", "pulp_b"}
+        assert buffer.stats()["pending_views"] == 0
+        assert buffer.stats()["deduplicated"] == 1
+
+    def test_failed_flush_is_restored(self):
+        """Restored views add to newer ones and registers keep the larger rank"""
+        buffer = server.ProfileViewBuffer(dedupe_seconds=60)
+        buffer.record("pulp_a", "a", now=0)
+        views, registers = buffer.drain()
+        buffer.record("pulp_a", "b", now=1)
+        buffer.restore(views, registers)
+
+        restored_views, restored_registers = buffer.drain()
+        assert restored_views == {"pulp_a": 2}
+        for key, day_registers in registers.items():
+            assert all(restored_registers[key][index] >= rank for index, rank in day_registers.items())
+
+    def test_dedupe_window_is_bounded(self):
+        """The oldest visitors are forgotten past max_entries"""
+        buffer = server.ProfileViewBuffer(dedupe_seconds=60, max_entries=2)
+        for visitor in ("a", "b", "c"):
+            buffer.record("pulp_a", visitor, now=0)
+        assert buffer.stats()["tracked_visitors"] == 2
+        assert buffer.record("pulp_a", "a", now=1)
+
+    def make_request(self, peer, forwarded_for=None, user_agent="ua"):
+        headers = [(b"user-agent", user_agent.encode())]
+        if forwarded_for:
+            headers.append((b"x-forwarded-for", forwarded_for.encode()))
+        return server.Request({"type": "http", "headers": headers, "client": (peer, 50000)})
+
+    def test_forwarded_for_needs_trusted_proxy(self, monkeypatch):
+        """X-Forwarded-For is ignored unless the direct peer is a trusted proxy"""
+        monkeypatch.setattr(server, "TRUSTED_PROXIES", {"10.0.0.1"})
+        assert server.client_address(self.make_request("203.0.113.9", "1.1.1.1")) == "203.0.113.9"
+        assert server.client_address(self.make_request("10.0.0.1", "1.1.1.1, 198.51.100.7")) == "198.51.100.7"
+        assert server.client_address(self.make_request("10.0.0.1")) == "10.0.0.1"
+
+    def test_made_up_headers_do_not_create_visitors(self, monkeypatch):
+        """An invalid token or another user agent is still the same anonymous visitor"""
+        import asyncio
+
+        async def reject(authorization, session_token):
+            raise server.HTTPException(status_code=401, detail="Sesión inválida")
+
+        monkeypatch.setattr(server, "get_current_user", reject)
+        first = asyncio.run(server.request_visitor(self.make_request("203.0.113.9"), "Bearer made-up", None))
+        second = asyncio.run(server.request_visitor(self.make_request("203.0.113.9", user_agent="other"), None, None))
+        assert first == second == "anon:203.0.113.9"
+
+    @pytest.mark.parametrize("visitors", [10, 300, 5000])
+    def test_estimate_is_close(self, visitors):
+        """The estimate stays within a few percent of the distinct count"""
+        registers = {}
+        for i in range(visitors):
+            index, rank = server.hll_position(server.visitor_hash(f"visitor-{i}"))
+            registers[str(index)] = max(registers.get(str(index), 0), rank)
+        assert abs(server.hll_estimate(registers) - visitors) <= max(1, visitors * 0.1)
+        assert server.hll_estimate({}) == 0
+
+
+class TestLeaderboards:
+    """Test the in-memory boards behind /api/leaderboards and top_rank"""
+
+    TEGUCIGALPA = {"location": {"lat": 14.08, "lng": -87.20}}
+    SAN_PEDRO_SULA = {"location": {"lat": 15.50, "lng": -88.03}}
+
+    def test_ranks_share_ties(self):
+        """Equal scores share a rank and the next rank skips"""
+        board = server.RankedBoard()
+        for pulperia_id, score in [("a", 10), ("b", 7), ("c", 10), ("d", 3)]:
+            board.set(pulperia_id, score)
+        assert [board.rank(p) for p in "abcd"] == [1, 3, 1, 4]
+        assert board.page(2, offset=1) == [(1, "c", 10), (3, "b", 7)]
+
+        board.set("d", 12)
+        board.discard("a")
+        assert board.rank("d") == 1
+        assert board.rank("a") is None
+        assert len(board) == 3
+
+    def test_region_from_location(self):
+        """The nearest department wins; far away or missing locations have none"""
+        assert server.pulperia_region(self.TEGUCIGALPA) == "francisco_morazan"
+        assert server.pulperia_region(self.SAN_PEDRO_SULA) == "cortes"
+        assert server.pulperia_region({"location": {"lat": 40.4, "lng": -3.7}}) is None
+        assert server.pulperia_region({}) is None
+
+    def test_sales_move_global_and_regional_boards(self):
+        """A completed order moves the pulperia on both boards; a reverted one moves it back"""
+        boards = server.Leaderboards()
+        boards.set_pulperia({"pulperia_id": "teg", **self.TEGUCIGALPA})
+        boards.set_pulperia({"pulperia_id": "sps", **self.SAN_PEDRO_SULA})
+        boards.record_sale("teg")
+        boards.record_sale("sps")
+        boards.record_sale("sps")
+
+        assert boards.rank("sales", "sps") == 1
+        assert boards.rank("sales", "teg") == 2
+        assert boards.rank("sales", "teg", "francisco_morazan") == 1
+
+        boards.record_sale("sps", -1)
+        boards.record_sale("sps", -1)
+        assert boards.rank("sales", "sps") is None
+
+    def test_top_rank_needs_a_full_board(self, monkeypatch):
+        """Small boards and baseline scores never rank; live moves wait for the rebuild"""
+        monkeypatch.setattr(server, "LEADERBOARD_MIN_RANKED", 3)
+        boards = server.Leaderboards()
+        for pulperia_id in ("a", "b"):
+            boards.set_pulperia({"pulperia_id": pulperia_id, **self.TEGUCIGALPA})
+            boards.record_sale(pulperia_id)
+            boards.set_rating(pulperia_id, 1, 1)
+        assert boards.compute_top_ranks() == {}
+
+        boards.set_pulperia({"pulperia_id": "c", **self.TEGUCIGALPA})
+        boards.record_sale("c")
+        boards.record_sale("c")
+        boards.set_rating("c", 20, 4)
+        boards.top_ranks = boards.compute_top_ranks()
+        assert boards.top_ranks == {"c": 1, "a": 2, "b": 2}
+        assert boards.rank("rating", "a") == 2
+
+        boards.record_sale("a", 5)
+        assert boards.rank("sales", "a") == 1
+        assert boards.top_rank("a") == 2
+        assert boards.top_rank("unknown") == 999
+
+    def test_moving_and_suspending(self):
+        """A new location changes region; a suspended pulperia leaves every board"""
+        boards = server.Leaderboards()
+        boards.set_pulperia({"pulperia_id": "p", **self.TEGUCIGALPA})
+        boards.set_rating("p", 18, 4)
+        boards.set_pulperia({"pulperia_id": "p", **self.SAN_PEDRO_SULA})
+        assert boards.rank("rating", "p", "cortes") == 1
+        assert boards.rank("rating", "p", "francisco_morazan") is None
+
+        boards.set_pulperia({"pulperia_id": "p", "is_suspended": True, **self.SAN_PEDRO_SULA})
+        assert boards.rank("rating", "p") is None
+
+    def test_rating_score_needs_reviews(self):
+        """One perfect review ranks below many good ones"""
+        assert server.rating_score(5, 1) < server.rating_score(90, 20)
+
+    def test_growth_compares_windows(self):
+        """Growth is the percent change between the last two windows"""
+        boards = server.Leaderboards()
+        boards.daily_sales["p"] = {"2026-03-30": 5, "2026-02-20": 10, "2025-12-01": 40}
+        assert boards.window_sales("p", today="2026-04-01") == (5, 10)
+        assert boards.growth_rate("p", today="2026-04-01") == -50.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
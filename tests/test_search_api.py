@@ -0,0 +1,344 @@
+"""
+Search and catalog API tests - La Pulpería
+Live HTTP checks against the routes behind the search and catalog work:
+1. Product search ranking and did_you_mean (/api/products)
+2. Search results follow product edits and deletes
+3. Typeahead suggestions (/api/search/suggest)
+4. Category facets (/api/products/facets)
+5. Barcode/SKU codes on product create, edit and /api/products/by-barcode
+6. Unified /api/search
+7. Products near a location (/api/products with lat/lng)
+
+Owner tests need a session token of a pulperia account in TEST_PULPERIA_TOKEN.
+"""
+
+import pytest
+import requests
+import os
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://achiev-meritocracy.preview.emergentagent.com')
+PULPERIA_TOKEN = os.environ.get('TEST_PULPERIA_TOKEN')
+
+
+def owner_headers():
+    if not PULPERIA_TOKEN:
+        pytest.skip("TEST_PULPERIA_TOKEN not set")
+    return {"Authorization": f"Bearer {PULPERIA_TOKEN}"}
+
+
+def create_pulperia():
+    response = requests.post(f"{BASE_URL}/api/pulperias", headers=owner_headers(), json={
+        "name": f"TEST Pulpería Búsqueda {uuid.uuid4().hex[:6]}",
+        "address": "Tegucigalpa, Honduras",
+        "location": {"lat": 14.0723, "lng": -87.1921}
+    })
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    return response.json()["pulperia_id"]
+
+
+def create_product(pulperia_id, **fields):
+    response = requests.post(f"{BASE_URL}/api/products", params={"pulperia_id": pulperia_id}, headers=owner_headers(), json={
+        "price": 10.0,
+        **fields
+    })
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    return response.json()
+
+
+def search_ids(**params):
+    response = requests.get(f"{BASE_URL}/api/products", params=params)
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    return [product["product_id"] for product in response.json()]
+
+
+@pytest.fixture(scope="module")
+def pulperia_id():
+    """A throwaway pulperia owned by the test account"""
+    return create_pulperia()
+
+
+class TestProductSearch:
+    """Test /api/products relevance ranking and typo suggestions"""
+
+    def test_name_match_ranks_first(self, pulperia_id):
+        """A product named after the query ranks above one that only mentions it"""
+        word = f"zr{uuid.uuid4().hex[:6]}"
+        mentioned = create_product(pulperia_id, name="TEST Refresco", description=f"Sabor {word}")
+        named = create_product(pulperia_id, name=f"TEST {word}", description="Refresco")
+
+        assert search_ids(search=word) == [named["product_id"], mentioned["product_id"]]
+        assert search_ids(search=f"{word} sabor") == [mentioned["product_id"]]
+        print(f"✅ Search '{word}' ranked the name match first")
+
+    def test_pages_follow_cursor(self, pulperia_id):
+        """with_meta pages cover every match once"""
+        word = f"zp{uuid.uuid4().hex[:6]}"
+        created = {create_product(pulperia_id, name=f"TEST {word} {index}")["product_id"] for index in range(3)}
+
+        product_ids = []
+        cursor = None
+        while True:
+            response = requests.get(f"{BASE_URL}/api/products", params={"search": word, "limit": 2, "with_meta": True, "cursor": cursor})
+            assert response.status_code == 200
+            page = response.json()
+            product_ids += [product["product_id"] for product in page["results"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        assert sorted(product_ids) == sorted(created)
+
+    def test_typo_suggests_did_you_mean(self, pulperia_id):
+        """A misspelled query returns the products of the corrected query"""
+        word = f"mermelada{uuid.uuid4().hex[:4]}"
+        product = create_product(pulperia_id, name=f"TEST {word}")
+        typo = word[:3] + word[4:]
+
+        response = requests.get(f"{BASE_URL}/api/products", params={"search": typo, "with_meta": True})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["did_you_mean"] == word
+        assert [p["product_id"] for p in data["results"]] == [product["product_id"]]
+
+        response = requests.get(f"{BASE_URL}/api/products", params={"search": word, "with_meta": True})
+        assert response.json()["did_you_mean"] is None
+        print(f"✅ '{typo}' suggested '{word}'")
+
+
+class TestSearchFreshness:
+    """Test that cached search responses follow product writes"""
+
+    def test_edit_and_delete_show_up_in_search(self, pulperia_id):
+        """A repeated search sees renames and deletes right away"""
+        word = f"zc{uuid.uuid4().hex[:6]}"
+        renamed = f"zc{uuid.uuid4().hex[:6]}"
+        product = create_product(pulperia_id, name=f"TEST Jugo {word}", price=15.0)
+        assert search_ids(search=word) == [product["product_id"]]
+        assert search_ids(search=word) == [product["product_id"]]
+        assert search_ids(search=renamed) == []
+
+        response = requests.put(f"{BASE_URL}/api/products/{product['product_id']}", headers=owner_headers(), json={
+            "name": f"TEST Jugo {renamed}",
+            "price": 15.0
+        })
+        assert response.status_code == 200
+        assert search_ids(search=word) == []
+        assert search_ids(search=renamed) == [product["product_id"]]
+
+        response = requests.delete(f"{BASE_URL}/api/products/{product['product_id']}", headers=owner_headers())
+        assert response.status_code == 200
+        assert search_ids(search=renamed) == []
+        print(f"✅ Search followed the rename and delete of {product['product_id']}")
+
+
+class TestSearchSuggest:
+    """Test /api/search/suggest typeahead"""
+
+    def suggestions(self, query, **params):
+        response = requests.get(f"{BASE_URL}/api/search/suggest", params={"q": query, **params})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["query"] == query
+        return data["suggestions"]
+
+    def test_empty_query(self):
+        """A blank prefix has no suggestions"""
+        assert self.suggestions(" ") == []
+
+    def test_suggests_new_product_and_follows_rename(self, pulperia_id):
+        """A product name is suggested from any of its word prefixes until it is renamed"""
+        word = f"zs{uuid.uuid4().hex[:6]}"
+        product = create_product(pulperia_id, name=f"TEST Rosquillas {word}")
+        assert {"text": f"TEST Rosquillas {word}", "type": "product"} in self.suggestions(word[:5].upper())
+
+        response = requests.put(f"{BASE_URL}/api/products/{product['product_id']}", headers=owner_headers(), json={
+            "name": "TEST Rosquillas",
+            "price": 10.0
+        })
+        assert response.status_code == 200
+        assert self.suggestions(word) == []
+
+    def test_limit(self):
+        """No more than limit suggestions come back"""
+        assert len(self.suggestions("t", limit=2)) <= 2
+
+
+class TestProductFacets:
+    """Test /api/products/facets and facets=true searches"""
+
+    def test_pulperia_counts_follow_writes(self):
+        """Per-pulperia counts change with product creates, edits and deletes"""
+        pulperia_id = create_pulperia()
+        response = requests.get(f"{BASE_URL}/api/products/facets", params={"pulperia_id": pulperia_id})
+        assert response.status_code == 200
+        assert response.json() == {"pulperia_id": pulperia_id, "categories": [], "total": 0}
+
+        create_product(pulperia_id, name="TEST Coca-Cola", category="Bebidas")
+        create_product(pulperia_id, name="TEST Pepsi", category="Bebidas")
+        snack = create_product(pulperia_id, name="TEST Churros", category="Snacks")
+        response = requests.get(f"{BASE_URL}/api/products/facets", params={"pulperia_id": pulperia_id})
+        assert response.json()["categories"] == [{"category": "Bebidas", "count": 2}, {"category": "Snacks", "count": 1}]
+        assert response.json()["total"] == 3
+
+        response = requests.put(f"{BASE_URL}/api/products/{snack['product_id']}", headers=owner_headers(), json={
+            "name": "TEST Churros",
+            "price": 10.0,
+            "category": "Bebidas"
+        })
+        assert response.status_code == 200
+        response = requests.get(f"{BASE_URL}/api/products/facets", params={"pulperia_id": pulperia_id})
+        assert response.json()["categories"] == [{"category": "Bebidas", "count": 3}]
+
+        response = requests.delete(f"{BASE_URL}/api/products/{snack['product_id']}", headers=owner_headers())
+        assert response.status_code == 200
+        response = requests.get(f"{BASE_URL}/api/products/facets", params={"pulperia_id": pulperia_id})
+        assert response.json()["total"] == 2
+        print(f"✅ Facets of {pulperia_id} followed the product writes")
+
+    def test_search_facets(self, pulperia_id):
+        """facets=true counts categories over the whole match set, not just the page"""
+        word = f"zf{uuid.uuid4().hex[:6]}"
+        for name, category in [("Agua", "Bebidas"), ("Jugo", "Bebidas"), ("Maní", "Snacks")]:
+            create_product(pulperia_id, name=f"TEST {name} {word}", category=category)
+
+        response = requests.get(f"{BASE_URL}/api/products", params={"search": word, "limit": 1, "facets": True})
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["results"]) == 1
+        assert data["facets"] == [{"category": "Bebidas", "count": 2}, {"category": "Snacks", "count": 1}]
+
+
+class TestProductCodes:
+    """Test barcode/SKU handling on the product routes"""
+
+    def test_invalid_barcode_is_rejected(self):
+        """A code that normalizes to nothing is a 400"""
+        response = requests.get(f"{BASE_URL}/api/products/by-barcode/%20-%20")
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+
+    def test_edit_without_codes_keeps_them(self, pulperia_id):
+        """The dashboard edit sends no barcode/sku; the stored codes must survive it"""
+        barcode = f"74{uuid.uuid4().int % 10**11:011d}"
+        response = requests.post(f"{BASE_URL}/api/products", params={"pulperia_id": pulperia_id}, headers=owner_headers(), json={
+            "name": "TEST Café molido",
+            "price": 45.0,
+            "stock": 10,
+            "barcode": barcode,
+            "sku": "cafe-250"
+        })
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        product = response.json()
+        assert product["barcode"] == barcode
+        assert product["sku"] == "CAFE250"
+
+        response = requests.put(f"{BASE_URL}/api/products/{product['product_id']}", headers=owner_headers(), json={
+            "name": "TEST Café molido",
+            "price": 50.0,
+            "stock": 8,
+            "available": True
+        })
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        assert response.json()["barcode"] == barcode
+        assert response.json()["sku"] == "CAFE250"
+
+        response = requests.get(f"{BASE_URL}/api/products/by-barcode/{barcode}")
+        assert response.status_code == 200
+        assert [p["product_id"] for p in response.json()] == [product["product_id"]]
+        assert response.json()[0]["price"] == 50.0
+        print(f"✅ Edit without codes kept barcode {barcode}")
+
+    def test_edit_can_clear_a_code(self, pulperia_id):
+        """Sending a code explicitly as null removes it"""
+        response = requests.post(f"{BASE_URL}/api/products", params={"pulperia_id": pulperia_id}, headers=owner_headers(), json={
+            "name": "TEST Azúcar",
+            "price": 20.0,
+            "sku": "azu-1"
+        })
+        assert response.status_code == 200
+        product_id = response.json()["product_id"]
+
+        response = requests.put(f"{BASE_URL}/api/products/{product_id}", headers=owner_headers(), json={
+            "name": "TEST Azúcar",
+            "price": 20.0,
+            "sku": None
+        })
+        assert response.status_code == 200
+        assert response.json()["sku"] is None
+
+
+class TestUnifiedSearch:
+    """Test /api/search groups"""
+
+    def test_empty_query_has_no_groups(self):
+        """A query without searchable terms returns no groups"""
+        response = requests.get(f"{BASE_URL}/api/search", params={"q": "  ¿? "})
+        assert response.status_code == 200
+        assert response.json()["groups"] == []
+
+    def test_groups_respect_limit(self):
+        """Every group is capped at limit and scored"""
+        response = requests.get(f"{BASE_URL}/api/search", params={"q": "a", "limit": 2})
+        assert response.status_code == 200
+        for group in response.json()["groups"]:
+            assert group["type"] in ("pulperias", "products", "jobs", "services")
+            assert len(group["results"]) <= 2
+            assert all(0 <= result["score"] <= 1 for result in group["results"])
+            assert isinstance(group["has_more"], bool)
+
+    def test_product_group_keeps_best_match_first(self, pulperia_id):
+        """A product named after the query leads its group; has_more reflects the rest"""
+        word = f"zq{uuid.uuid4().hex[:6]}"
+        for name in (f"TEST Galleta {word}", f"TEST {word} Refresco", f"TEST Jugo {word}"):
+            response = requests.post(f"{BASE_URL}/api/products", params={"pulperia_id": pulperia_id}, headers=owner_headers(), json={
+                "name": name,
+                "price": 10.0,
+                "description": f"Producto de prueba {word}"
+            })
+            assert response.status_code == 200
+
+        response = requests.get(f"{BASE_URL}/api/search", params={"q": word, "limit": 2, "types": "products"})
+        assert response.status_code == 200
+        groups = response.json()["groups"]
+        assert [group["type"] for group in groups] == ["products"]
+        assert len(groups[0]["results"]) == 2
+        assert groups[0]["has_more"] is True
+        assert all(word in result["name"] for result in groups[0]["results"])
+
+
+class TestNearbyProducts:
+    """Test /api/products ranked around a location"""
+
+    def walk(self, params):
+        """Every product id of a nearby search, following next_cursor"""
+        product_ids = []
+        cursor = None
+        while True:
+            response = requests.get(f"{BASE_URL}/api/products", params={**params, "with_meta": True, "cursor": cursor})
+            assert response.status_code == 200
+            page = response.json()
+            for product in page["results"]:
+                assert product["distance_km"] <= params["radius_km"]
+            product_ids += [product["product_id"] for product in page["results"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                return product_ids
+
+    def test_pages_are_stable(self, pulperia_id):
+        """Paging the same search twice yields the same products, each once"""
+        word = f"zn{uuid.uuid4().hex[:6]}"
+        for index in range(4):
+            response = requests.post(f"{BASE_URL}/api/products", params={"pulperia_id": pulperia_id}, headers=owner_headers(), json={
+                "name": f"TEST Cerca {word} {index}",
+                "price": 10.0 + index
+            })
+            assert response.status_code == 200
+
+        params = {"search": word, "lat": 14.0723, "lng": -87.1921, "radius_km": 5, "limit": 1}
+        first = self.walk(params)
+        assert len(first) == 4
+        assert len(set(first)) == 4
+        assert self.walk(params) == first
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
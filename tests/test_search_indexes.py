@@ -0,0 +1,431 @@
+"""
+Search Index Tests - La Pulpería
+Testing the in-memory search structures in backend/server.py:
+1. Product inverted index with BM25 ranking
+2. Persisted normalized search fields and index-backed prefix queries
+3. Trigram typo correction (did_you_mean)
+4. Search result cache with write-driven invalidation
+5. Typeahead suggestion trie
+6. Shared relevance scoring for unified search
+7. Incrementally maintained category facets
+8. Keyset pagination cursors
+9. Barcode/SKU normalization
+"""
+import pytest
+import os
+import sys
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+# Environments with a MongoDB set this; the index plan tests then fail instead of skipping
+TEST_MONGO_URL = os.environ.get('TEST_MONGO_URL')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+server = pytest.importorskip("server")
+
+
+def make_product(product_id, name, description=None, category=None, pulperia_id="pulperia_test", **extra):
+    return {
+        "product_id": product_id,
+        "pulperia_id": pulperia_id,
+        "name": name,
+        "description": description,
+        "category": category,
+        "available": True,
+        **extra
+    }
+
+
+@pytest.fixture
+def catalog():
+    index = server.ProductSearchIndex()
+    index.add(make_product("p1", "Galletas Oreo", "Galletas de chocolate", "Snacks"))
+    index.add(make_product("p2", "Coca-Cola 2L", "Refresco", "Bebidas"))
+    index.add(make_product("p3", "Leche Entera", "Leche de vaca", "Lácteos"))
+    index.add(make_product("p4", "Café Molido", "Café hondureño con leche en polvo", "Abarrotes"))
+    return index
+
+
+class TestProductSearchIndex:
+    """Test BM25 product search"""
+
+    def test_plural_and_accent_folding(self, catalog):
+        """'galleta' finds 'Galletas' and 'cafe' finds 'Café'"""
+        assert [pid for pid, _ in catalog.search("galleta")] == ["p1"]
+        assert [pid for pid, _ in catalog.search("CAFES")] == ["p4"]
+
+    def test_name_match_ranks_above_description_match(self, catalog):
+        """A product named 'Leche' ranks above one mentioning leche in its description"""
+        ranked = [pid for pid, _ in catalog.search("leche")]
+        assert ranked[0] == "p3"
+        assert "p4" in ranked
+
+    def test_prefix_expansion(self, catalog):
+        """Partial words still match, like the old regex search"""
+        assert [pid for pid, _ in catalog.search("coc")] == ["p2"]
+
+    def test_every_term_must_match(self, catalog):
+        """Like the prefix lookup behind the explicit sorts, all terms are required"""
+        assert [pid for pid, _ in catalog.search("leche vaca")] == ["p3"]
+        assert [pid for pid, _ in catalog.search("cafe lech")] == ["p4"]
+        assert catalog.search("leche pepsi") == []
+
+    def test_snapshot_keeps_scores_stable(self, catalog):
+        """Later pages scored with the first page's snapshot ignore corpus changes"""
+        scores, snapshot = catalog.scored_match("leche")
+        catalog.add(make_product("p5", "Leche Deslactosada", "Leche sin lactosa", "Lácteos"))
+        catalog.add(make_product("p6", "Queso Seco", "Queso de leche entera", "Lácteos"))
+
+        rescored, _ = catalog.scored_match("leche", snapshot)
+        assert rescored["p3"] == scores["p3"]
+        assert rescored["p4"] == scores["p4"]
+        assert catalog.scored_match("leche")[0]["p3"] != scores["p3"]
+        with pytest.raises(ValueError):
+            catalog.scored_match("leche entera", snapshot)
+
+    def test_incremental_update_and_remove(self, catalog):
+        """Updating or removing a product changes results immediately"""
+        catalog.add(make_product("p2", "Pepsi 2L", "Refresco", "Bebidas"))
+        assert catalog.search("coca") == []
+        assert [pid for pid, _ in catalog.search("pepsi")] == ["p2"]
+
+        catalog.remove("p2")
+        assert catalog.search("pepsi") == []
+        assert len(catalog) == 3
+
+    def test_unavailable_products_are_dropped(self, catalog):
+        """apply_product_change removes products marked unavailable"""
+        original = server.product_search_index
+        server.product_search_index = catalog
+        try:
+            server.apply_product_change(make_product("p3", "Leche Entera", available=False))
+            assert [pid for pid, _ in catalog.search("leche")] == ["p4"]
+        finally:
+            server.product_search_index = original
+
+
+class TestPersistedSearchFields:
+    """Test normalized search fields written with each document"""
+
+    def test_build_search_fields(self):
+        """Fields are accent-folded, singularized and expanded to prefixes"""
+        fields = server.build_search_fields("products", {"name": "Café Molido", "category": "Abarrotes"})
+        assert fields["name_norm"] == "cafe molido"
+        assert fields["search_tokens"] == ["cafe", "molido", "abarrote"]
+        assert {"c", "ca", "caf", "cafe", "mol", "abarrote"} <= set(fields["search_prefixes"])
+
+    def test_jobs_use_title_norm(self):
+        """Jobs and services normalize their title"""
+        fields = server.build_search_fields("jobs", {"title": "Electricista", "description": "Instalaciones"})
+        assert fields["title_norm"] == "electricista"
+        assert "instalacione" in fields["search_tokens"]
+
+    def test_prefix_query_is_anchored(self):
+        """Every term becomes an exact match on the prefix keys"""
+        query = server.prefix_search_query("pulperias", "Tortillas Doña")
+        assert query["$or"][0] == {"search_prefixes": {"$all": ["tortilla", "dona"]}}
+
+    @staticmethod
+    def plan_stages(plan):
+        """Every stage dict of an explain plan, depth first"""
+        if isinstance(plan, dict):
+            if "stage" in plan:
+                yield plan
+            for value in plan.values():
+                yield from TestPersistedSearchFields.plan_stages(value)
+        elif isinstance(plan, list):
+            for value in plan:
+                yield from TestPersistedSearchFields.plan_stages(value)
+
+    @pytest.mark.parametrize("collection_name, index, extra", [
+        ("jobs", [("search_prefixes", 1), ("created_at", -1)], {}),
+        ("products", [("search_prefixes", 1), ("available", 1), ("price", 1), ("product_id", 1)], {"available": True}),
+    ])
+    def test_prefix_query_uses_index(self, collection_name, index, extra):
+        """explain() of the real query: each $or branch, backfilled and legacy, is an index scan"""
+        pymongo = pytest.importorskip("pymongo")
+        mongo = pymongo.MongoClient(TEST_MONGO_URL or os.environ["MONGO_URL"], serverSelectionTimeoutMS=500)
+        try:
+            mongo.admin.command("ping")
+        except Exception:
+            if TEST_MONGO_URL:
+                raise
+            pytest.skip("TEST_MONGO_URL not set and no local MongoDB")
+
+        name_field, _ = server.SEARCH_FIELD_SOURCES[collection_name]
+        collection = mongo["la_pulperia_test"][f"{collection_name}_explain"]
+        collection.drop()
+        collection.create_index(index)
+        collection.insert_many([
+            {name_field: name, "available": True, "price": 10, **server.build_search_fields(collection_name, {name_field: name})}
+            for name in ["Galletas Oreo", "Coca Cola", "Leche Entera", "Pan Dulce"]
+        ] + [{name_field: "Galletas Maria", "available": True, "price": 12}])
+
+        try:
+            query = {**server.prefix_search_query(collection_name, "galle"), **extra}
+            plan = collection.find(query).explain()["queryPlanner"]["winningPlan"]
+            stages = list(self.plan_stages(plan))
+            assert not [stage for stage in stages if stage["stage"] == "COLLSCAN"]
+
+            or_stage = next(stage for stage in stages if stage["stage"] == "OR")
+            assert len(or_stage["inputStages"]) == len(query["$or"])
+            for branch in or_stage["inputStages"]:
+                scans = [stage for stage in self.plan_stages(branch) if stage["stage"] == "IXSCAN"]
+                assert scans and all(scan["keyPattern"] == dict(index) for scan in scans)
+
+            assert sorted(doc[name_field] for doc in collection.find(query)) == ["Galletas Maria", "Galletas Oreo"]
+        finally:
+            collection.drop()
+
+
+class TestTypoCorrection:
+    """Test trigram candidates re-ranked by Levenshtein distance"""
+
+    def test_product_typos_are_corrected(self, catalog):
+        """Common misspellings map back to catalog terms"""
+        catalog.add(make_product("p5", "Arroz Precocido", "Arroz blanco", "Granos"))
+        assert catalog.correct_query("galetas") == "galleta"
+        assert catalog.correct_query("cosa cola") == "coca cola"
+        assert catalog.correct_query("arrox") == "arroz"
+        # "arros" singularizes to a prefix of "arroz" and matches directly
+        assert [pid for pid, _ in catalog.search("arros")] == ["p5"]
+
+    def test_known_terms_and_prefixes_are_kept(self, catalog):
+        """A query that already matches needs no suggestion"""
+        assert catalog.correct_query("leche") is None
+        assert catalog.correct_query("lech") is None
+
+    def test_short_terms_are_not_fuzzed(self):
+        """Terms under three characters only match exactly"""
+        vocabulary = server.TrigramIndex()
+        vocabulary.add_term("pan")
+        assert vocabulary.suggest("pa") == []
+        assert vocabulary.suggest("pam") == [("pan", 1)]
+
+    def test_removed_terms_stop_suggesting(self, catalog):
+        """Vocabulary follows product removals"""
+        catalog.remove("p2")
+        assert catalog.correct_query("cosa") is None
+
+    def test_pulperia_vocabulary_documents(self):
+        """Pulperia names feed their own vocabulary, replaced on update"""
+        vocabulary = server.TrigramIndex()
+        vocabulary.set_document("pul_1", server.search_tokens("Pulpería Doña María"))
+        assert vocabulary.correct_query("dona marya") == "dona maria"
+
+        vocabulary.set_document("pul_1", server.search_tokens("Pulpería El Sol"))
+        assert vocabulary.correct_query("marya") is None
+        assert vocabulary.correct_query("el zol") == "el sol"
+
+
+class TestSearchResultCache:
+    """Test the /api/products response cache"""
+
+    @pytest.fixture
+    def cache(self):
+        cache = server.SearchResultCache(max_entries=10, ttl_seconds=60)
+        cache.set(cache.make_key("Cocas", None, None), [make_product("p2", "Coca-Cola 2L", pulperia_id="pul_a")])
+        cache.set(cache.make_key("pan", None, "price_asc"), [make_product("p9", "Pan Dulce", pulperia_id="pul_b")])
+        cache.set(cache.make_key(None, "Bebidas", None), [make_product("p2", "Coca-Cola 2L", pulperia_id="pul_a")])
+        return cache
+
+    def test_key_is_normalized(self, cache):
+        """Accents, case and plurals share one entry"""
+        assert cache.make_key("Cocas", None, None) == cache.make_key("coca", "", "")
+        assert cache.get(cache.make_key("COCA", None, None)) is not None
+        assert cache.get(cache.make_key("coca", None, "price_desc")) is None
+        assert cache.stats()["hit_ratio"] == 0.5
+
+    def test_product_in_results_invalidates(self, cache):
+        """Updating a cached product drops every entry that returned it"""
+        cache.invalidate_product(make_product("p2", "Coca-Cola 3L", category="Bebidas", pulperia_id="pul_a"))
+        assert cache.get(cache.make_key("coca", None, None)) is None
+        assert cache.get(cache.make_key(None, "Bebidas", None)) is None
+        assert cache.get(cache.make_key("pan", None, "price_asc")) is not None
+
+    def test_new_matching_product_invalidates(self, cache):
+        """A new product whose words extend a cached term drops that query only"""
+        cache.invalidate_product(make_product("p10", "Pancakes", category="Desayuno"))
+        assert cache.get(cache.make_key("pan", None, "price_asc")) is None
+        assert cache.get(cache.make_key("coca", None, None)) is not None
+        assert cache.get(cache.make_key(None, "Bebidas", None)) is not None
+
+    def test_pulperia_change_invalidates(self, cache):
+        """Renaming a pulperia drops results showing its name"""
+        cache.invalidate_pulperia("pul_b")
+        assert cache.get(cache.make_key("pan", None, "price_asc")) is None
+        assert cache.get(cache.make_key("coca", None, None)) is not None
+
+    def test_empty_results_follow_vocabulary(self, cache):
+        """A zero-hit search is dropped by any product write"""
+        cache.set(cache.make_key("galetas", None, None), [])
+        cache.invalidate_product(make_product("p11", "Tortillas"))
+        assert cache.get(cache.make_key("galetas", None, None)) is None
+
+    def test_lru_eviction(self):
+        """The least recently used query is evicted first"""
+        cache = server.SearchResultCache(max_entries=1, ttl_seconds=60)
+        cache.set(cache.make_key("coca", None, None), [])
+        cache.set(cache.make_key("pan", None, None), [])
+        assert cache.get(cache.make_key("coca", None, None)) is None
+        assert cache.stats()["evictions"] == 1
+
+    def test_result_raced_by_write_is_not_stored(self, cache):
+        """A response computed across an invalidation is discarded"""
+        generation = cache.generation
+        cache.invalidate_product(make_product("p12", "Tortillas"))
+        cache.set(cache.make_key("tortilla", None, None), [], generation=generation)
+        assert cache.get(cache.make_key("tortilla", None, None)) is None
+        assert cache.stats()["stale_discards"] == 1
+
+        cache.set(cache.make_key("tortilla", None, None), [], generation=cache.generation)
+        assert cache.get(cache.make_key("tortilla", None, None)) is not None
+
+
+class TestSearchSuggestTrie:
+    """Test popularity-weighted typeahead suggestions"""
+
+    @pytest.fixture
+    def trie(self):
+        trie = server.SearchSuggestTrie()
+        trie.set_product(make_product("p1", "Coco Rallado", category="Abarrotes"))
+        trie.set_product(make_product("p2", "Coca-Cola 2L", category="Bebidas"))
+        trie.set_pulperia({"pulperia_id": "pul_a", "name": "Pulpería Doña Tere"})
+        return trie
+
+    def texts(self, trie, query):
+        return [suggestion["text"] for suggestion in trie.suggest(query)]
+
+    def test_prefix_matches_any_word(self, trie):
+        """Suggestions complete from the start of every word, accent-insensitive"""
+        assert set(self.texts(trie, "co")) == {"Coco Rallado", "Coca-Cola 2L"}
+        assert self.texts(trie, "cola") == ["Coca-Cola 2L"]
+        assert self.texts(trie, "DONA") == ["Pulpería Doña Tere"]
+        assert trie.suggest("beb") == [{"text": "Bebidas", "type": "category"}]
+
+    def test_orders_raise_popularity(self, trie):
+        """Ordered products move ahead of the others"""
+        trie.record_order({"pulperia_id": "pul_a", "items": [{"product_id": "p2"}]})
+        assert self.texts(trie, "co")[0] == "Coca-Cola 2L"
+        trie.record_order({"pulperia_id": "pul_a", "items": [{"product_id": "p1"}]})
+        trie.record_order({"pulperia_id": "pul_a", "items": [{"product_id": "p1"}]})
+        assert self.texts(trie, "co")[0] == "Coco Rallado"
+
+    def test_shared_names_merge(self, trie):
+        """The same product in two pulperias is one suggestion with both weights"""
+        trie.set_product(make_product("p3", "Coca Cola 2L", pulperia_id="pul_b"))
+        assert self.texts(trie, "coca") == ["Coca-Cola 2L"]
+        trie.set_product(make_product("p4", "Coca", pulperia_id="pul_c"))
+        assert self.texts(trie, "coca") == ["Coca-Cola 2L", "Coca"]
+
+    def test_incremental_rename_and_remove(self, trie):
+        """Product writes update the trie without a rebuild"""
+        trie.set_product(make_product("p2", "Pepsi 2L", category="Bebidas"))
+        assert self.texts(trie, "coca") == []
+        assert self.texts(trie, "pep") == ["Pepsi 2L"]
+
+        trie.remove_source("p2")
+        assert self.texts(trie, "pep") == []
+        assert self.texts(trie, "beb") == []
+
+
+class TestUnifiedSearchRanking:
+    """Test the ranking model shared by every /api/search group"""
+
+    def test_title_beats_text(self):
+        """A title match outranks a description match across collections"""
+        terms = server.search_tokens("electricistas")
+        service = {"title": "Electricista", "description": "Casas y negocios"}
+        job = {"title": "Ayudante", "description": "Buscamos electricista"}
+        assert server.relevance_score(terms, "services", service) == 1.0
+        assert server.relevance_score(terms, "jobs", job) == 0.5
+
+    def test_prefix_and_partial_matches(self):
+        """Prefixes score below whole words and unmatched terms dilute the score"""
+        product = make_product("p1", "Tortillas de maíz", category="Granos")
+        assert server.relevance_score(["tort"], "products", product) == 0.75
+        assert server.relevance_score(["tortilla", "queso"], "products", product) == 0.5
+        assert server.relevance_score([], "products", product) == 0.0
+
+
+class TestCategoryFacets:
+    """Test category counts maintained from product writes"""
+
+    @pytest.fixture
+    def facets(self):
+        facets = server.CategoryFacets()
+        facets.add(make_product("p1", "Coca-Cola", category="Bebidas", pulperia_id="pul_a"))
+        facets.add(make_product("p2", "Pepsi", category="Bebidas", pulperia_id="pul_b"))
+        facets.add(make_product("p3", "Oreo", category="Snacks", pulperia_id="pul_a"))
+        return facets
+
+    def test_global_and_per_pulperia_counts(self, facets):
+        """Counts are kept both globally and per pulperia, largest first"""
+        assert facets.get() == [{"category": "Bebidas", "count": 2}, {"category": "Snacks", "count": 1}]
+        assert facets.get("pul_b") == [{"category": "Bebidas", "count": 1}]
+        assert facets.get("pul_missing") == []
+
+    def test_recategorize_and_remove(self, facets):
+        """Moving a product between categories and removing it adjust the counts"""
+        facets.add(make_product("p2", "Pepsi", category="Snacks", pulperia_id="pul_b"))
+        assert facets.get() == [{"category": "Snacks", "count": 2}, {"category": "Bebidas", "count": 1}]
+
+        facets.remove("p2")
+        facets.remove("p2")
+        assert facets.get() == [{"category": "Bebidas", "count": 1}, {"category": "Snacks", "count": 1}]
+        assert facets.get("pul_b") == []
+
+    def test_result_set_counts(self, facets):
+        """Facets for a search come from the in-memory map of matched ids"""
+        assert facets.count_products(["p1", "p3", "unknown"]) == [
+            {"category": "Bebidas", "count": 1},
+            {"category": "Snacks", "count": 1}
+        ]
+
+
+class TestKeysetPagination:
+    """Test opaque cursors and keyset filters for product pages"""
+
+    def test_cursor_roundtrip(self):
+        """A cursor decodes back to its sort values for the same sort"""
+        token = server.encode_cursor({"sort": "price_asc", "after": [12.5, "prod_abc"], "q": "coca"})
+        assert "=" not in token
+        assert server.decode_cursor(token, "price_asc")["after"] == [12.5, "prod_abc"]
+
+    def test_cursor_rejected_for_other_sort_or_garbage(self):
+        """Mismatched or malformed cursors are a 400"""
+        token = server.encode_cursor({"sort": "price_asc", "after": [1, "p1"]})
+        for bad_token, sort_name in [(token, "newest"), ("not-a-cursor", "price_asc")]:
+            with pytest.raises(server.HTTPException) as exc:
+                server.decode_cursor(bad_token, sort_name)
+            assert exc.value.status_code == 400
+
+    def test_keyset_filter_follows_sort_direction(self):
+        """The filter seeks on the leading key and breaks ties on product_id"""
+        ascending = server.keyset_filter(server.PRODUCT_SORTS["price_asc"], [10, "p5"])
+        assert ascending == {
+            "price": {"$gte": 10},
+            "$or": [{"price": {"$gt": 10}}, {"price": 10, "product_id": {"$gt": "p5"}}]
+        }
+        descending = server.keyset_filter(server.PRODUCT_SORTS["price_desc"], [10, "p5"])
+        assert descending["$or"][1] == {"price": 10, "product_id": {"$lt": "p5"}}
+
+
+class TestProductCodes:
+    """Test barcode/SKU handling on product writes"""
+
+    def test_normalize_code(self):
+        """Scanner and hand-typed codes collapse to the same key"""
+        assert server.normalize_code(" 7 501-055 3032 45 ") == "7501055303245"
+        assert server.normalize_code("ab-12") == "AB12"
+        assert server.normalize_code("  ") is None
+        assert server.normalize_code(None) is None
+
+    def test_product_fields_normalize_codes(self):
+        """Empty codes are stored as null so the partial unique index ignores them"""
+        fields = server.product_fields(server.ProductCreate(name="Coca", price=25, barcode="750-1055", sku=""))
+        assert fields["barcode"] == "7501055"
+        assert fields["sku"] is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,257 @@
+"""
+Session/Auth Tests - La Pulpería
+Testing the in-process auth helpers in backend/server.py:
+1. Session cache (LRU + TTL, invalidation, hit/miss counters)
+2. Signed stateless session tokens and the revocation list
+3. Session date normalization and coalesced sliding expiry
+4. Shared upstream HTTP client and its latency histogram
+5. Local Google ID token verification against a stand-in key set
+"""
+import pytest
+import os
+import sys
+from datetime import datetime, timezone, timedelta
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+server = pytest.importorskip("server")
+
+
+def make_user(user_id="user_test123456", user_type="cliente"):
+    return server.User(
+        user_id=user_id,
+        email="test@example.com",
+        name="Test",
+        user_type=user_type,
+        created_at=datetime.now(timezone.utc)
+    )
+
+
+class TestSessionCache:
+    """Test the session cache used by get_current_user"""
+
+    def test_hit_and_miss_counters(self):
+        """A cached token is a hit, an unknown token is a miss"""
+        cache = server.SessionCache(max_entries=10, ttl_seconds=60)
+        expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+        cache.set("sess_a", make_user(), expires_at)
+
+        assert cache.get("sess_a")["user"].user_id == "user_test123456"
+        assert cache.get("sess_b") is None
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_ratio"] == 0.5
+
+    def test_lru_eviction(self):
+        """The least recently used token is evicted first"""
+        cache = server.SessionCache(max_entries=2, ttl_seconds=60)
+        expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+        cache.set("sess_a", make_user("user_a"), expires_at)
+        cache.set("sess_b", make_user("user_b"), expires_at)
+        cache.get("sess_a")
+        cache.set("sess_c", make_user("user_c"), expires_at)
+
+        assert cache.get("sess_b") is None
+        assert cache.get("sess_a") is not None
+        assert cache.get("sess_c") is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_ttl_expiry(self):
+        """Entries older than the TTL are treated as misses"""
+        cache = server.SessionCache(max_entries=10, ttl_seconds=0)
+        cache.set("sess_a", make_user(), datetime.now(timezone.utc) + timedelta(days=1))
+        assert cache.get("sess_a") is None
+        assert cache.stats()["entries"] == 0
+
+    def test_invalidate_user_drops_all_tokens(self):
+        """Changing a user invalidates every cached session of that user"""
+        cache = server.SessionCache(max_entries=10, ttl_seconds=60)
+        expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+        cache.set("sess_a", make_user("user_a"), expires_at)
+        cache.set("sess_a2", make_user("user_a"), expires_at)
+        cache.set("sess_b", make_user("user_b"), expires_at)
+
+        cache.invalidate_user("user_a")
+
+        assert cache.get("sess_a") is None
+        assert cache.get("sess_a2") is None
+        assert cache.get("sess_b") is not None
+        assert "user_a" not in cache.user_tokens
+
+
+class TestSignedSessionTokens:
+    """Test HMAC-signed session tokens"""
+
+    @pytest.fixture(autouse=True)
+    def signing_key(self, monkeypatch):
+        monkeypatch.setattr(server, "SESSION_SIGNING_KEY", "test-signing-key")
+        monkeypatch.setattr(server, "revoked_sessions", server.RevocationList())
+
+    def test_roundtrip_carries_claims(self):
+        """A signed token validates locally and carries user_id, user_type and expiry"""
+        token = server.issue_signed_session_token("user_abc", "pulperia")
+        assert server.is_signed_session_token(token)
+        assert not server.is_signed_session_token("sess_0123456789abcdef")
+
+        claims = server.decode_signed_session_token(token)
+        assert claims["sub"] == "user_abc"
+        assert claims["user_type"] == "pulperia"
+        assert claims["exp"] > datetime.now(timezone.utc).timestamp()
+
+    def test_tampered_token_rejected(self):
+        """A token signed with another key is rejected with 401"""
+        token = server.issue_signed_session_token("user_abc", "cliente")
+        server.SESSION_SIGNING_KEY = "another-key"
+        with pytest.raises(server.HTTPException) as exc:
+            server.decode_signed_session_token(token)
+        assert exc.value.status_code == 401
+
+    def test_revoked_token_rejected(self):
+        """A revoked token id is rejected even though the signature is valid"""
+        token = server.issue_signed_session_token("user_abc", "cliente")
+        claims = server.decode_signed_session_token(token)
+        server.revoked_sessions.add(claims["jti"], claims["exp"])
+        with pytest.raises(server.HTTPException) as exc:
+            server.decode_signed_session_token(token)
+        assert exc.value.status_code == 401
+
+
+class TestSessionExpiry:
+    """Test session date handling and sliding expiry"""
+
+    def test_to_utc_datetime_accepts_legacy_and_bson_values(self):
+        """ISO strings and naive BSON datetimes both normalize to aware UTC"""
+        naive = datetime(2025, 1, 1, 12, 0)
+        assert server.to_utc_datetime(naive).tzinfo == timezone.utc
+        assert server.to_utc_datetime("2025-01-01T12:00:00+00:00") == naive.replace(tzinfo=timezone.utc)
+
+    def test_slide_is_skipped_within_touch_interval(self, monkeypatch):
+        """A session touched recently is not written again"""
+        import asyncio
+        monkeypatch.setattr(server, "SESSION_SLIDING_EXPIRY", True)
+        recently = datetime.now(timezone.utc) - timedelta(seconds=5)
+        assert asyncio.run(server.slide_session_expiry("sess_a", recently)) is None
+
+    def test_slide_is_skipped_when_disabled(self, monkeypatch):
+        """Sliding expiry is opt-in"""
+        import asyncio
+        monkeypatch.setattr(server, "SESSION_SLIDING_EXPIRY", False)
+        assert asyncio.run(server.slide_session_expiry("sess_a", None)) is None
+
+
+class TestUpstreamClient:
+    """Test the pooled client used for OAuth calls"""
+
+    def test_histogram_percentiles(self):
+        """Latencies land in the right buckets"""
+        histogram = server.LatencyHistogram()
+        for _ in range(9):
+            histogram.record("oauth2.googleapis.com", 0.020)
+        histogram.record("oauth2.googleapis.com", 0.800, error=True)
+
+        snapshot = histogram.snapshot()["oauth2.googleapis.com"]
+        assert snapshot["count"] == 10
+        assert snapshot["errors"] == 1
+        assert snapshot["p50_ms"] == 25
+        assert snapshot["p99_ms"] == 1000
+
+    def test_requests_reuse_one_client_and_record_latency(self):
+        """Calls go through the shared client and are timed per host"""
+        import asyncio
+        import httpx
+
+        def handler(request):
+            return httpx.Response(200, json={"host": request.url.host})
+
+        async def run():
+            upstream = server.UpstreamClient()
+            upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            first = await upstream.get("https://www.googleapis.com/oauth2/v2/userinfo")
+            second = await upstream.post("https://oauth2.googleapis.com/token", data={})
+            await upstream.close()
+            return first, second, upstream.latency.snapshot()
+
+        first, second, snapshot = asyncio.run(run())
+        assert first.json()["host"] == "www.googleapis.com"
+        assert second.status_code == 200
+        assert snapshot["www.googleapis.com"]["count"] == 1
+        assert snapshot["oauth2.googleapis.com"]["errors"] == 0
+
+
+class TestGoogleIdTokenVerification:
+    """Test local ID token verification with a stand-in JWKS"""
+
+    @pytest.fixture
+    def signing_key(self):
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    @pytest.fixture
+    def key_set(self, signing_key):
+        import jwt
+        jwk = jwt.algorithms.RSAAlgorithm.to_jwk(signing_key.public_key(), as_dict=True)
+        jwk.update({"kid": "test-kid", "alg": "RS256", "use": "sig"})
+        keys = server.GoogleKeySet(jwks_url="http://localhost/unused")
+        keys.load({"keys": [jwk]})
+        return keys
+
+    def make_id_token(self, signing_key, **overrides):
+        import jwt
+        now = datetime.now(timezone.utc)
+        claims = {
+            "iss": "https://accounts.google.com",
+            "aud": "test-client-id",
+            "sub": "1234567890",
+            "email": "cliente@example.com",
+            "email_verified": True,
+            "name": "Cliente Prueba",
+            "iat": now,
+            "exp": now + timedelta(hours=1),
+            **overrides
+        }
+        return jwt.encode(claims, signing_key, algorithm="RS256", headers={"kid": "test-kid"})
+
+    def test_valid_token_verified_locally(self, signing_key, key_set):
+        """A token signed by a known key yields its claims without network calls"""
+        import asyncio
+        claims = asyncio.run(key_set.verify_id_token(self.make_id_token(signing_key), "test-client-id"))
+        assert claims["email"] == "cliente@example.com"
+        assert claims["name"] == "Cliente Prueba"
+
+    def test_wrong_audience_rejected(self, signing_key, key_set):
+        """A token issued for another client is rejected"""
+        import asyncio
+        import jwt
+        token = self.make_id_token(signing_key, aud="someone-else")
+        with pytest.raises(jwt.InvalidTokenError):
+            asyncio.run(key_set.verify_id_token(token, "test-client-id"))
+
+    def test_wrong_issuer_rejected(self, signing_key, key_set):
+        """A token not issued by Google is rejected"""
+        import asyncio
+        import jwt
+        token = self.make_id_token(signing_key, iss="https://evil.example.com")
+        with pytest.raises(jwt.InvalidTokenError):
+            asyncio.run(key_set.verify_id_token(token, "test-client-id"))
+
+    @pytest.mark.parametrize("body", ["<html>mantenimiento</html>", '{"keys": "none"}', '{"keys": [{"kty": "RSA", "kid": "k"}]}'])
+    def test_malformed_jwks_keeps_keys(self, key_set, monkeypatch, body):
+        """A broken JWKS body raises GoogleKeySetError, which login treats as a fallback, and keeps the old keys"""
+        import asyncio
+        import httpx
+
+        async def fake_get(url, **kwargs):
+            return httpx.Response(200, text=body, request=httpx.Request("GET", url))
+
+        monkeypatch.setattr(server.upstream, "get", fake_get)
+        key_set.fetched_at = None
+        with pytest.raises(server.GoogleKeySetError):
+            asyncio.run(key_set.refresh())
+        assert list(key_set.keys) == ["test-kid"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])